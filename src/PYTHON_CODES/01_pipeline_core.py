@@ -5,14 +5,35 @@ import json
 import shutil
 import gzip
 import logging
+import numpy as np
 import pandas as pd
 import re
+import shlex
 import csv
+import atexit
 import concurrent.futures
 import multiprocessing
 from functools import partial
 from collections import defaultdict
 
+# Dependencia opcional: solo se usa si 'matrix_binary_format' pide Parquet/Feather.
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from index_cache import obtain_cached_index, hold_index_entry, file_sha256, get_tool_version, compute_cache_key
+from download_manager import download_file, load_md5_map, md5_list_path_for, load_ensembl_checksums, DownloadError
+from telemetry import run_tool, configure_telemetry, summarize_run_profile
+from run_planner import make_step, plan_run, invalidate_stale_outputs, record_manifest, load_manifest, format_plan
+from slurm_backend import run_samples_on_slurm
+from matrix_store import build_matrix_store, columnar_path, COLUMNAR_EXTENSIONS
+from gtf_index import load_gtf_index
+from decompression import decompress_gzip_file
+from resource_allocator import detect_resources, index_build_memory, plan_index_builds, sample_memory_model, plan_sample_slots, QC_STAGE_BYTES, GiB
+
 # ==============================================================================
 # SECCIÓN 1: FUNCIONES AUXILIARES Y DE CONFIGURACIÓN
 # ==============================================================================
@@ -45,19 +66,22 @@ def read_urls_from_file(file_path):
     except FileNotFoundError:
         logging.error(f"❌ No se encontró el archivo de lista de FASTQs: {file_path}"); exit(1)
 
-def run_parallel_downloads(urls, destination_dir, max_workers):
+def run_parallel_downloads(urls, destination_dir, max_workers, download_config=None, md5_map=None):
     if not urls: logging.info(f"🤷 No hay URLs para descargar en {os.path.basename(destination_dir)}. Saltando."); return
     logging.info(f"⬇️  Iniciando descarga de {len(urls)} archivos en {os.path.basename(destination_dir)} con {max_workers} hilos...")
+    md5_map = md5_map or {}
+    # Genomas y GTF de Ensembl: se verifican contra el CHECKSUMS publicado en su misma carpeta.
+    pending_urls = [url for url in urls if not os.path.exists(os.path.join(destination_dir, os.path.basename(url)).removesuffix(".gz"))]
+    sum_map = load_ensembl_checksums(pending_urls) if (download_config or {}).get("verify_ensembl_checksums", True) else {}
     def download_worker(url):
         filename = os.path.basename(url)
         filepath = os.path.join(destination_dir, filename)
         uncompressed_path = filepath[:-3] if filepath.endswith(".gz") else filepath
-        if os.path.exists(uncompressed_path) or os.path.exists(filepath): return ('SALTADO', filename)
+        if os.path.exists(uncompressed_path): return ('SALTADO', filename)
         try:
-            subprocess.run(["wget", "-q", "-P", destination_dir, url], check=True, capture_output=True, text=True)
-            return ('OK', filename)
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"⚠️  Error descargando {filename}: {e.stderr.strip()}."); return ('ERROR', filename)
+            return (download_file(url, filepath, md5_map.get(filename), download_config, sum_map.get(filename)), filename)
+        except DownloadError as e:
+            logging.warning(f"⚠️  Error descargando {filename}: {e}."); return ('ERROR', filename)
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         results = list(executor.map(download_worker, urls))
@@ -65,25 +89,30 @@ def run_parallel_downloads(urls, destination_dir, max_workers):
     skipped_files = [f for status, f in results if status == 'SALTADO']
     if skipped_files: logging.info(f"  -> 📝 {len(skipped_files)} archivos saltados (ya existían) en {os.path.basename(destination_dir)}.")
 
-def unzip_single_file(gz_path):
+def unzip_single_file(gz_path, threads=1):
     out_path = gz_path[:-3]
     if os.path.exists(out_path):
         try: os.remove(gz_path); return ('SALTADO', os.path.basename(gz_path))
         except OSError: return ('ERROR_BORRADO', os.path.basename(gz_path))
     try:
-        with gzip.open(gz_path, 'rb') as f_in, open(out_path, 'wb') as f_out: shutil.copyfileobj(f_in, f_out)
+        engine = decompress_gzip_file(gz_path, out_path, threads)
+        logging.debug(f"    -> {os.path.basename(gz_path)} descomprimido con {engine}")
         os.remove(gz_path); return ('OK', os.path.basename(gz_path))
     except Exception as e:
         logging.error(f"❌ Error descomprimiendo {os.path.basename(gz_path)}: {e}"); return ('ERROR', os.path.basename(gz_path))
 
-def unzip_files_parallel(directory, process_executor):
-    """Descomprime archivos .gz en paralelo usando un pool de procesos compartido."""
+def unzip_files_parallel(directory, process_executor, threads=1):
+    """
+    Descomprime archivos .gz en paralelo usando un pool de procesos compartido. Los 'threads' del nodo
+    se reparten entre los archivos, así que un único FASTA grande también usa varios núcleos.
+    """
     logging.info(f"📦 Iniciando descompresión paralela en {directory}...")
     files_to_unzip = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".gz")]
     if not files_to_unzip:
         logging.info(f"🤷 No hay archivos .gz para descomprimir en {directory}."); return
 
-    results = list(process_executor.map(unzip_single_file, files_to_unzip))
+    threads_per_file = max(1, threads // len(files_to_unzip))
+    results = list(process_executor.map(partial(unzip_single_file, threads=threads_per_file), files_to_unzip))
     
     ok_files = [f for status, f in results if status == 'OK']
     skipped_files = [f for status, f in results if status == 'SALTADO']
@@ -131,7 +160,7 @@ def get_reference_files(reference_dir):
         elif fname.endswith(".gtf"): gtf_file = os.path.join(reference_dir, fname)
     return fasta_file, gtf_file
 
-def prepare_adapters(base_dir, adapter_url):
+def prepare_adapters(base_dir, adapter_url, download_config=None):
     if not adapter_url: logging.warning("⚠️ No se proporcionó URL de adaptadores."); return None
     adapters_dir = os.path.join(base_dir, "adapters")
     adapters_file = os.path.join(adapters_dir, "TruSeq_adapters.fa")
@@ -139,7 +168,7 @@ def prepare_adapters(base_dir, adapter_url):
         create_directory(adapters_dir)
         logging.info(f"⬇️ Descargando adaptadores desde {adapter_url}...")
         try:
-            subprocess.run(["wget", "-O", adapters_file, adapter_url], check=True, capture_output=True, text=True)
+            download_file(adapter_url, adapters_file, download_config=download_config)
             logging.info(f"✅ Adaptadores descargados en {adapters_file}")
         except Exception as e:
             logging.error(f"❌ Error al descargar adaptadores: {e}"); return None
@@ -148,10 +177,12 @@ def prepare_adapters(base_dir, adapter_url):
     return adapters_file
 
 
-def download_and_prepare_matrix(matrix_url, output_dir):
+def download_and_prepare_matrix(matrix_url, output_dir, download_config=None, max_memory_mb=256, binary_format=None):
     """
-    Descarga, descomprime, detecta separador, limpia y estandariza la matriz
-    a formato CSV, reemplazando guiones en los nombres de columnas por puntos.
+    Descarga, detecta separador, limpia y estandariza la matriz a formato CSV, reemplazando
+    guiones en los nombres de columnas por puntos. Se procesa en streaming desde el .gz, por
+    bloques de filas cuyo tamaño se calcula para no superar 'max_memory_mb', así que el pico
+    de memoria no depende del tamaño de la matriz (cohortes tipo GTEx o single-cell).
     """
     create_directory(output_dir)
     filename = os.path.basename(matrix_url)
@@ -165,42 +196,82 @@ def download_and_prepare_matrix(matrix_url, output_dir):
     if not os.path.exists(compressed_path):
         logging.info(f"⬇️ Descargando matriz de conteos desde {matrix_url}...")
         try:
-            subprocess.run(["wget", "-O", compressed_path, matrix_url], check=True, capture_output=True, text=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"❌ Error descargando la matriz: {e.stderr}"); return None
-
-    uncompressed_path = compressed_path[:-3] if filename.endswith(".gz") else compressed_path
-    if filename.endswith(".gz"):
-        logging.info(f"📦 Descomprimiendo {filename}...")
-        with gzip.open(compressed_path, 'rb') as f_in, open(uncompressed_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+            download_file(matrix_url, compressed_path, download_config=download_config)
+        except DownloadError as e:
+            logging.error(f"❌ Error descargando la matriz: {e}"); return None
 
+    compression = 'gzip' if filename.endswith(".gz") else None
     try:
         logging.info(f"🕵️  Detectando separador y limpiando la matriz...")
         sep = ','
         try:
-            with open(uncompressed_path, 'r', newline='') as f:
-                sample = f.read(4096)
+            with (gzip.open(compressed_path, 'rt', newline='') if compression else open(compressed_path, 'r', newline='')) as f:
+                # Las líneas de comentario (cabecera de featureCounts) confundirían al detector.
+                sample = "".join(line for _, line in zip(range(20), f) if not line.startswith('#'))
                 dialect = csv.Sniffer().sniff(sample, delimiters=',\t ')
                 sep = dialect.delimiter
                 logging.info(f"    -> Separador detectado: '{repr(sep)}'")
         except csv.Error:
             logging.warning(f"⚠️  El detective de CSV falló. Se usará la coma (,) como separador por defecto.")
 
-        df = pd.read_csv(uncompressed_path, sep=sep, comment='#', index_col=0)
-        
+        # Solo se leen la columna de IDs y las de muestras: las de anotación se descartan en el parser.
+        header = pd.read_csv(compressed_path, sep=sep, comment='#', nrows=0, compression=compression).columns
         annotation_cols_to_remove = ['Chr', 'Start', 'End', 'Strand', 'Length']
-        cleaned_df = df[[col for col in df.columns if col not in annotation_cols_to_remove]]
-
-        cleaned_df.columns = cleaned_df.columns.str.replace('-', '.', regex=False)
+        keep_positions = [0] + [i for i, col in enumerate(header) if i > 0 and col not in annotation_cols_to_remove]
+
+        # ~8 bytes por valor más el coste del parseo de texto: se reserva ~4x por celda.
+        rows_per_chunk = max(100, int(max_memory_mb * 1024 ** 2 / (32 * len(keep_positions))))
+        logging.info(f"    -> Lectura por bloques de {rows_per_chunk} filas (límite ~{max_memory_mb} MB).")
+        read_chunks = lambda dtype=None: pd.read_csv(compressed_path, sep=sep, comment='#', index_col=0, usecols=keep_positions,
+                                                     compression=compression, chunksize=rows_per_chunk, dtype=dtype)
+        # Primera pasada: el tipo de cada columna se decide con el archivo entero, como en una lectura completa.
+        # Si algún bloque de una columna tiene decimales o huecos, toda la columna se lee como float ("5.0"),
+        # y el formato del CSV no depende de dónde caigan los cortes entre bloques.
+        column_kinds = defaultdict(set)
+        for chunk in read_chunks():
+            for col, dtype in chunk.dtypes.items():
+                column_kinds[col].add(dtype.kind)
+        float_columns = {col: 'float64' for col, kinds in column_kinds.items() if kinds == {'i', 'f'}}
+        reader = read_chunks(float_columns or None)
+
+        tmp_path = f"{standardized_csv_path}.tmp"
+        n_genes = 0
+        # Copia columnar escrita a la vez, bloque a bloque. Feather (Arrow IPC) no admite diccionarios
+        # distintos entre bloques, así que ahí gene_id va como texto.
+        columnar_file = columnar_path(standardized_csv_path, binary_format) if columnar_enabled(binary_format) else None
+        columnar_writer, columnar_schema = None, None
+        with open(tmp_path, 'w', newline='') as f_out:
+            for i, chunk in enumerate(reader):
+                chunk.columns = chunk.columns.str.replace('-', '.', regex=False)
+                # Columnas enteras: se reducen al menor tipo entero que las contiene (menos memoria, mismo texto).
+                for col in chunk.columns:
+                    if chunk[col].dtype.kind == 'i':
+                        chunk[col] = pd.to_numeric(chunk[col], downcast='integer')
+                chunk.to_csv(f_out, sep=',', header=(i == 0))
+                n_genes += len(chunk)
+                if columnar_file:
+                    try:
+                        table = matrix_to_arrow(chunk, columnar_schema, dictionary_ids=binary_format == "parquet")
+                        if columnar_writer is None:
+                            columnar_schema = table.schema
+                            columnar_writer = open_columnar_writer(f"{columnar_file}.tmp", columnar_schema, binary_format)
+                        columnar_writer.write_table(table)
+                    except pa.ArrowInvalid as e:
+                        # Un bloque posterior no encaja en los tipos del primero (p. ej. decimales en una columna entera).
+                        logging.warning(f"⚠️ Se descarta la copia {binary_format} de la matriz: {e}")
+                        if columnar_writer: columnar_writer.close()
+                        if os.path.exists(f"{columnar_file}.tmp"): os.remove(f"{columnar_file}.tmp")
+                        columnar_file, columnar_writer = None, None
+        os.replace(tmp_path, standardized_csv_path)
+        if columnar_writer:
+            columnar_writer.close()
+            os.replace(f"{columnar_file}.tmp", columnar_file)
+            logging.info(f"    -> Copia columnar ({binary_format}): {columnar_file}")
         logging.info("    -> Nombres de columnas estandarizados (guiones '-' reemplazados por puntos '.').")
-        
-        cleaned_df.to_csv(standardized_csv_path, sep=',')
-        logging.info(f"✅ Matriz limpia guardada en formato estándar CSV: {standardized_csv_path}")
-        
+        logging.info(f"✅ Matriz limpia guardada en formato estándar CSV ({n_genes} genes x {len(keep_positions) - 1} muestras): {standardized_csv_path}")
+
         if os.path.exists(compressed_path): os.remove(compressed_path)
-        if os.path.exists(uncompressed_path): os.remove(uncompressed_path)
-            
+
         return standardized_csv_path
     except Exception as e:
         logging.error(f"❌ Error procesando la matriz: {e}"); return None
@@ -212,22 +283,96 @@ def download_and_prepare_matrix(matrix_url, output_dir):
 
               
 
-def build_star_index(fasta_file, gtf_file, index_dir, star_container, threads, sjdb_overhang):
-    """Construye el índice del genoma para STAR, omitiendo si ya existe."""
+def build_star_index(fasta_file, gtf_file, index_dir, star_container, threads, sjdb_overhang, sjdb_file=None):
+    """Construye el índice del genoma para STAR, omitiendo si ya existe. 'sjdb_file' añade uniones extra (2ª pasada)."""
     container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
     if os.path.exists(os.path.join(index_dir, "SA")):
         logging.info(f"⏩ Índice STAR ya existe en {index_dir}. Saltando."); return
     
     cmd = [container_cmd, "exec", star_container, "STAR", "--runThreadN", str(threads), "--runMode", "genomeGenerate", "--genomeDir", index_dir, "--genomeFastaFiles", fasta_file, "--sjdbGTFfile", gtf_file, "--sjdbOverhang", str(sjdb_overhang)]
+    if sjdb_file:
+        cmd.extend(["--sjdbFileChrStartEnd", sjdb_file])
     logging.info(f"🛠️  Construyendo índice STAR en {index_dir} ...")
     try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        run_tool(cmd, stage="star_index")
         logging.info(f"✅ Índice STAR generado.")
     except subprocess.CalledProcessError as e:
         logging.error(f"❌ Error al construir el índice STAR: {e.stderr}"); exit(1)
 
 
-def build_hisat2_index(fasta_file, gtf_file, index_prefix, hisat2_container):
+def build_star_index_cached(fasta_file, gtf_file, link_dir, star_container, threads, sjdb_overhang, cache_config):
+    """Obtiene el índice STAR de la caché global (o lo construye una vez) y lo enlaza en 'link_dir'."""
+    key_material = {
+        'aligner': "STAR",
+        'version': get_tool_version(star_container, ["STAR", "--version"]),
+        'fasta': file_sha256(fasta_file),
+        'gtf': file_sha256(gtf_file),
+        'sjdbOverhang': sjdb_overhang
+    }
+    build_func = lambda target_dir: build_star_index(fasta_file, gtf_file, target_dir, star_container, threads, sjdb_overhang)
+    return obtain_cached_index(cache_config, "STAR", key_material, build_func, link_dir)
+
+
+def build_hisat2_index_cached(fasta_file, gtf_file, index_prefix, hisat2_container, cache_config, threads=1):
+    """Obtiene el índice HISAT2 de la caché global (o lo construye una vez); 'index_prefix' cuelga del symlink."""
+    key_material = {
+        'aligner': "HISAT2",
+        'version': get_tool_version(hisat2_container, ["hisat2", "--version"]),
+        'fasta': file_sha256(fasta_file),
+        'gtf': file_sha256(gtf_file)
+    }
+    prefix_name = os.path.basename(index_prefix)
+    build_func = lambda target_dir: build_hisat2_index(fasta_file, gtf_file, os.path.join(target_dir, prefix_name), hisat2_container, threads)
+    return obtain_cached_index(cache_config, "HISAT2", key_material, build_func, os.path.dirname(index_prefix))
+
+
+def merge_splice_junctions(sj_files, output_file, min_unique_reads=3, min_samples=1, keep_noncanonical=False):
+    """
+    Une los SJ.out.tab de la primera pasada de todas las muestras en una única base de uniones
+    de cohorte. Descarta uniones ya anotadas en el GTF, mitocondriales y, por defecto, no canónicas,
+    y exige un mínimo de lecturas únicas (sumadas en la cohorte) y de muestras que las soporten.
+    """
+    junction_reads = defaultdict(int)
+    junction_samples = defaultdict(int)
+    for sj_file in sj_files:
+        with open(sj_file, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 7: continue
+                chrom, start, end, strand, motif, annotated, unique_reads = fields[:7]
+                if annotated == '1' or chrom in ('chrM', 'MT', 'M'): continue
+                if motif == '0' and not keep_noncanonical: continue
+                key = (chrom, int(start), int(end), {'1': '+', '2': '-'}.get(strand, '.'))
+                junction_reads[key] += int(unique_reads)
+                junction_samples[key] += 1
+
+    kept = sorted(k for k in junction_reads if junction_reads[k] >= min_unique_reads and junction_samples[k] >= min_samples)
+    with open(output_file, 'w') as f:
+        for chrom, start, end, strand in kept:
+            f.write(f"{chrom}\t{start}\t{end}\t{strand}\n")
+    logging.info(f"🧩 Base de uniones de cohorte: {len(kept)} de {len(junction_reads)} uniones nuevas retenidas ({len(sj_files)} muestras) -> {output_file}")
+    return len(kept)
+
+
+def manage_star_shared_genome(index_dir, star_container, action, log_prefix):
+    """
+    Carga ('LoadAndExit') o libera ('Remove') el índice STAR en memoria compartida del nodo,
+    para que todas las muestras concurrentes se adjunten a una única copia con 'LoadAndKeep'.
+    """
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    cmd = [container_cmd, "exec", star_container, "STAR", "--genomeDir", index_dir, "--genomeLoad", action, "--outFileNamePrefix", log_prefix]
+    action_label = "Cargando" if action == "LoadAndExit" else "Liberando"
+    logging.info(f"🧠 {action_label} índice STAR en memoria compartida ({index_dir})...")
+    try:
+        run_tool(cmd, stage=f"star_genome_{action.lower()}")
+        logging.info(f"✅ Operación '{action}' de memoria compartida completada.")
+        return True
+    except subprocess.CalledProcessError as e:
+        logging.error(f"❌ Error en STAR --genomeLoad {action}: {e.stderr}")
+        return False
+
+
+def build_hisat2_index(fasta_file, gtf_file, index_prefix, hisat2_container, threads=1):
     """Construye el índice del genoma para HISAT2 de forma robusta."""
     container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
     index_dir = os.path.dirname(index_prefix)
@@ -237,24 +382,16 @@ def build_hisat2_index(fasta_file, gtf_file, index_prefix, hisat2_container):
     
     logging.info(f"🛠️  Construyendo índice HISAT2 en {index_dir} ...")
     ss_file, exon_file = f"{index_prefix}.ss", f"{index_prefix}.exon"
-    
-    cmd_ss = [container_cmd, "exec", hisat2_container, "hisat2_extract_splice_sites.py", gtf_file]
-    cmd_exon = [container_cmd, "exec", hisat2_container, "hisat2_extract_exons.py", gtf_file]
-    build_cmd = [container_cmd, "exec", hisat2_container, "hisat2-build", "--ss", ss_file, "--exon", exon_file, fasta_file, index_prefix]
+    build_cmd = [container_cmd, "exec", hisat2_container, "hisat2-build", "-p", str(threads), "--ss", ss_file, "--exon", exon_file, fasta_file, index_prefix]
 
     try:
-        logging.info("    -> 1. Extrayendo splice sites del GTF...")
-        result_ss = subprocess.run(cmd_ss, check=True, capture_output=True, text=True)
-        with open(ss_file, 'w') as f:
-            f.write(result_ss.stdout)
-        
-        logging.info("    -> 2. Extrayendo exones del GTF...")
-        result_exon = subprocess.run(cmd_exon, check=True, capture_output=True, text=True)
-        with open(exon_file, 'w') as f:
-            f.write(result_exon.stdout)
+        # Mismo resultado que hisat2_extract_splice_sites.py / hisat2_extract_exons.py, desde el índice del GTF.
+        gtf_index = load_gtf_index(gtf_file)
+        logging.info(f"    -> 1. Splice sites desde el índice de anotación: {gtf_index.write_splice_sites(ss_file)}")
+        logging.info(f"    -> 2. Exones desde el índice de anotación: {gtf_index.write_exons(exon_file)}")
         
         logging.info("    -> 3. Construyendo el índice con hisat2-build...")
-        subprocess.run(build_cmd, check=True, capture_output=True, text=True)
+        run_tool(build_cmd, stage="hisat2_index")
         
         logging.info(f"✅ Índice HISAT2 generado correctamente.")
     except subprocess.CalledProcessError as e:
@@ -264,16 +401,13 @@ def build_hisat2_index(fasta_file, gtf_file, index_prefix, hisat2_container):
         exit(1)
 
 
-def generate_count_matrix(bam_dir, gtf_file, output_file, container_img, seq_type, threads, strand_specific=0):
-    """Genera la matriz de conteo con featureCounts, compatible con PE y SE y Strandedness."""
-    if os.path.exists(output_file):
-        logging.info(f"⏩ La matriz de conteo '{os.path.basename(output_file)}' ya existe. Saltando."); return
-    
+def list_final_bams(bam_dir):
+    """BAMs finales de una carpeta de alineamientos (excluye los '.tmp.bam' de ejecuciones interrumpidas)."""
+    return sorted(os.path.join(bam_dir, f) for f in os.listdir(bam_dir) if f.endswith(".bam") and not f.endswith(".tmp.bam"))
+
+
+def build_featurecounts_cmd(container_img, gtf_file, output_file, bam_files, seq_type, threads, strand_specific):
     container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
-    bam_files = sorted([os.path.join(bam_dir, f) for f in os.listdir(bam_dir) if f.endswith(".bam")])
-    if not bam_files:
-        logging.warning(f"⚠️ No se encontraron archivos BAM en {bam_dir}. No se puede generar la matriz de conteo."); return
-        
     cmd = [container_cmd, "exec", container_img, "featureCounts", 
            "-T", str(threads), 
            "-s", str(strand_specific), 
@@ -283,65 +417,494 @@ def generate_count_matrix(bam_dir, gtf_file, output_file, container_img, seq_typ
     if seq_type == "paired-end":
         cmd.append("-p")
     cmd.extend(bam_files)
+    return cmd
+
+
+def generate_count_matrix(bam_dir, gtf_file, output_file, container_img, seq_type, threads, strand_specific=0, incremental=False):
+    """Genera la matriz de conteo con featureCounts, compatible con PE y SE y Strandedness."""
+    if incremental:
+        return generate_count_matrix_incremental(bam_dir, gtf_file, output_file, container_img, seq_type, threads, strand_specific)
+    if os.path.exists(output_file):
+        logging.info(f"⏩ La matriz de conteo '{os.path.basename(output_file)}' ya existe. Saltando."); return
+    
+    bam_files = list_final_bams(bam_dir)
+    if not bam_files:
+        logging.warning(f"⚠️ No se encontraron archivos BAM en {bam_dir}. No se puede generar la matriz de conteo."); return
+        
+    cmd = build_featurecounts_cmd(container_img, gtf_file, output_file, bam_files, seq_type, threads, strand_specific)
     
     logging.info(f"📊 Generando matriz de conteo (Strandedness={strand_specific}) desde {bam_dir}...")
     try:
-        subprocess.run(cmd, check=True, text=True, capture_output=True)
+        run_tool(cmd, stage="featurecounts")
         logging.info(f"✅ Matriz de conteo generada: {output_file}")
     except subprocess.CalledProcessError as e:
         logging.error(f"❌ Error en featureCounts:\n{e.stderr}"); exit(1)
 
-def run_stringtie_quantification(bam_dir, gtf_file, output_dir, container_img, threads):
-    """Ejecuta StringTie en modo 'solo cuantificación' para cada archivo BAM."""
+
+def split_featurecounts_output(fc_output, cache_files):
+    """Reparte la salida de featureCounts (y su .summary) en un vector por BAM: {ruta_bam: archivo_caché}."""
+    counts = pd.read_csv(fc_output, sep='\t', comment='#', dtype=str)
+    summary = pd.read_csv(f"{fc_output}.summary", sep='\t', dtype=str)
+    annotation_cols = list(counts.columns[:6])
+    for bam_file, cache_file in cache_files.items():
+        counts[annotation_cols + [bam_file]].to_csv(f"{cache_file}.tmp", sep='\t', index=False)
+        summary[['Status', bam_file]].to_csv(f"{cache_file}.summary", sep='\t', index=False)
+        os.replace(f"{cache_file}.tmp", cache_file)
+
+
+def merge_cached_counts(cache_files, output_file):
+    """Une los vectores por muestra en la matriz de cohorte (formato featureCounts) y su .summary."""
+    annotation, columns, summaries = None, [], []
+    for bam_file, cache_file in cache_files.items():
+        sample_counts = pd.read_csv(cache_file, sep='\t', dtype=str)
+        if annotation is None:
+            annotation = sample_counts.iloc[:, :6]
+        elif not sample_counts['Geneid'].equals(annotation['Geneid']):
+            raise ValueError(f"El vector en caché {os.path.basename(cache_file)} no tiene los mismos genes que el resto.")
+        # La columna se renombra a la ruta actual del BAM, como la escribiría featureCounts.
+        columns.append(sample_counts.iloc[:, 6].rename(bam_file))
+        summaries.append(pd.read_csv(f"{cache_file}.summary", sep='\t', dtype=str, index_col=0).iloc[:, 0].rename(bam_file))
+
+    tmp_output = f"{output_file}.tmp"
+    with open(tmp_output, 'w') as f:
+        f.write("# Program:featureCounts (incremental); vectores por muestra en caché\n")
+        pd.concat([annotation] + columns, axis=1).to_csv(f, sep='\t', index=False)
+    pd.concat(summaries, axis=1).to_csv(f"{output_file}.summary", sep='\t')
+    os.replace(tmp_output, output_file)
+
+
+def generate_count_matrix_incremental(bam_dir, gtf_file, output_file, container_img, seq_type, threads, strand_specific=0):
+    """
+    Modo incremental de featureCounts: cada BAM tiene un vector de conteos en caché cuya clave es el
+    SHA-256 del BAM (y del GTF y parámetros de conteo). Solo se cuentan los BAMs nuevos o modificados,
+    en UNA llamada a featureCounts, y la matriz de cohorte se re-ensambla desde la caché.
+    """
+    bam_files = list_final_bams(bam_dir)
+    if not bam_files:
+        logging.warning(f"⚠️ No se encontraron archivos BAM en {bam_dir}. No se puede generar la matriz de conteo."); return
+
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(output_file)), f".{os.path.basename(output_file)}_cache")
+    create_directory(cache_dir)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        bam_hashes = dict(zip(bam_files, executor.map(file_sha256, bam_files)))
+    common_material = {'gtf': file_sha256(gtf_file), 'strand': strand_specific, 'paired': seq_type == "paired-end",
+                       'version': get_tool_version(container_img, ["featureCounts", "-v"])}
+    cache_files = {}
+    for bam_file in bam_files:
+        key = compute_cache_key({**common_material, 'bam': bam_hashes[bam_file]})
+        sample_name = re.sub(r'_Aligned\.sortedByCoord\.out\.bam$', '', os.path.basename(bam_file))
+        cache_files[bam_file] = os.path.join(cache_dir, f"{sample_name}_{key[:20]}.counts")
+
+    manifest_file = os.path.join(cache_dir, "matrix_manifest.json")
+    manifest = {bam_file: os.path.basename(cache_file) for bam_file, cache_file in cache_files.items()}
+    if os.path.exists(output_file) and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            if json.load(f) == manifest:
+                logging.info(f"⏩ La matriz de conteo '{os.path.basename(output_file)}' está al día ({len(bam_files)} muestras). Saltando."); return
+
+    to_count = [bam_file for bam_file, cache_file in cache_files.items() if not os.path.exists(cache_file)]
+    logging.info(f"📊 Conteo incremental (Strandedness={strand_specific}): {len(to_count)} BAMs nuevos o modificados, "
+                 f"{len(bam_files) - len(to_count)} reutilizados de la caché.")
+    if to_count:
+        batch_output = os.path.join(cache_dir, f"batch-{os.getpid()}.txt")
+        cmd = build_featurecounts_cmd(container_img, gtf_file, batch_output, to_count, seq_type, threads, strand_specific)
+        try:
+            run_tool(cmd, stage="featurecounts")
+        except subprocess.CalledProcessError as e:
+            logging.error(f"❌ Error en featureCounts:\n{e.stderr}"); exit(1)
+        split_featurecounts_output(batch_output, {bam_file: cache_files[bam_file] for bam_file in to_count})
+        for leftover in (batch_output, f"{batch_output}.summary"):
+            if os.path.exists(leftover): os.remove(leftover)
+
+    merge_cached_counts(cache_files, output_file)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Vectores obsoletos de muestras cuyo BAM ha cambiado (misma muestra, otra clave).
+    current_files = {os.path.basename(cache_file) for cache_file in cache_files.values()}
+    current_samples = {name.rsplit('_', 1)[0] for name in current_files}
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(".counts") and fname not in current_files and fname.rsplit('_', 1)[0] in current_samples:
+            os.remove(os.path.join(cache_dir, fname))
+            if os.path.exists(os.path.join(cache_dir, f"{fname}.summary")): os.remove(os.path.join(cache_dir, f"{fname}.summary"))
+    logging.info(f"✅ Matriz de conteo generada: {output_file}")
+
+# ------------------------------------------------------------------------------
+# Pseudoalineamiento (Salmon / kallisto) como 'counting_method'
+# ------------------------------------------------------------------------------
+PSEUDO_ALIGNERS = ("SALMON", "KALLISTO")
+PSEUDO_QUANT_FILES = {"SALMON": "quant.sf", "KALLISTO": "abundance.tsv"}
+# Columnas (transcrito, longitud, conteos estimados, TPM) de la tabla de cada herramienta.
+PSEUDO_QUANT_COLUMNS = {"SALMON": ("Name", "Length", "NumReads", "TPM"),
+                        "KALLISTO": ("target_id", "length", "est_counts", "tpm")}
+KALLISTO_INDEX_FILE = "transcriptome.idx"
+
+
+def build_transcriptome_fasta(fasta_file, gtf_file, output_fasta, gffread_container):
+    """Extrae las secuencias de transcritos (gffread -w) del genoma y el GTF si no se dio 'transcriptome_url'."""
+    if os.path.exists(output_fasta):
+        logging.info(f"⏩ Transcriptoma ya existe en {output_fasta}. Saltando."); return output_fasta
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    cmd = [container_cmd, "exec", gffread_container, "gffread", "-w", f"{output_fasta}.tmp", "-g", fasta_file, gtf_file]
+    logging.info(f"🛠️  Extrayendo transcriptoma con gffread en {output_fasta} ...")
+    try:
+        run_tool(cmd, stage="gffread")
+        os.replace(f"{output_fasta}.tmp", output_fasta)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"❌ Error al extraer el transcriptoma con gffread: {e.stderr}"); exit(1)
+    return output_fasta
+
+
+def build_pseudo_index(quantifier, transcriptome_fasta, index_dir, container_img, threads, kmer_size=31):
+    """Construye el índice de transcriptoma de Salmon o kallisto en 'index_dir', omitiendo si ya existe."""
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    if quantifier == "SALMON":
+        done_file = os.path.join(index_dir, "versionInfo.json")
+        cmd = [container_cmd, "exec", container_img, "salmon", "index", "-t", transcriptome_fasta, "-i", index_dir,
+               "-k", str(kmer_size), "-p", str(threads)]
+    else:
+        done_file = os.path.join(index_dir, KALLISTO_INDEX_FILE)
+        cmd = [container_cmd, "exec", container_img, "kallisto", "index", "-i", done_file, "-k", str(kmer_size), transcriptome_fasta]
+    if os.path.exists(done_file):
+        logging.info(f"⏩ Índice {quantifier} ya existe en {index_dir}. Saltando."); return
+    create_directory(index_dir)
+    logging.info(f"🛠️  Construyendo índice {quantifier} en {index_dir} ...")
+    try:
+        run_tool(cmd, stage=f"{quantifier.lower()}_index")
+        logging.info(f"✅ Índice {quantifier} generado.")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"❌ Error al construir el índice {quantifier}: {e.stderr}"); exit(1)
+
+
+def prepare_pseudo_index(quantifier, fasta_file, gtf_file, transcriptome_url, index_dir, images, threads, quant_config,
+                         download_config=None, cache_config=None):
+    """Obtiene el transcriptoma (descarga o gffread) y construye su índice una sola vez (con caché global opcional)."""
+    transcriptome_dir = os.path.join(os.path.dirname(index_dir), "TRANSCRIPTOME")
+    create_directory(transcriptome_dir)
+    if transcriptome_url:
+        # Salmon y kallisto leen el FASTA comprimido directamente: no se descomprime.
+        transcriptome_fasta = os.path.join(transcriptome_dir, os.path.basename(transcriptome_url))
+        logging.info(f"⬇️ Descargando/verificando transcriptoma {os.path.basename(transcriptome_url)}...")
+        download_file(transcriptome_url, transcriptome_fasta, download_config=download_config)
+    else:
+        transcriptome_fasta = build_transcriptome_fasta(fasta_file, gtf_file, os.path.join(transcriptome_dir, "transcripts.fa"), images.get("gffread"))
+
+    container_img = images.get(quantifier.lower())
+    kmer_size = quant_config.get("kmer_size", 31)
+    if not cache_config:
+        return build_pseudo_index(quantifier, transcriptome_fasta, index_dir, container_img, threads, kmer_size)
+    key_material = {
+        'aligner': quantifier,
+        'version': get_tool_version(container_img, ["salmon", "--version"] if quantifier == "SALMON" else ["kallisto", "version"]),
+        'transcriptome': file_sha256(transcriptome_fasta),
+        'kmer_size': kmer_size
+    }
+    build_func = lambda target_dir: build_pseudo_index(quantifier, transcriptome_fasta, target_dir, container_img, threads, kmer_size)
+    return obtain_cached_index(cache_config, quantifier, key_material, build_func, index_dir)
+
+
+def pseudo_quantify_sample(quantifier, sample_id, r1_trimmed, r2_trimmed, seq_type, quant_dir, index_dir, container_img, threads, quant_config):
+    """Cuantifica una muestra recortada con Salmon o kallisto en '<quant_dir>/<muestra>/' (vía directorio .tmp)."""
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    sample_out_dir = os.path.join(quant_dir, sample_id)
+    tmp_out_dir = f"{sample_out_dir}.tmp"
+    shutil.rmtree(tmp_out_dir, ignore_errors=True)
+
+    if quantifier == "SALMON":
+        cmd = [container_cmd, "exec", container_img, "salmon", "quant", "-i", index_dir,
+               "-l", quant_config.get("lib_type", "A"), "-p", str(threads), "-o", tmp_out_dir]
+        cmd.extend(["-1", r1_trimmed, "-2", r2_trimmed] if seq_type == "paired-end" else ["-r", r1_trimmed])
+    else:
+        cmd = [container_cmd, "exec", container_img, "kallisto", "quant", "-i", os.path.join(index_dir, KALLISTO_INDEX_FILE),
+               "-o", tmp_out_dir, "-t", str(threads)]
+        if seq_type == "paired-end":
+            cmd.extend([r1_trimmed, r2_trimmed])
+        else:
+            # En single-end kallisto necesita la distribución de longitudes de fragmento.
+            cmd.extend(["--single", "-l", str(quant_config.get("fragment_length", 200)), "-s", str(quant_config.get("fragment_sd", 20)), r1_trimmed])
+    if quant_config.get("extra_args"):
+        cmd[5:5] = quant_config["extra_args"].split()
+
+    result = run_tool(cmd, stage=f"{quantifier.lower()}_quant", sample=sample_id)
+    with open(os.path.join(tmp_out_dir, f"{quantifier.lower()}_quant.log"), 'w') as f:
+        f.write(result.stderr)
+    shutil.rmtree(sample_out_dir, ignore_errors=True)
+    os.rename(tmp_out_dir, sample_out_dir)
+
+
+def load_transcript_gene_map(gtf_file):
+    """Relación transcrito -> gen del GTF y coordenadas de cada gen (cromosoma, inicio, fin, hebra), desde el índice cacheado."""
+    gtf_index = load_gtf_index(gtf_file)
+    return gtf_index.transcript_gene_map(), gtf_index.gene_coordinates()
+
+
+def read_pseudo_quant_by_gene(quant_file, quantifier, tx2gene):
+    """Lee la tabla de una muestra y agrega transcrito -> gen: (conteos, TPM, longitud máxima, nº transcritos sin gen)."""
+    name_col, length_col, counts_col, tpm_col = PSEUDO_QUANT_COLUMNS[quantifier]
+    df = pd.read_csv(quant_file, sep='\t', usecols=[name_col, length_col, counts_col, tpm_col], dtype={name_col: str})
+    # GENCODE usa cabeceras 'ENST...|ENSG...|...'; Ensembl añade la versión (.N) que el GTF guarda aparte.
+    names = df[name_col].str.split('|', n=1).str[0]
+    genes = names.map(tx2gene)
+    unversioned = genes.isna()
+    genes[unversioned] = names[unversioned].str.replace(r'\.\d+$', '', regex=True).map(tx2gene)
+    df['gene_id'] = genes
+    unmapped = int(df['gene_id'].isna().sum())
+    grouped = df.dropna(subset=['gene_id']).groupby('gene_id')
+    return grouped[counts_col].sum(), grouped[tpm_col].sum(), grouped[length_col].max(), unmapped
+
+
+def aggregate_pseudo_quantification(quant_dir, quantifier, gtf_file, counts_file, tpm_matrix_file, max_workers=4):
+    """
+    Agrega las cuantificaciones de Salmon/kallisto a nivel de gen y escribe:
+      - 'counts_file' con el formato de featureCounts (Geneid, Chr, Start, End, Strand, Length, muestras...)
+        y conteos estimados redondeados, para que DESeq2 lo consuma sin cambios.
+      - 'tpm_matrix_file' con el formato de las matrices de StringTie (gene_id x muestras) para el EDA.
+    """
+    quant_filename = PSEUDO_QUANT_FILES[quantifier]
+    sample_files = {d: os.path.join(quant_dir, d, quant_filename) for d in sorted(os.listdir(quant_dir))
+                    if os.path.exists(os.path.join(quant_dir, d, quant_filename))}
+    if not sample_files:
+        logging.error(f"❌ No se encontraron cuantificaciones de {quantifier} en {quant_dir}."); return None
+
+    logging.info(f"📊 Agregando {len(sample_files)} cuantificaciones de {quantifier} a nivel de gen...")
+    tx2gene, gene_coords = load_transcript_gene_map(gtf_file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {name: executor.submit(read_pseudo_quant_by_gene, path, quantifier, tx2gene) for name, path in sample_files.items()}
+        per_sample = {name: future.result() for name, future in futures.items()}
+
+    unmapped = max(result[3] for result in per_sample.values())
+    if unmapped:
+        logging.warning(f"⚠️ {unmapped} transcritos sin gen en el GTF (¿versiones distintas de transcriptoma y anotación?). Se descartan.")
+
+    counts = pd.concat({name: result[0] for name, result in per_sample.items()}, axis=1).fillna(0).round().astype(int)
+    tpm = pd.concat({name: result[1] for name, result in per_sample.items()}, axis=1).fillna(0).astype(float)
+    lengths = pd.concat([result[2] for result in per_sample.values()], axis=1).max(axis=1)
+
+    annotation = pd.DataFrame([gene_coords.get(gene, ("NA", 0, 0, ".")) for gene in counts.index],
+                              index=counts.index, columns=['Chr', 'Start', 'End', 'Strand'])
+    annotation['Length'] = lengths.reindex(counts.index).fillna(0).astype(int)
+    fc_table = pd.concat([annotation, counts], axis=1)
+    fc_table.index.name = 'Geneid'
+    with open(counts_file, 'w') as f:
+        f.write(f"# Program:{quantifier.lower()}; conteos estimados agregados a gen por OmniRNA-seq (formato featureCounts)\n")
+        fc_table.to_csv(f, sep='\t')
+    logging.info(f"✅ Matriz de conteo ({quantifier}) generada: {counts_file}")
+
+    tpm.index.name = 'gene_id'
+    tpm.to_csv(tpm_matrix_file, sep='\t')
+    logging.info(f"✅ Matriz de TPM ({quantifier}) guardada en: {tpm_matrix_file}")
+    return counts_file
+
+
+
+def stringtie_quantify_sample(apptainer_cmd, container_img, bam_path, gtf_file, sample_out_dir, sample_name, threads):
+    """StringTie '-e' para una muestra. Escribe en .tmp y renombra: solo un resultado completo cuenta para reanudar."""
+    abund_file = os.path.join(sample_out_dir, "gene_abundances.tsv")
+    if os.path.exists(abund_file):
+        return ('SALTADO', sample_name, None)
+    create_directory(sample_out_dir)
+    tmp_abund_file = f"{abund_file}.tmp"
+    cmd = [apptainer_cmd, "exec", container_img, "stringtie", bam_path, "-G", gtf_file, "-p", str(threads), "-e", "-A", tmp_abund_file, "-o", os.path.join(sample_out_dir, f"{sample_name}.gtf")]
+    logging.info(f"  -> Procesando {sample_name} ({threads} hilos)...")
+    try:
+        run_tool(cmd, stage="stringtie", sample=sample_name)
+    except subprocess.CalledProcessError as e:
+        return ('ERROR', sample_name, (e.stderr or "").strip())
+    os.replace(tmp_abund_file, abund_file)
+    logging.info(f"✅ Cuantificación completada para {sample_name}")
+    return ('OK', sample_name, None)
+
+
+def run_stringtie_quantification(bam_dir, gtf_file, output_dir, container_img, threads, threads_per_sample=None):
+    """
+    Ejecuta StringTie en modo 'solo cuantificación' para cada archivo BAM, varias muestras a la vez.
+    StringTie -e escala mal más allá de pocos hilos, así que los 'threads' del nodo se reparten en
+    (threads // threads_per_sample) muestras concurrentes. Devuelve la lista de muestras fallidas.
+    """
     create_directory(output_dir)
     apptainer_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
-    bam_files = [f for f in os.listdir(bam_dir) if f.endswith(".bam")]
-    logging.info(f"🧬 Iniciando cuantificación (TPM/FPKM) con StringTie para {len(bam_files)} muestras...")
+    bam_files = [os.path.basename(f) for f in list_final_bams(bam_dir)]
+    threads_per_sample = max(1, min(threads, threads_per_sample or 4))
+    concurrent_samples = max(1, threads // threads_per_sample)
+    logging.info(f"🧬 Iniciando cuantificación (TPM/FPKM) con StringTie para {len(bam_files)} muestras "
+                 f"({concurrent_samples} en paralelo x {threads_per_sample} hilos)...")
+
+    jobs = []
     for bam_file in bam_files:
         sample_name = re.sub(r'_Aligned\.sortedByCoord\.out\.bam$', '', bam_file)
-        bam_path = os.path.join(bam_dir, bam_file)
-        sample_out_dir = os.path.join(output_dir, sample_name)
-        abund_file = os.path.join(sample_out_dir, "gene_abundances.tsv")
-        if os.path.exists(abund_file):
-            logging.info(f"⏩ Cuantificación de StringTie para {sample_name} ya existe. Saltando.")
+        jobs.append((os.path.join(bam_dir, bam_file), os.path.join(output_dir, sample_name), sample_name))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_samples) as executor:
+        results = list(executor.map(lambda job: stringtie_quantify_sample(apptainer_cmd, container_img, job[0], gtf_file, job[1], job[2], threads_per_sample), jobs))
+
+    skipped = [name for status, name, _ in results if status == 'SALTADO']
+    failed = [(name, stderr) for status, name, stderr in results if status == 'ERROR']
+    if skipped:
+        logging.info(f"⏩ Cuantificación de StringTie ya existente para {len(skipped)} muestras. Saltadas.")
+    if failed:
+        logging.error(f"❌ StringTie falló en {len(failed)}/{len(jobs)} muestras:")
+        for name, stderr in failed:
+            logging.error(f"   - {name}:\n{stderr}")
+    return [name for name, _ in failed]
+
+
+STRINGTIE_METRIC_COLUMNS = {'tpm': 'TPM', 'fpkm': 'FPKM', 'coverage': 'Coverage'}
+
+
+def read_stringtie_abundances(abund_file):
+    """Lee UNA vez un gene_abundances.tsv y devuelve (gene_ids, {columna: valores}) para TPM, FPKM y Coverage."""
+    metric_cols = list(STRINGTIE_METRIC_COLUMNS.values())
+    df_sample = pd.read_csv(abund_file, sep='\t', usecols=['Gene ID'] + metric_cols,
+                            dtype={'Gene ID': str, **{c: np.float64 for c in metric_cols}})
+    return df_sample['Gene ID'].to_numpy(dtype=object), {c: df_sample[c].to_numpy() for c in metric_cols}
+
+
+def save_matrix_npz(npz_file, gene_ids, sample_names, values):
+    """Formato binario compacto de una matriz (genes x muestras) junto a la TSV."""
+    np.savez_compressed(npz_file, gene_id=np.asarray(gene_ids, dtype=str), sample=np.asarray(sample_names, dtype=str), values=values)
+
+
+def columnar_enabled(binary_format):
+    """True si se pidió Parquet/Feather y pyarrow está disponible (si no, se avisa y se sigue solo con texto)."""
+    if binary_format not in COLUMNAR_EXTENSIONS:
+        return False
+    if pa is None:
+        logging.warning(f"⚠️ 'pyarrow' no está instalado: se omite la copia {binary_format} y se mantiene solo el formato de texto.")
+        return False
+    return True
+
+
+def matrix_to_arrow(matrix, schema=None, dictionary_ids=True):
+    """
+    Matriz (genes x muestras, índice = gene_id) -> tabla Arrow: gene_id como columna diccionario,
+    conteos como int64 y valores normalizados como float64. Con 'schema' se fuerza el de un bloque previo.
+    """
+    gene_ids = pa.array(matrix.index.astype(str))
+    columns = [gene_ids.dictionary_encode() if dictionary_ids else gene_ids]
+    for col in matrix.columns:
+        values = matrix[col].to_numpy()
+        columns.append(pa.array(values.astype(np.int64) if values.dtype.kind in 'iu' else values.astype(np.float64)))
+    table = pa.Table.from_arrays(columns, names=['gene_id'] + [str(c) for c in matrix.columns])
+    return table.cast(schema) if schema is not None else table
+
+
+def open_columnar_writer(path, schema, binary_format):
+    """Escritor incremental: row groups en Parquet, record batches en Feather (Arrow IPC, sin comprimir para mmap)."""
+    if binary_format == "parquet":
+        return pq.ParquetWriter(path, schema, compression="zstd")
+    return pa.ipc.new_file(path, schema)
+
+
+def save_matrix_columnar(matrix, output_file, binary_format):
+    """Escribe una matriz completa en Parquet (zstd) o Feather (sin comprimir, apto para memory-map)."""
+    table = matrix_to_arrow(matrix)
+    if binary_format == "parquet":
+        pq.write_table(table, f"{output_file}.tmp", compression="zstd")
+    else:
+        feather.write_feather(table, f"{output_file}.tmp", compression="uncompressed")
+    os.replace(f"{output_file}.tmp", output_file)
+
+
+def export_matrix_columnar(text_file, binary_format, featurecounts_format=False):
+    """Copia columnar de una matriz de texto ya generada (salta si la copia es más reciente que el texto)."""
+    if not columnar_enabled(binary_format) or not os.path.exists(text_file):
+        return None
+    output_file = columnar_path(text_file, binary_format)
+    if os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(text_file):
+        return output_file
+    if featurecounts_format:
+        # Formato featureCounts: Geneid + 5 columnas de anotación + una columna de conteos por BAM.
+        matrix = pd.read_csv(text_file, sep='\t', comment='#', index_col=0)
+        matrix = matrix.drop(columns=[c for c in ['Chr', 'Start', 'End', 'Strand', 'Length'] if c in matrix.columns])
+    else:
+        matrix = pd.read_csv(text_file, sep='\t', index_col=0)
+    save_matrix_columnar(matrix, output_file, binary_format)
+    logging.info(f"    -> Copia columnar ({binary_format}): {output_file}")
+    return output_file
+
+
+def export_matrix_stores(matrix_files, quant_options):
+    """Almacén indexado (<matriz>.mstore) para consultas rápidas de genes/muestras, si 'matrix_store' está activo."""
+    if not quant_options.get("matrix_store", False):
+        return
+    for matrix_file in matrix_files:
+        if not os.path.exists(matrix_file):
             continue
-        create_directory(sample_out_dir)
-        cmd = [apptainer_cmd, "exec", container_img, "stringtie", bam_path, "-G", gtf_file, "-p", str(threads), "-e", "-A", abund_file, "-o", os.path.join(sample_out_dir, f"{sample_name}.gtf")]
-        logging.info(f"  -> Procesando {sample_name}...")
         try:
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-            logging.info(f"✅ Cuantificación completada para {sample_name}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"❌ Error en StringTie para {sample_name}:\n{e.stderr}")
+            store_dir = build_matrix_store(matrix_file, memory_mb=quant_options.get("matrix_store_memory_mb", 256))
+            logging.info(f"    -> Almacén de matriz: {store_dir}")
+        except (ValueError, OSError) as e:
+            logging.warning(f"⚠️ No se pudo crear el almacén de {matrix_file}: {e}")
+
 
-def assemble_normalized_matrices(stringtie_dir, output_prefix, methods_to_assemble):
-    """Ensambla los archivos de abundancia de StringTie en matrices FPKM y/o TPM."""
+def assemble_normalized_matrices(stringtie_dir, output_prefix, methods_to_assemble, max_workers=4, binary_format=None):
+    """
+    Ensambla los archivos de abundancia de StringTie en matrices FPKM, TPM y/o Coverage.
+    Cada archivo se lee una sola vez (en paralelo entre muestras) y todas las matrices se
+    construyen con NumPy sobre un índice de genes común; los genes repetidos se suman.
+    """
     logging.info(f"📊 Ensamblando matrices finales para: {', '.join(m.upper() for m in methods_to_assemble)}...")
-    sample_dirs = sorted([d for d in os.listdir(stringtie_dir) if os.path.isdir(os.path.join(stringtie_dir, d))])
+    methods = []
     for method in methods_to_assemble:
-        metric_col_name = 'TPM' if method.lower() == 'tpm' else 'FPKM'
-        list_of_series = []
-        for sample_name in sample_dirs:
-            abund_file = os.path.join(stringtie_dir, sample_name, "gene_abundances.tsv")
-            if not os.path.exists(abund_file):
-                logging.warning(f"⚠️ No se encontró el archivo de abundancias para {sample_name}. Se omitirá.")
-                continue
+        if method.lower() in STRINGTIE_METRIC_COLUMNS:
+            methods.append(method)
+        else:
+            logging.warning(f"⚠️ Métrica '{method}' no disponible en StringTie (tpm, fpkm, coverage). Se omitirá.")
+    if not methods:
+        return
+
+    sample_dirs = sorted([d for d in os.listdir(stringtie_dir) if os.path.isdir(os.path.join(stringtie_dir, d))])
+    abund_files = {}
+    for sample_name in sample_dirs:
+        abund_file = os.path.join(stringtie_dir, sample_name, "gene_abundances.tsv")
+        if not os.path.exists(abund_file):
+            logging.warning(f"⚠️ No se encontró el archivo de abundancias para {sample_name}. Se omitirá.")
+            continue
+        abund_files[sample_name] = abund_file
+
+    samples_data = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(read_stringtie_abundances, f): name for name, f in abund_files.items()}
+        for future in concurrent.futures.as_completed(futures):
+            sample_name = futures[future]
             try:
-                df_sample = pd.read_csv(abund_file, sep='\t', usecols=['Gene ID', metric_col_name])
-                df_sample = df_sample.groupby('Gene ID')[metric_col_name].sum().reset_index()
-                sample_series = df_sample.set_index('Gene ID')[metric_col_name]
-                sample_series.name = sample_name
-                list_of_series.append(sample_series)
+                samples_data[sample_name] = future.result()
             except Exception as e:
                 logging.warning(f"⚠️ No se pudo procesar el archivo para {sample_name}: {e}")
-        if not list_of_series:
+
+    sample_names = [name for name in sample_dirs if name in samples_data]
+    if not sample_names:
+        for method in methods:
             logging.error(f"❌ No se pudo generar la matriz de {method.upper()}.")
-            continue
-        final_matrix = pd.concat(list_of_series, axis=1, join='outer').fillna(0)
-        final_matrix.index.name = 'gene_id'
+        return
+
+    # Índice de genes común (factorize por hash, luego ordenado) y posición de cada fila de cada muestra en él.
+    codes, gene_ids = pd.factorize(np.concatenate([samples_data[name][0] for name in sample_names]))
+    order = np.argsort(gene_ids)
+    gene_ids = gene_ids[order]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    sample_positions = np.split(rank[codes], np.cumsum([len(samples_data[name][0]) for name in sample_names])[:-1])
+
+    matrices = {m: np.zeros((len(gene_ids), len(sample_names)), dtype=np.float64) for m in methods}
+    for j, sample_name in enumerate(sample_names):
+        metric_values = samples_data[sample_name][1]
+        positions = sample_positions[j]
+        for method in methods:
+            values = np.nan_to_num(metric_values[STRINGTIE_METRIC_COLUMNS[method.lower()]])
+            matrices[method][:, j] = np.bincount(positions, weights=values, minlength=len(gene_ids))
+
+    for method in methods:
+        final_matrix = pd.DataFrame(matrices[method], index=pd.Index(gene_ids, name='gene_id'), columns=sample_names)
         output_file = f"{output_prefix}_{method}_matrix.tsv"
         final_matrix.to_csv(output_file, sep='\t')
         logging.info(f"✅ Matriz de {method.upper()} guardada en: {output_file}")
+        if binary_format == "npz":
+            save_matrix_npz(f"{output_prefix}_{method}_matrix.npz", gene_ids, sample_names, matrices[method])
+            logging.info(f"    -> Copia binaria (NumPy .npz): {output_prefix}_{method}_matrix.npz")
+        elif columnar_enabled(binary_format):
+            save_matrix_columnar(final_matrix, columnar_path(output_file, binary_format), binary_format)
+            logging.info(f"    -> Copia columnar ({binary_format}): {columnar_path(output_file, binary_format)}")
 
 def run_exploratory_analysis(config, matrix_path, output_dir):
     """Ejecuta el script de R para análisis exploratorio usando la estrategia --bind."""
@@ -358,12 +921,12 @@ def run_exploratory_analysis(config, matrix_path, output_dir):
     cmd = [apptainer_cmd, "exec", "--bind", f"{host_bind_dir}:{container_workspace}", "--pwd", container_workspace, r_container_host, "Rscript", r_script_container, "--matrix_file", matrix_container, "--metadata_file", metadata_container, "--output_dir", output_dir_container, "--grouping_variable", deseq2_config.get("grouping_variable"), "--matrix_type", matrix_type, "--organism_db", annotation_config.get("organism_db"), "--key_type", annotation_config.get("key_type")]
     logging.info(f"  -> Comando a ejecutar: {' '.join(cmd)}")
     try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        run_tool(cmd, stage="r_exploratory")
         logging.info(f"✅ Análisis Exploratorio completado. Gráficos en: {output_dir}")
     except subprocess.CalledProcessError as e:
         logging.error(f"❌ Error CRÍTICO en el script de R (Análisis Exploratorio).\n--- STDOUT de R ---\n{e.stdout}\n--- STDERR de R ---\n{e.stderr}")
 
-def run_deseq2(config, output_dir, counts_file_path, gtf_file, alignments_dir=None):
+def run_deseq2(config, output_dir, counts_file_path, gtf_file, alignments_dir=None, counting_method=None):
     """
     Prepara un metadata corregido y ejecuta DESeq2 usando la estrategia --bind.
     """
@@ -405,7 +968,7 @@ def run_deseq2(config, output_dir, counts_file_path, gtf_file, alignments_dir=No
     cmd = [
         apptainer_cmd, "exec", "--bind", f"{host_bind_dir}:{container_workspace}", "--pwd", container_workspace,
         r_container_host, "Rscript", r_script_container,
-        "--counting_method", setup_params.get("counting_method"),
+        "--counting_method", counting_method or setup_params.get("counting_method"),
         "--counts_file", counts_file_container,
         "--metadata_file", metadata_container,
         "--output_dir", output_dir_container,
@@ -428,7 +991,7 @@ def run_deseq2(config, output_dir, counts_file_path, gtf_file, alignments_dir=No
     
     logging.info(f"  -> Comando a ejecutar: {' '.join(cmd)}")
     try:
-        process = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        process = run_tool(cmd, stage="r_deseq2")
         logging.info("✅ Análisis DESeq2 completado exitosamente.")
         logging.debug(f"--- STDOUT de R ---\n{process.stdout}\n--- FIN STDOUT ---")
     except subprocess.CalledProcessError as e:
@@ -529,7 +1092,7 @@ def run_enrichment_visualization(config, deseq2_results_dir):
     logging.info(f"  -> Comando a ejecutar: {' '.join(final_cmd)}")
     
     try:
-        process = subprocess.run(final_cmd, check=True, capture_output=True, text=True)
+        process = run_tool(final_cmd, stage="r_enrichment_viz")
         logging.info(f"✅ Gráficos de enriquecimiento generados exitosamente en: {deseq2_results_dir}")
         logging.debug(f"--- STDOUT de R ---\n{process.stdout}\n--- FIN STDOUT ---")
     except subprocess.CalledProcessError as e:
@@ -595,7 +1158,7 @@ def run_pdf_report_generator(config, deseq2_results_dir):
     logging.info(f"  -> Comando a ejecutar: {' '.join(final_cmd)}")
 
     try:
-        process = subprocess.run(final_cmd, check=True, capture_output=True, text=True)
+        process = run_tool(final_cmd, stage="r_pdf_report")
         logging.info(f"✅ Informes PDF 'tochos' generados exitosamente en: {deseq2_results_dir}")
         logging.debug(f"--- STDOUT de R (Informes PDF) ---\n{process.stdout}\n--- FIN STDOUT ---")
     except subprocess.CalledProcessError as e:
@@ -617,7 +1180,7 @@ def run_multiqc(dirs_to_scan, output_dir, container_img):
         return
     cmd = [container_cmd, "exec", container_img, "multiqc"] + existing_dirs + ["-o", output_dir, "--force"]
     try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        run_tool(cmd, stage="multiqc")
         logging.info(f"✅ Informe de MultiQC generado en: {output_dir}")
     except subprocess.CalledProcessError as e:
         logging.error(f"❌ Error en MultiQC: {e.stderr}")
@@ -727,243 +1290,333 @@ def compare_and_analyze_workflows(config):
 
 
 
-def pipeline_worker_for_sample(sample_info, config, paths):
+def get_sample_file_paths(sample_info, config, paths):
+    """Calcula las rutas de los FASTQ crudos (planos y .gz) y recortados de una muestra."""
+    sample_id = sample_info['id']
+    seq_type = config.get("project_setup", {}).get("sequencing_type", "paired-end").lower()
+    r2_url = sample_info.get('r2_url', None)
+
+    r1_raw_gz = os.path.join(
+        paths['fastq_dir'],
+        f"{sample_id}_1.fastq.gz" if seq_type == "paired-end" else f"{sample_id}.fastq.gz"
+    )
+    r2_raw_gz = os.path.join(paths['fastq_dir'], f"{sample_id}_2.fastq.gz") if r2_url else None
+
+    r1_raw = r1_raw_gz.replace(".gz", "")
+    r2_raw = r2_raw_gz.replace(".gz", "") if r2_raw_gz else None
+
+    r1_trimmed = os.path.join(
+        paths['trimmed_dir'],
+        f"{sample_id}_1.trimmed.fastq.gz" if seq_type == "paired-end" else f"{sample_id}.trimmed.fastq.gz"
+    )
+    r2_trimmed = os.path.join(paths['trimmed_dir'], f"{sample_id}_2.trimmed.fastq.gz") \
+        if seq_type == "paired-end" else None
+
+    return {
+        'r1_raw_gz': r1_raw_gz, 'r2_raw_gz': r2_raw_gz,
+        'r1_raw': r1_raw, 'r2_raw': r2_raw,
+        'r1_trimmed': r1_trimmed, 'r2_trimmed': r2_trimmed,
+        # Crudos planos o .gz del modo streaming (y sus marcas de MD5): la limpieza debe reconocer todos.
+        'raw_fastq_files': [f for f in (r1_raw, r2_raw, r1_raw_gz, r2_raw_gz) if f] +
+                           [f"{f}.md5" for f in (r1_raw_gz, r2_raw_gz) if f]
+    }
+
+
+def cleanup_sample_files(sample_id, files, paths, purge_intermediates):
+    """Borra los FASTQ crudos y, en modo ahorro máximo, también trimmed, SAM y temporales de STAR."""
+    for raw_file in files['raw_fastq_files']:
+        if os.path.exists(raw_file): os.remove(raw_file)
+
+    if not purge_intermediates:
+        return
+
+    if os.path.exists(files['r1_trimmed']): os.remove(files['r1_trimmed'])
+    if files['r2_trimmed'] and os.path.exists(files['r2_trimmed']): os.remove(files['r2_trimmed'])
+
+    if 'alignments_dir_HISAT2' in paths:
+        sam_file = os.path.join(paths['alignments_dir_HISAT2'], f"{sample_id}.sam")
+        if os.path.exists(sam_file): os.remove(sam_file)
+
+    if 'alignments_dir_STAR' in paths:
+        star_out_prefix = os.path.join(paths['alignments_dir_STAR'], f"{sample_id}_")
+        star_tmp_dir = f"{star_out_prefix}STARtmp"
+        # Limpieza de carpetas temporales
+        if os.path.exists(star_tmp_dir): shutil.rmtree(star_tmp_dir, ignore_errors=True)
+        if os.path.exists(star_tmp_dir.replace("STARtmp", "_STARtmp")): shutil.rmtree(star_tmp_dir.replace("STARtmp", "_STARtmp"), ignore_errors=True)
+
+
+def sample_final_output(paths, aligner, sample_id):
+    """Archivo que marca una muestra como terminada: BAM ordenado o tabla de cuantificación (Salmon/kallisto)."""
+    if aligner in PSEUDO_ALIGNERS:
+        return os.path.join(paths[f'alignments_dir_{aligner}'], sample_id, PSEUDO_QUANT_FILES[aligner])
+    return os.path.join(paths[f'alignments_dir_{aligner}'], f"{sample_id}_Aligned.sortedByCoord.out.bam")
+
+
+def check_sample_completed(sample_info, config, paths):
     """
-    Función "trabajador" que ejecuta el pipeline completo para UNA SOLA muestra.
-    Incluye lógica de limpieza avanzada (Retroactiva y Post-ejecución).
+    Chequeo rápido de finalización: devuelve True si todos los BAMs finales existen,
+    aplicando en ese caso la limpieza retroactiva configurada en el JSON.
     """
     sample_id = sample_info['id']
-    r1_url = sample_info['r1_url']
-    r2_url = sample_info.get('r2_url', None)
+    tool_params = config.get("tool_parameters", {})
 
-    try:
-        # --- Extracción de Parámetros ---
-        setup_params = config.get("project_setup", {})
-        images = config.get("container_images", {})
-        tool_params = config.get("tool_parameters", {})
-        seq_type = setup_params.get("sequencing_type", "paired-end").lower()
-        threads_per_sample = tool_params.get("threads_per_sample", 2)
-        container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
-
-        # --- Rutas de Archivos ---
-        r1_raw_gz = os.path.join(
-            paths['fastq_dir'],
-            f"{sample_id}_1.fastq.gz" if seq_type == "paired-end" else f"{sample_id}.fastq.gz"
-        )
-        r2_raw_gz = os.path.join(paths['fastq_dir'], f"{sample_id}_2.fastq.gz") if r2_url else None
-
-        r1_raw = r1_raw_gz.replace(".gz", "")
-        r2_raw = r2_raw_gz.replace(".gz", "") if r2_raw_gz else None
-
-        r1_trimmed = os.path.join(
-            paths['trimmed_dir'],
-            f"{sample_id}_1.trimmed.fastq.gz" if seq_type == "paired-end" else f"{sample_id}.trimmed.fastq.gz"
-        )
-        r2_trimmed = os.path.join(paths['trimmed_dir'], f"{sample_id}_2.trimmed.fastq.gz") \
-            if seq_type == "paired-end" else None
-
-        # ====================================================================
-        # === 1. CHEQUEO RÁPIDO DE FINALIZACIÓN (CON LIMPIEZA RETROACTIVA) ===
-        # ====================================================================
+    for aligner in paths['aligners_to_run']:
+        final_bam_file = sample_final_output(paths, aligner, sample_id)
+        if not os.path.exists(final_bam_file):
+            logging.info(f"🧬 [WORKER {sample_id}] Resultado final de {aligner} faltante: {os.path.basename(final_bam_file)}. Se debe procesar.")
+            return False
 
-        if not paths['aligners_to_run']:
-            return f"SALTADO (No Aligners): {sample_id}"
+    logging.info(f"✅ [WORKER {sample_id}] Todos los resultados finales (BAM/cuantificación) ya existen.")
 
-        all_bams_exist = True
-        for aligner in paths['aligners_to_run']:
-            final_bam_file = os.path.join(
-                paths[f'alignments_dir_{aligner}'],
-                f"{sample_id}_Aligned.sortedByCoord.out.bam"
-            )
-            if not os.path.exists(final_bam_file):
-                all_bams_exist = False
-                logging.info(f"🧬 [WORKER {sample_id}] BAM faltante: {os.path.basename(final_bam_file)}. Se debe procesar.")
-                break 
-        
-        if all_bams_exist:
-            logging.info(f"✅ [WORKER {sample_id}] Todos los BAMs finales ya existen.")
-            
-            retro_max = tool_params.get("retain_only_fastqc_and_bam", False)
-            retro_med = tool_params.get("cleanup_only_fastq", False)
-            
-            if retro_max or retro_med:
-                logging.info(f"🧹 [WORKER {sample_id}] Ejecutando limpieza retroactiva...")
-                
-                # 1. Borrar CRUDOS (Aplica a ambos modos)
-                if os.path.exists(r1_raw): os.remove(r1_raw)
-                if r2_raw and os.path.exists(r2_raw): os.remove(r2_raw)
-                
-                # 2. Borrar INTERMEDIOS (Solo modo Máximo)
-                if retro_max:
-                    if os.path.exists(r1_trimmed): os.remove(r1_trimmed)
-                    if r2_trimmed and os.path.exists(r2_trimmed): os.remove(r2_trimmed)
-                    
-                    if 'alignments_dir_HISAT2' in paths:
-                        sam_file = os.path.join(paths['alignments_dir_HISAT2'], f"{sample_id}.sam")
-                        if os.path.exists(sam_file): os.remove(sam_file)
-                        
-                    if 'alignments_dir_STAR' in paths:
-                        star_out_prefix = os.path.join(paths['alignments_dir_STAR'], f"{sample_id}_")
-                        star_tmp_dir = f"{star_out_prefix}STARtmp" 
-                        if os.path.exists(star_tmp_dir): shutil.rmtree(star_tmp_dir, ignore_errors=True)
-                        if os.path.exists(star_tmp_dir.replace("STARtmp", "_STARtmp")): shutil.rmtree(star_tmp_dir.replace("STARtmp", "_STARtmp"), ignore_errors=True)
+    retro_max = tool_params.get("retain_only_fastqc_and_bam", False)
+    retro_med = tool_params.get("cleanup_only_fastq", False)
 
-            return f"SALTADO (BAMs OK): {sample_id}"
+    if retro_max or retro_med:
+        logging.info(f"🧹 [WORKER {sample_id}] Ejecutando limpieza retroactiva...")
+        # Crudos en ambos modos; intermedios solo en modo Máximo.
+        cleanup_sample_files(sample_id, get_sample_file_paths(sample_info, config, paths), paths, purge_intermediates=retro_max)
+
+    return True
 
-        # Si no existen los BAMs, continuamos con el pipeline normal
-        logging.info(f"🚀 [WORKER {sample_id}] Iniciando pipeline...")
-        
-        # ====================================================================
-        # 2. DESCARGA Y DESCOMPRESIÓN
-        # ====================================================================
 
-        # --- R1 ---
+def download_sample_stage(sample_info, config, paths):
+    """Etapa 1 (red): descarga los FASTQ de la muestra y, fuera del modo streaming, los descomprime."""
+    sample_id = sample_info['id']
+    r1_url = sample_info['r1_url']
+    r2_url = sample_info.get('r2_url', None)
+    tool_params = config.get("tool_parameters", {})
+    seq_type = config.get("project_setup", {}).get("sequencing_type", "paired-end").lower()
+    files = get_sample_file_paths(sample_info, config, paths)
+    r1_raw_gz, r2_raw_gz, r1_raw, r2_raw = files['r1_raw_gz'], files['r2_raw_gz'], files['r1_raw'], files['r2_raw']
+    download_config = tool_params.get("downloads", {})
+    md5_map = paths.get('fastq_md5', {})
+
+    logging.info(f"🚀 [WORKER {sample_id}] Iniciando pipeline...")
+
+    # download_file() salta los .gz ya completos y re-verifica (MD5) los heredados de ejecuciones previas.
+    if tool_params.get("streaming_ingest", False):
+        # Se reutiliza un FASTQ plano de ejecuciones anteriores si existe; si no, se trabaja sobre el .gz.
         if not os.path.exists(r1_raw):
-            if not os.path.exists(r1_raw_gz):
-                logging.info(f"⬇️ [WORKER {sample_id}] Descargando {os.path.basename(r1_url)}...")
-                subprocess.run(["wget", "-q", "-O", r1_raw_gz, r1_url], check=True, capture_output=True, text=True)
-            
-            logging.info(f"📦 [WORKER {sample_id}] Descomprimiendo {os.path.basename(r1_raw_gz)}...")
-            with gzip.open(r1_raw_gz, 'rb') as f_in, open(r1_raw, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            os.remove(r1_raw_gz) 
+            logging.info(f"⬇️ [WORKER {sample_id}] Descargando/verificando {os.path.basename(r1_url)} (streaming, sin descomprimir)...")
+            download_file(r1_url, r1_raw_gz, md5_map.get(os.path.basename(r1_url)), download_config)
         else:
             logging.info(f"⏩ [WORKER {sample_id}] R1 raw ya existe.")
 
-        # --- R2 ---
         if seq_type == "paired-end" and r2_url:
             if not os.path.exists(r2_raw):
-                if not os.path.exists(r2_raw_gz):
-                    logging.info(f"⬇️ [WORKER {sample_id}] Descargando {os.path.basename(r2_url)}...")
-                    subprocess.run(["wget", "-q", "-O", r2_raw_gz, r2_url], check=True, capture_output=True, text=True)
-                
-                logging.info(f"📦 [WORKER {sample_id}] Descomprimiendo {os.path.basename(r2_raw_gz)}...")
-                with gzip.open(r2_raw_gz, 'rb') as f_in, open(r2_raw, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                os.remove(r2_raw_gz)
+                logging.info(f"⬇️ [WORKER {sample_id}] Descargando/verificando {os.path.basename(r2_url)} (streaming, sin descomprimir)...")
+                download_file(r2_url, r2_raw_gz, md5_map.get(os.path.basename(r2_url)), download_config)
             else:
                 logging.info(f"⏩ [WORKER {sample_id}] R2 raw ya existe.")
+        return
 
-        # ====================================================================
-        # 3. FastQC Inicial
-        # ====================================================================
-        fastqc_check_file = os.path.join(
-            paths['fastqc_dir'],
-            f"{os.path.basename(r1_raw).replace('.fastq', '')}_fastqc.html"
-        )
-
-        if not os.path.exists(fastqc_check_file):
-            logging.info(f"🔍 [WORKER {sample_id}] Ejecutando FastQC inicial...")
-            fastqc_cmd = [
-                container_cmd, "exec", images.get("fastqc"), "fastqc",
-                "-o", paths['fastqc_dir'], r1_raw
-            ]
-            if r2_raw and os.path.exists(r2_raw):
-                fastqc_cmd.append(r2_raw)
-
-            subprocess.run(fastqc_cmd, check=True, capture_output=True, text=True)
+    # --- R1 ---
+    if not os.path.exists(r1_raw):
+        logging.info(f"⬇️ [WORKER {sample_id}] Descargando/verificando {os.path.basename(r1_url)}...")
+        download_file(r1_url, r1_raw_gz, md5_map.get(os.path.basename(r1_url)), download_config)
+
+        logging.info(f"📦 [WORKER {sample_id}] Descomprimiendo {os.path.basename(r1_raw_gz)}...")
+        decompress_gzip_file(r1_raw_gz, r1_raw)
+        os.remove(r1_raw_gz)
+    else:
+        logging.info(f"⏩ [WORKER {sample_id}] R1 raw ya existe.")
+
+    # --- R2 ---
+    if seq_type == "paired-end" and r2_url:
+        if not os.path.exists(r2_raw):
+            logging.info(f"⬇️ [WORKER {sample_id}] Descargando/verificando {os.path.basename(r2_url)}...")
+            download_file(r2_url, r2_raw_gz, md5_map.get(os.path.basename(r2_url)), download_config)
+
+            logging.info(f"📦 [WORKER {sample_id}] Descomprimiendo {os.path.basename(r2_raw_gz)}...")
+            decompress_gzip_file(r2_raw_gz, r2_raw)
+            os.remove(r2_raw_gz)
         else:
-            logging.info(f"⏩ [WORKER {sample_id}] FastQC inicial ya existe.")
+            logging.info(f"⏩ [WORKER {sample_id}] R2 raw ya existe.")
 
-        # ====================================================================
-        # 4. Trimmomatic
-        # ====================================================================
-        if not os.path.exists(r1_trimmed):
-            logging.info(f"✂️ [WORKER {sample_id}] Ejecutando Trimmomatic...")
 
-            trimmomatic_config = tool_params.get("trimmomatic", {})
-            trimmomatic_extra_args = trimmomatic_config.get("extra_args", None)
-            
-            sliding_w = trimmomatic_config.get("sliding_window", "4:15")
-            min_len = trimmomatic_config.get("min_len", 36)
-            leading = trimmomatic_config.get("leading", 3)
-            trailing = trimmomatic_config.get("trailing", 3)
-
-            trim_cmd_base = [container_cmd, "exec", images.get("trimmomatic"), "trimmomatic"]
-
-            if trimmomatic_extra_args:
-                trim_cmd_base.extend(trimmomatic_extra_args.split())
-
-            trim_params = [
-                f"ILLUMINACLIP:{paths['adapters_file']}:2:30:10",
-                f"LEADING:{leading}",
-                f"TRAILING:{trailing}",
-                f"SLIDINGWINDOW:{sliding_w}",
-                f"MINLEN:{min_len}"
-            ]
-
-            # Validación de existencia de crudos antes de trim
-            if not os.path.exists(r1_raw):
-                 raise FileNotFoundError(f"FASTQ RAW no encontrado para {sample_id} antes de Trimmomatic")
-
-            if seq_type == "paired-end":
-                out1_unp = os.path.join(paths['trimmed_dir'], f"{sample_id}_1.unpaired.fastq.gz")
-                out2_unp = os.path.join(paths['trimmed_dir'], f"{sample_id}_2.unpaired.fastq.gz")
-
-                trim_cmd = trim_cmd_base + [
-                    "PE", "-threads", str(threads_per_sample),
-                    r1_raw, r2_raw,
-                    r1_trimmed, out1_unp,
-                    r2_trimmed, out2_unp
-                ] + trim_params
-
-                subprocess.run(trim_cmd, check=True, capture_output=True, text=True)
-                if os.path.exists(out1_unp): os.remove(out1_unp)
-                if os.path.exists(out2_unp): os.remove(out2_unp)
+def qc_trim_sample_stage(sample_info, config, paths):
+    """Etapa 2 (CPU ligera): FastQC inicial y Trimmomatic."""
+    sample_id = sample_info['id']
+    images = config.get("container_images", {})
+    tool_params = config.get("tool_parameters", {})
+    seq_type = config.get("project_setup", {}).get("sequencing_type", "paired-end").lower()
+    threads_per_sample = tool_params.get("threads_per_sample", 2)
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    files = get_sample_file_paths(sample_info, config, paths)
+    r1_raw, r2_raw = files['r1_raw'], files['r2_raw']
+    r1_trimmed, r2_trimmed = files['r1_trimmed'], files['r2_trimmed']
+
+    # En modo streaming las herramientas leen el .gz salvo que quede un FASTQ plano de ejecuciones previas.
+    if tool_params.get("streaming_ingest", False):
+        r1_input = r1_raw if os.path.exists(r1_raw) else files['r1_raw_gz']
+        r2_input = (r2_raw if os.path.exists(r2_raw) else files['r2_raw_gz']) if r2_raw else None
+    else:
+        r1_input, r2_input = r1_raw, r2_raw
+
+    # ====================================================================
+    # FastQC Inicial
+    # ====================================================================
+    fastqc_check_file = os.path.join(
+        paths['fastqc_dir'],
+        f"{os.path.basename(r1_raw).replace('.fastq', '')}_fastqc.html"
+    )
 
-            else:
-                trim_cmd = trim_cmd_base + [
-                    "SE", "-threads", str(threads_per_sample),
-                    r1_raw, r1_trimmed
-                ] + trim_params
+    if not os.path.exists(fastqc_check_file):
+        logging.info(f"🔍 [WORKER {sample_id}] Ejecutando FastQC inicial...")
+        fastqc_cmd = [
+            container_cmd, "exec", images.get("fastqc"), "fastqc",
+            "-o", paths['fastqc_dir'], r1_input
+        ]
+        if r2_input and os.path.exists(r2_input):
+            fastqc_cmd.append(r2_input)
 
-                subprocess.run(trim_cmd, check=True, capture_output=True, text=True)
+        run_tool(fastqc_cmd, stage="fastqc", sample=sample_id)
+    else:
+        logging.info(f"⏩ [WORKER {sample_id}] FastQC inicial ya existe.")
+
+    # ====================================================================
+    # Trimmomatic
+    # ====================================================================
+    if not os.path.exists(r1_trimmed):
+        logging.info(f"✂️ [WORKER {sample_id}] Ejecutando Trimmomatic...")
+
+        trimmomatic_config = tool_params.get("trimmomatic", {})
+        trimmomatic_extra_args = trimmomatic_config.get("extra_args", None)
+
+        sliding_w = trimmomatic_config.get("sliding_window", "4:15")
+        min_len = trimmomatic_config.get("min_len", 36)
+        leading = trimmomatic_config.get("leading", 3)
+        trailing = trimmomatic_config.get("trailing", 3)
+
+        trim_cmd_base = [container_cmd, "exec", images.get("trimmomatic"), "trimmomatic"]
+
+        if trimmomatic_extra_args:
+            trim_cmd_base.extend(trimmomatic_extra_args.split())
+
+        trim_params = [
+            f"ILLUMINACLIP:{paths['adapters_file']}:2:30:10",
+            f"LEADING:{leading}",
+            f"TRAILING:{trailing}",
+            f"SLIDINGWINDOW:{sliding_w}",
+            f"MINLEN:{min_len}"
+        ]
+
+        # Validación de existencia de crudos antes de trim
+        if not os.path.exists(r1_input):
+             raise FileNotFoundError(f"FASTQ RAW no encontrado para {sample_id} antes de Trimmomatic")
+
+        if seq_type == "paired-end":
+            out1_unp = os.path.join(paths['trimmed_dir'], f"{sample_id}_1.unpaired.fastq.gz")
+            out2_unp = os.path.join(paths['trimmed_dir'], f"{sample_id}_2.unpaired.fastq.gz")
+
+            trim_cmd = trim_cmd_base + [
+                "PE", "-threads", str(threads_per_sample),
+                r1_input, r2_input,
+                r1_trimmed, out1_unp,
+                r2_trimmed, out2_unp
+            ] + trim_params
+
+            run_tool(trim_cmd, stage="trimmomatic", sample=sample_id)
+            if os.path.exists(out1_unp): os.remove(out1_unp)
+            if os.path.exists(out2_unp): os.remove(out2_unp)
 
-            logging.info(f"✅ [WORKER {sample_id}] Trimmomatic completado.")
         else:
-            logging.info(f"⏩ [WORKER {sample_id}] Trimmed ya existe.")
+            trim_cmd = trim_cmd_base + [
+                "SE", "-threads", str(threads_per_sample),
+                r1_input, r1_trimmed
+            ] + trim_params
 
-        # ====================================================================
-        # 5. Alineamiento
-        # ====================================================================
-        for aligner in paths['aligners_to_run']:
-            alignments_dir = paths[f'alignments_dir_{aligner}']
-            out_prefix = os.path.join(alignments_dir, f"{sample_id}_")
-            final_bam_file = f"{out_prefix}Aligned.sortedByCoord.out.bam"
-
-            if not os.path.exists(final_bam_file):
-                logging.info(f"🧬 [WORKER {sample_id}] Ejecutando alineamiento con {aligner}...")
-
-                if aligner == "STAR":
-                    align_cmd = [
-                        container_cmd, "exec", images.get("star"), "STAR",
-                        "--runThreadN", str(threads_per_sample),
-                        "--genomeDir", paths['reference_dir'],
-                        "--outFileNamePrefix", out_prefix,
-                        "--outSAMtype", "BAM", "SortedByCoordinate",
-                        "--readFilesCommand", "zcat",
-                        "--readFilesIn", r1_trimmed
-                    ]
-                    if seq_type == "paired-end":
-                        align_cmd.append(r2_trimmed)
+            run_tool(trim_cmd, stage="trimmomatic", sample=sample_id)
 
-                    subprocess.run(align_cmd, check=True, capture_output=True, text=True)
+        logging.info(f"✅ [WORKER {sample_id}] Trimmomatic completado.")
+    else:
+        logging.info(f"⏩ [WORKER {sample_id}] Trimmed ya existe.")
 
-                elif aligner == "HISAT2":
-                    sam_output = os.path.join(alignments_dir, f"{sample_id}.sam")
-                    align_cmd = [
-                        container_cmd, "exec", images.get("hisat2"), "hisat2",
-                        "-p", str(threads_per_sample),
-                        "-x", paths['hisat2_index_prefix'],
-                        "-S", sam_output
-                    ]
-                    if seq_type == "paired-end":
-                        align_cmd.extend(["-1", r1_trimmed, "-2", r2_trimmed])
-                    else:
-                        align_cmd.extend(["-U", r1_trimmed])
 
-                    align_result = subprocess.run(align_cmd, check=True, text=True, capture_output=True)
-                    with open(os.path.join(alignments_dir, f"{sample_id}_hisat2_summary.log"), 'w') as f:
+def align_sample_stage(sample_info, config, paths):
+    """Etapa 3 (CPU pesada): alineamiento con cada alineador y gestión del ciclo de vida de datos."""
+    sample_id = sample_info['id']
+    images = config.get("container_images", {})
+    tool_params = config.get("tool_parameters", {})
+    seq_type = config.get("project_setup", {}).get("sequencing_type", "paired-end").lower()
+    threads_per_sample = tool_params.get("threads_per_sample", 2)
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    files = get_sample_file_paths(sample_info, config, paths)
+    r1_trimmed, r2_trimmed = files['r1_trimmed'], files['r2_trimmed']
+
+    # ====================================================================
+    # Alineamiento
+    # ====================================================================
+    for aligner in paths['aligners_to_run']:
+        alignments_dir = paths[f'alignments_dir_{aligner}']
+        out_prefix = os.path.join(alignments_dir, f"{sample_id}_")
+        final_bam_file = f"{out_prefix}Aligned.sortedByCoord.out.bam"
+
+        if not os.path.exists(sample_final_output(paths, aligner, sample_id)):
+            logging.info(f"🧬 [WORKER {sample_id}] Ejecutando alineamiento con {aligner}...")
+
+            if aligner == "STAR":
+                align_cmd = [
+                    container_cmd, "exec", images.get("star"), "STAR",
+                    "--runThreadN", str(threads_per_sample),
+                    "--genomeDir", paths.get('star_index_dir', paths['reference_dir']),
+                    "--outFileNamePrefix", out_prefix,
+                    "--outSAMtype", "BAM", "SortedByCoordinate",
+                    "--readFilesCommand", "zcat",
+                    "--readFilesIn", r1_trimmed
+                ]
+                if seq_type == "paired-end":
+                    align_cmd.append(r2_trimmed)
+                if paths.get('star_shared_genome'):
+                    # Se adjunta al genoma ya cargado; el ordenado de BAM exige un límite explícito de RAM.
+                    align_cmd.extend([
+                        "--genomeLoad", "LoadAndKeep",
+                        "--limitBAMsortRAM", str(tool_params.get("star", {}).get("limitBAMsortRAM", 10000000000))
+                    ])
+
+                run_tool(align_cmd, stage="align_star", sample=sample_id)
+
+            elif aligner == "HISAT2":
+                hisat2_params = tool_params.get("hisat2", {})
+                summary_log = os.path.join(alignments_dir, f"{sample_id}_hisat2_summary.log")
+                align_cmd = [
+                    container_cmd, "exec", images.get("hisat2"), "hisat2",
+                    "-p", str(threads_per_sample),
+                    "-x", paths['hisat2_index_prefix']
+                ]
+                if seq_type == "paired-end":
+                    align_cmd.extend(["-1", r1_trimmed, "-2", r2_trimmed])
+                else:
+                    align_cmd.extend(["-U", r1_trimmed])
+
+                if hisat2_params.get("stream_to_sort", False):
+                    # Sin SAM intermedio: HISAT2 escribe a stdout y samtools sort ordena directamente a BAM.
+                    # El BAM se escribe como .tmp y se renombra al final: un BAM a medias nunca cuenta como hecho.
+                    sort_tmp_dir = hisat2_params.get("sort_tmp_dir") or alignments_dir
+                    create_directory(sort_tmp_dir)
+                    tmp_bam_file = f"{final_bam_file}.tmp.bam"
+                    sort_cmd = [
+                        container_cmd, "exec", images.get("star"), "samtools",
+                        "sort", "-@", str(threads_per_sample),
+                        "-m", str(hisat2_params.get("sort_memory_per_thread", "768M")),
+                        "-T", os.path.join(sort_tmp_dir, f"{sample_id}.sorttmp"),
+                        "-o", tmp_bam_file, "-"
+                    ]
+                    pipeline = (f"set -o pipefail; {shlex.join(align_cmd)} 2> {shlex.quote(summary_log)} "
+                                f"| {shlex.join(sort_cmd)}")
+                    try:
+                        run_tool(["bash", "-c", pipeline], stage="align_hisat2", sample=sample_id, tool="hisat2|samtools")
+                    except subprocess.CalledProcessError:
+                        if os.path.exists(summary_log):
+                            with open(summary_log, 'r') as f:
+                                logging.error(f"❌ [WORKER {sample_id}] Salida de HISAT2:\n{f.read()}")
+                        if os.path.exists(tmp_bam_file): os.remove(tmp_bam_file)
+                        raise
+                    os.replace(tmp_bam_file, final_bam_file)
+                else:
+                    sam_output = os.path.join(alignments_dir, f"{sample_id}.sam")
+                    align_result = run_tool(align_cmd + ["-S", sam_output], stage="align_hisat2", sample=sample_id)
+                    with open(summary_log, 'w') as f:
                         f.write(align_result.stderr)
 
                     sam_to_bam_cmd = [
@@ -971,50 +1624,185 @@ def pipeline_worker_for_sample(sample_info, config, paths):
                         "sort", "-@", str(threads_per_sample),
                         "-o", final_bam_file, sam_output
                     ]
-                    subprocess.run(sam_to_bam_cmd, check=True, capture_output=True, text=True)
-                    os.remove(sam_output) 
+                    run_tool(sam_to_bam_cmd, stage="samtools_sort", sample=sample_id)
+                    os.remove(sam_output)
 
-                logging.info(f"✅ [WORKER {sample_id}] Alineamiento {aligner} completado.")
-            else:
-                logging.info(f"⏩ [WORKER {sample_id}] BAM final de {aligner} ya existe.")
-
-        # ====================================================================
-        # 6. Gestión del Ciclo de Vida de Datos (POST-EJECUCIÓN)
-        # ====================================================================
-        
-        # Leemos parámetros (igual que en la limpieza retroactiva)
-        retain_strict = tool_params.get("retain_only_fastqc_and_bam", False)
-        cleanup_simple = tool_params.get("cleanup_only_fastq", False)
-
-        # MODO AHORRO MÁXIMO
-        if retain_strict:
-            logging.info(f"🧹 [WORKER {sample_id}] MODO AHORRO MÁXIMO: Purgando intermedios post-run...")
-            if os.path.exists(r1_raw): os.remove(r1_raw)
-            if r2_raw and os.path.exists(r2_raw): os.remove(r2_raw)
-            if os.path.exists(r1_trimmed): os.remove(r1_trimmed)
-            if r2_trimmed and os.path.exists(r2_trimmed): os.remove(r2_trimmed)
-            
-            if 'alignments_dir_HISAT2' in paths:
-                sam_file = os.path.join(paths['alignments_dir_HISAT2'], f"{sample_id}.sam")
-                if os.path.exists(sam_file): os.remove(sam_file)
-            
-            if 'alignments_dir_STAR' in paths:
-                star_out_prefix = os.path.join(paths['alignments_dir_STAR'], f"{sample_id}_")
-                star_tmp_dir = f"{star_out_prefix}STARtmp"
-                # Limpieza de carpetas temporales
-                if os.path.exists(star_tmp_dir): shutil.rmtree(star_tmp_dir, ignore_errors=True)
-                if os.path.exists(star_tmp_dir.replace("STARtmp", "_STARtmp")): shutil.rmtree(star_tmp_dir.replace("STARtmp", "_STARtmp"), ignore_errors=True)
-
-        # MODO AHORRO INTERMEDIO
-        elif cleanup_simple:
-            logging.info(f"🧹 [WORKER {sample_id}] MODO AHORRO INTERMEDIO: Borrando crudos...")
-            if os.path.exists(r1_raw): os.remove(r1_raw)
-            if r2_raw and os.path.exists(r2_raw): os.remove(r2_raw)
+            elif aligner in PSEUDO_ALIGNERS:
+                pseudo_quantify_sample(aligner, sample_id, r1_trimmed, r2_trimmed, seq_type, alignments_dir,
+                                       paths['pseudo_index_dir'], images.get(aligner.lower()), threads_per_sample,
+                                       tool_params.get(aligner.lower(), {}))
 
+            logging.info(f"✅ [WORKER {sample_id}] Alineamiento {aligner} completado.")
         else:
-            logging.info(f"💾 [WORKER {sample_id}] MODO DEBUG: Se conservan todos los archivos.")
+            logging.info(f"⏩ [WORKER {sample_id}] Resultado final de {aligner} ya existe.")
+
+    # ====================================================================
+    # Gestión del Ciclo de Vida de Datos (POST-EJECUCIÓN)
+    # ====================================================================
+
+    # Leemos parámetros (igual que en la limpieza retroactiva)
+    retain_strict = tool_params.get("retain_only_fastqc_and_bam", False)
+    cleanup_simple = tool_params.get("cleanup_only_fastq", False)
+
+    # MODO AHORRO MÁXIMO
+    if retain_strict:
+        logging.info(f"🧹 [WORKER {sample_id}] MODO AHORRO MÁXIMO: Purgando intermedios post-run...")
+        cleanup_sample_files(sample_id, files, paths, purge_intermediates=True)
+
+    # MODO AHORRO INTERMEDIO
+    elif cleanup_simple:
+        logging.info(f"🧹 [WORKER {sample_id}] MODO AHORRO INTERMEDIO: Borrando crudos...")
+        cleanup_sample_files(sample_id, files, paths, purge_intermediates=False)
+
+    else:
+        logging.info(f"💾 [WORKER {sample_id}] MODO DEBUG: Se conservan todos los archivos.")
+
+    logging.info(f"🎉 [WORKER {sample_id}] Pipeline finalizado con éxito.")
+
+
+def star_first_pass_stage(sample_info, config, paths):
+    """Primera pasada STAR de cohorte: alineamiento sin BAM, solo para descubrir uniones (SJ.out.tab)."""
+    sample_id = sample_info['id']
+    images = config.get("container_images", {})
+    tool_params = config.get("tool_parameters", {})
+    seq_type = config.get("project_setup", {}).get("sequencing_type", "paired-end").lower()
+    threads_per_sample = tool_params.get("threads_per_sample", 2)
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    files = get_sample_file_paths(sample_info, config, paths)
+    out_prefix = os.path.join(paths['star_first_pass_dir'], f"{sample_id}_")
+
+    if os.path.exists(f"{out_prefix}SJ.out.tab"):
+        logging.info(f"⏩ [WORKER {sample_id}] Primera pasada STAR ya existe."); return
+
+    logging.info(f"🧬 [WORKER {sample_id}] Ejecutando primera pasada STAR (descubrimiento de uniones)...")
+    cmd = [
+        container_cmd, "exec", images.get("star"), "STAR",
+        "--runThreadN", str(threads_per_sample),
+        "--genomeDir", paths.get('star_index_dir', paths['reference_dir']),
+        "--outFileNamePrefix", out_prefix,
+        "--outSAMtype", "None",
+        "--readFilesCommand", "zcat",
+        "--readFilesIn", files['r1_trimmed']
+    ]
+    if seq_type == "paired-end":
+        cmd.append(files['r2_trimmed'])
+    run_tool(cmd, stage="star_first_pass", sample=sample_id)
+    logging.info(f"✅ [WORKER {sample_id}] Primera pasada STAR completada.")
+
+
+def star_first_pass_worker(sample_info, config, paths):
+    """Trabajador de la primera pasada de cohorte: descarga, QC/trimming y primera pasada STAR."""
+    for stage_func in (download_sample_stage, qc_trim_sample_stage, star_first_pass_stage):
+        status = run_sample_stage(stage_func, sample_info, config, paths)
+        if status.startswith("ERROR"):
+            return status
+    return f"OK: {sample_info['id']}"
+
+
+STAR_SAMPLE_OUTPUT_RE = re.compile(r'^(.+)_(Aligned\.sortedByCoord\.out\.bam(\.bai)?|Log(\.final|\.progress)?\.out|SJ\.out\.tab)$')
+
+
+def discard_star_alignments(config, paths):
+    """
+    Borra los resultados de STAR alineados contra otro índice (BAMs y logs de cada muestra, su
+    cuantificación de StringTie y counts_STAR.txt) para que toda la cohorte se realinee contra el índice
+    nuevo. Si no, check_sample_completed los daría por buenos y featureCounts/DESeq2 mezclarían índices.
+    """
+    base_dir = config.get("project_setup", {}).get("base_dir", ".")
+    alignments_dir = paths['alignments_dir_STAR']
+    stale_files = [f for f in os.listdir(alignments_dir)
+                   if STAR_SAMPLE_OUTPUT_RE.match(f) and os.path.isfile(os.path.join(alignments_dir, f))]
+    stale_samples = sorted({STAR_SAMPLE_OUTPUT_RE.match(f).group(1) for f in stale_files if f.endswith(".bam")})
+    if not stale_files:
+        return
+    logging.warning(f"⚠️ Se descartan los alineamientos STAR de {len(stale_samples)} muestras (índice de segunda pasada distinto). Se realinearán.")
+    for f in stale_files:
+        os.remove(os.path.join(alignments_dir, f))
+    for sample_id in stale_samples:
+        shutil.rmtree(os.path.join(base_dir, "STRINGTIE_STAR", sample_id), ignore_errors=True)
+    counts_file = os.path.join(base_dir, "COUNTS", "counts_STAR.txt")
+    for stale in (counts_file, f"{counts_file}.summary"):
+        if os.path.exists(stale): os.remove(stale)
+
 
-        logging.info(f"🎉 [WORKER {sample_id}] Pipeline finalizado con éxito.")
+def run_star_cohort_two_pass(samples, config, paths, fasta_file, gtf_file, threads):
+    """
+    STAR en dos pasadas a nivel de cohorte: primera pasada de todas las muestras, fusión y filtrado
+    de sus SJ.out.tab en una base común y re-indexado ÚNICO del genoma con esas uniones. La segunda
+    pasada (alineamiento normal) usa ese índice en lugar de insertar uniones muestra a muestra.
+    El índice queda ligado (cohort_two_pass.json) a las muestras y filtros con que se construyó:
+    si cambia la cohorte se reconstruye y se descartan los BAMs STAR alineados contra el anterior.
+    Devuelve la ruta del índice de segunda pasada o None si falla.
+    """
+    tool_params = config.get("tool_parameters", {})
+    star_config = tool_params.get("star", {})
+    images = config.get("container_images", {})
+    second_pass_index = os.path.join(paths['reference_dir'], "STAR_INDEX_2PASS")
+    key_file = os.path.join(second_pass_index, "cohort_two_pass.json")
+    cohort_key = {
+        'samples': sorted(s['id'] for s in samples),
+        'sjdbOverhang': star_config.get("sjdbOverhang", 99),
+        'two_pass_min_unique_reads': star_config.get("two_pass_min_unique_reads", 3),
+        'two_pass_min_samples': star_config.get("two_pass_min_samples", 1),
+        'two_pass_keep_noncanonical': star_config.get("two_pass_keep_noncanonical", False)
+    }
+
+    if os.path.exists(os.path.join(second_pass_index, "SA")):
+        try:
+            with open(key_file, 'r') as f:
+                previous_key = json.load(f)
+        except (OSError, ValueError):
+            previous_key = None
+        if previous_key == cohort_key:
+            logging.info(f"⏩ Índice STAR de segunda pasada ya existe en {second_pass_index} para esta cohorte. Saltando primera pasada.")
+            return second_pass_index
+        logging.info("♻️ El índice STAR de segunda pasada se construyó con otra cohorte o filtros. Reconstruyendo...")
+        shutil.rmtree(second_pass_index)
+    # Todo BAM STAR existente se alineó contra otro índice (el anterior de segunda pasada o el de una pasada).
+    discard_star_alignments(config, paths)
+
+    first_pass_dir = os.path.join(paths['alignments_dir_STAR'], "FIRST_PASS")
+    create_directory(first_pass_dir)
+    paths['star_first_pass_dir'] = first_pass_dir
+
+    # Toda muestra de la cohorte necesita su SJ.out.tab de primera pasada, aunque ya tenga BAM final:
+    # el SJ.out.tab de la segunda pasada marca como anotadas las uniones insertadas y no sirve para la base.
+    sj_files = {s['id']: os.path.join(first_pass_dir, f"{s['id']}_SJ.out.tab") for s in samples}
+    pending = [s for s in samples if not os.path.exists(sj_files[s['id']])]
+    logging.info(f"🔁 STAR dos pasadas (cohorte): primera pasada para {len(pending)} de {len(samples)} muestras...")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=tool_params.get("max_parallel_samples", 4)) as executor:
+        worker_func = partial(star_first_pass_worker, config=config, paths=paths)
+        results = list(executor.map(worker_func, pending))
+    if any("ERROR" in res for res in results):
+        logging.error("❌ Hubo errores en la primera pasada STAR de cohorte."); return None
+
+    pooled_sj_file = os.path.join(first_pass_dir, "cohort_SJ.filtered.tab")
+    merge_splice_junctions(
+        [sj_files[sample_id] for sample_id in cohort_key['samples']], pooled_sj_file,
+        min_unique_reads=cohort_key['two_pass_min_unique_reads'],
+        min_samples=cohort_key['two_pass_min_samples'],
+        keep_noncanonical=cohort_key['two_pass_keep_noncanonical']
+    )
+
+    create_directory(second_pass_index)
+    build_star_index(fasta_file, gtf_file, second_pass_index, images.get("star"), threads, cohort_key['sjdbOverhang'], sjdb_file=pooled_sj_file)
+    with open(key_file, 'w') as f:
+        json.dump(cohort_key, f, indent=2)
+    return second_pass_index
+
+
+SAMPLE_STAGES = [
+    ("descarga", download_sample_stage),
+    ("qc_trimming", qc_trim_sample_stage),
+    ("alineamiento", align_sample_stage),
+]
+
+
+def run_sample_stage(stage_func, sample_info, config, paths):
+    """Ejecuta una etapa de una muestra y traduce las excepciones al estado 'OK'/'ERROR' del worker."""
+    sample_id = sample_info['id']
+    try:
+        stage_func(sample_info, config, paths)
         return f"OK: {sample_id}"
 
     except subprocess.CalledProcessError as e:
@@ -1024,7 +1812,220 @@ def pipeline_worker_for_sample(sample_info, config, paths):
     except Exception as e:
         logging.error(f"❌ [WORKER {sample_id}] ERROR INESPERADO: {e}")
         return f"ERROR: {sample_id}"
-       
+
+
+def pipeline_worker_for_sample(sample_info, config, paths):
+    """
+    Función "trabajador" que ejecuta el pipeline completo para UNA SOLA muestra.
+    Incluye lógica de limpieza avanzada (Retroactiva y Post-ejecución).
+    """
+    sample_id = sample_info['id']
+
+    if not paths['aligners_to_run']:
+        return f"SALTADO (No Aligners): {sample_id}"
+
+    try:
+        if check_sample_completed(sample_info, config, paths):
+            return f"SALTADO (BAMs OK): {sample_id}"
+    except Exception as e:
+        logging.error(f"❌ [WORKER {sample_id}] ERROR INESPERADO: {e}")
+        return f"ERROR: {sample_id}"
+
+    # Si no existen los BAMs, continuamos con el pipeline normal
+    for stage_name, stage_func in SAMPLE_STAGES:
+        status = run_sample_stage(stage_func, sample_info, config, paths)
+        if status.startswith("ERROR"):
+            return status
+    return f"OK: {sample_id}"
+
+
+def run_staged_sample_scheduler(samples, config, paths):
+    """
+    Planificador por etapas: descarga (red), QC/trimming (CPU ligera) y alineamiento
+    (CPU pesada) se ejecutan en pools independientes con su propio límite de concurrencia,
+    de modo que la descarga de la muestra N+k se solapa con el alineamiento de la muestra N.
+    Devuelve los estados en el mismo orden que 'samples'.
+    """
+    tool_params = config.get("tool_parameters", {})
+    scheduler_config = tool_params.get("stage_scheduler", {})
+    download_slots = scheduler_config.get("download_slots", tool_params.get("download_threads", 4))
+    qc_slots = scheduler_config.get("qc_slots", 2)
+    align_slots = scheduler_config.get("align_slots", tool_params.get("max_parallel_samples", 4))
+    # Máximo de muestras "en vuelo" (descargadas y sin alinear) para acotar el uso de scratch.
+    prefetch_limit = scheduler_config.get("prefetch_limit", download_slots + qc_slots + align_slots)
+
+    logging.info(f"🗂️  Planificador por etapas: descarga={download_slots}, qc={qc_slots}, alineamiento={align_slots}, muestras en vuelo<={prefetch_limit}.")
+
+    results = {}
+    pending = []
+    for sample in samples:
+        if not paths['aligners_to_run']:
+            results[sample['id']] = f"SALTADO (No Aligners): {sample['id']}"
+            continue
+        try:
+            if check_sample_completed(sample, config, paths):
+                results[sample['id']] = f"SALTADO (BAMs OK): {sample['id']}"
+                continue
+        except Exception as e:
+            logging.error(f"❌ [WORKER {sample['id']}] ERROR INESPERADO: {e}")
+            results[sample['id']] = f"ERROR: {sample['id']}"
+            continue
+        pending.append(sample)
+    pending.reverse()
+
+    # La descarga solo espera a la red: hilos. QC y alineamiento: procesos, como el worker clásico.
+    stage_pools = [(concurrent.futures.ThreadPoolExecutor, download_slots),
+                   (concurrent.futures.ProcessPoolExecutor, qc_slots),
+                   (concurrent.futures.ProcessPoolExecutor, align_slots)]
+    pools = [executor_class(max_workers=slots) for executor_class, slots in stage_pools]
+    in_flight = {}
+    samples_in_flight = 0
+
+    def replace_broken_pool(stage_idx, broken_pool):
+        # Un worker muerto (p. ej. por el OOM killer) rompe todo el pool: se sustituye para las muestras siguientes.
+        if pools[stage_idx] is broken_pool:
+            logging.warning(f"⚠️ Pool de la etapa '{SAMPLE_STAGES[stage_idx][0]}' roto; se crea uno nuevo.")
+            broken_pool.shutdown(wait=False)
+            executor_class, slots = stage_pools[stage_idx]
+            pools[stage_idx] = executor_class(max_workers=slots)
+
+    def submit_stage(sample, stage_idx):
+        _, stage_func = SAMPLE_STAGES[stage_idx]
+        pool = pools[stage_idx]
+        try:
+            future = pool.submit(run_sample_stage, stage_func, sample, config, paths)
+        except concurrent.futures.BrokenExecutor:
+            replace_broken_pool(stage_idx, pool)
+            pool = pools[stage_idx]
+            future = pool.submit(run_sample_stage, stage_func, sample, config, paths)
+        in_flight[future] = (sample, stage_idx, pool)
+
+    try:
+        while pending or in_flight:
+            while pending and samples_in_flight < prefetch_limit:
+                submit_stage(pending.pop(), 0)
+                samples_in_flight += 1
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                sample, stage_idx, pool = in_flight.pop(future)
+                try:
+                    status = future.result()
+                except concurrent.futures.BrokenExecutor:
+                    logging.error(f"❌ [WORKER {sample['id']}] El proceso de la etapa '{SAMPLE_STAGES[stage_idx][0]}' terminó abruptamente (¿falta de memoria?).")
+                    replace_broken_pool(stage_idx, pool)
+                    status = f"ERROR: {sample['id']}"
+                except Exception as e:
+                    logging.error(f"❌ [WORKER {sample['id']}] ERROR INESPERADO: {e}")
+                    status = f"ERROR: {sample['id']}"
+                if status.startswith("ERROR") or stage_idx == len(SAMPLE_STAGES) - 1:
+                    results[sample['id']] = status
+                    samples_in_flight -= 1
+                else:
+                    submit_stage(sample, stage_idx + 1)
+    finally:
+        for pool in pools:
+            pool.shutdown()
+
+    return [results[sample['id']] for sample in samples]
+
+def build_pipeline_steps(config, base_dir, paths, samples, fasta_file, gtf_file, counts_dir):
+    """
+    Declara el DAG del workflow desde FASTQ (entradas, salidas y parámetros de cada paso) para el
+    planificador de run_planner.py. Refleja la misma estructura de carpetas que usa main().
+    """
+    setup_params = config.get("project_setup", {})
+    tool_params = config.get("tool_parameters", {})
+    images = config.get("container_images", {})
+    seq_type = setup_params.get("sequencing_type", "paired-end").lower()
+    quant_options = setup_params.get("quantification_options", {})
+    use_index_cache = tool_params.get("index_cache", {}).get("enabled", False)
+    star_config = tool_params.get("star", {})
+    reference_dir = paths['reference_dir']
+    steps = []
+
+    # --- Índices ---
+    index_sentinels = {}
+    for aligner in paths['aligners_to_run']:
+        if aligner == "STAR":
+            star_index_dir = os.path.join(reference_dir, "STAR_INDEX") if use_index_cache else reference_dir
+            if not use_index_cache:
+                steps.append(make_step("star_index", inputs=[fasta_file, gtf_file],
+                                       outputs=[os.path.join(reference_dir, f) for f in ("SA", "SAindex", "Genome")],
+                                       params={'sjdbOverhang': star_config.get("sjdbOverhang", 99), 'image': images.get("star")}))
+            index_sentinels["STAR"] = os.path.join(star_index_dir, "SA")
+            if star_config.get("cohort_two_pass", False):
+                second_pass_sa = os.path.join(reference_dir, "STAR_INDEX_2PASS", "SA")
+                steps.append(make_step("star_index_2pass", inputs=[index_sentinels["STAR"], gtf_file], outputs=[second_pass_sa],
+                                       params={**{k: v for k, v in star_config.items() if k.startswith("two_pass_")},
+                                               'samples': sorted(s['id'] for s in samples)}))
+                index_sentinels["STAR"] = second_pass_sa
+        elif aligner == "HISAT2":
+            prefix = os.path.basename(os.path.splitext(fasta_file)[0]) if fasta_file else "genome"
+            index_prefix = os.path.join(os.path.join(reference_dir, "HISAT2_INDEX") if use_index_cache else reference_dir, prefix)
+            if not use_index_cache:
+                steps.append(make_step("hisat2_index", inputs=[fasta_file, gtf_file],
+                                       outputs=[f"{index_prefix}.{i}.ht2" for i in range(1, 9)],
+                                       params={'image': images.get("hisat2")}))
+            index_sentinels["HISAT2"] = f"{index_prefix}.1.ht2"
+        elif aligner in PSEUDO_ALIGNERS:
+            index_dir = os.path.join(reference_dir, f"{aligner}_INDEX")
+            sentinel = os.path.join(index_dir, "versionInfo.json" if aligner == "SALMON" else KALLISTO_INDEX_FILE)
+            if not use_index_cache:
+                steps.append(make_step(f"{aligner.lower()}_index", inputs=[gtf_file], outputs=[sentinel],
+                                       params={'transcriptome_url': config.get("source_data", {}).get("transcriptome_url"),
+                                               'kmer_size': tool_params.get(aligner.lower(), {}).get("kmer_size", 31),
+                                               'image': images.get(aligner.lower())}))
+            index_sentinels[aligner] = sentinel
+
+    # --- Muestras: trimming (intermedio purgable) y alineamiento/cuantificación ---
+    for sample in samples:
+        files = get_sample_file_paths(sample, config, paths)
+        trimmed = [files['r1_trimmed'], files['r2_trimmed']]
+        steps.append(make_step(f"trim:{sample['id']}",
+                               inputs=[files['r1_raw'], files['r2_raw'], files['r1_raw_gz'], files['r2_raw_gz']],
+                               outputs=trimmed, temporary_outputs=trimmed,
+                               params={'trimmomatic': tool_params.get("trimmomatic", {}), 'image': images.get("trimmomatic")}))
+        for aligner in paths['aligners_to_run']:
+            if aligner == "STAR":
+                align_params = {k: v for k, v in star_config.items() if k not in ("shared_memory_genome", "limitBAMsortRAM")}
+            elif aligner == "HISAT2":
+                align_params = {k: v for k, v in tool_params.get("hisat2", {}).items() if k not in ("sort_memory_per_thread", "sort_tmp_dir")}
+            else:
+                align_params = tool_params.get(aligner.lower(), {})
+            steps.append(make_step(f"align_{aligner}:{sample['id']}", inputs=trimmed + [index_sentinels.get(aligner)],
+                                   outputs=[sample_final_output(paths, aligner, sample['id'])],
+                                   params={'aligner': align_params, 'seq_type': seq_type, 'image': images.get(aligner.lower())}))
+
+    # --- Agregación por alineador ---
+    for aligner in paths['aligners_to_run']:
+        final_outputs = [sample_final_output(paths, aligner, sample['id']) for sample in samples]
+        counts_file = os.path.join(counts_dir, f"counts_{aligner}.txt")
+        if aligner in PSEUDO_ALIGNERS:
+            steps.append(make_step(f"counts_{aligner}", inputs=final_outputs + [gtf_file],
+                                   outputs=[counts_file, os.path.join(counts_dir, f"{aligner}_tpm_matrix.tsv")]))
+        else:
+            quant_methods = quant_options.get("run_for", {}).get(aligner.lower(), [])
+            if quant_methods:
+                stringtie_dir = os.path.join(base_dir, f"STRINGTIE_{aligner}")
+                abund_files = [os.path.join(stringtie_dir, sample['id'], "gene_abundances.tsv") for sample in samples]
+                for sample, bam_file, abund_file in zip(samples, final_outputs, abund_files):
+                    steps.append(make_step(f"stringtie_{aligner}:{sample['id']}", inputs=[bam_file, gtf_file], outputs=[abund_file],
+                                           params={'image': images.get("stringtie")}))
+                steps.append(make_step(f"matrices_{aligner}", inputs=abund_files,
+                                       outputs=[os.path.join(counts_dir, f"{aligner}_{m}_matrix.tsv") for m in quant_methods],
+                                       params={'methods': quant_methods}))
+            steps.append(make_step(f"featurecounts_{aligner}", inputs=final_outputs + [gtf_file], outputs=[counts_file],
+                                   params={'featurecounts': tool_params.get("featurecounts", {}), 'seq_type': seq_type,
+                                           'image': images.get("featurecounts")}))
+        steps.append(make_step(f"deseq2_{aligner}", inputs=[counts_file, config.get("deseq2_experiment", {}).get("metadata_path")],
+                               outputs=[os.path.join(base_dir, f"DESEQ2_RESULTS_{aligner}")],
+                               params={'deseq2': config.get("deseq2_experiment", {}), 'annotation': config.get("annotation", {}),
+                                       'thresholds': tool_params.get("analysis_thresholds", {}),
+                                       'functional': config.get("functional_analysis", {}), 'image': images.get("r_deseq2")}))
+    return steps
+
+
 # ==============================================================================
 # SECCIÓN 3: FUNCIÓN PRINCIPAL Y ORQUESTACIÓN (CORREGIDA)
 # ==============================================================================
@@ -1033,6 +2034,7 @@ def main():
     """Función principal que orquesta todo el pipeline."""
     parser = argparse.ArgumentParser(description="Pipeline de RNA-seq de extremo a extremo")
     parser.add_argument("-c", "--config", required=True, help="Archivo de configuración JSON.")
+    parser.add_argument("--dry-run", action="store_true", help="Muestra el plan de ejecución (pasos obsoletos/pendientes) y termina sin ejecutar nada.")
     args = parser.parse_args()
     
     try:
@@ -1043,6 +2045,12 @@ def main():
     base_dir = config.get("project_setup", {}).get("base_dir", ".")
     create_directory(base_dir)
     setup_logging(os.path.join(base_dir, "pipeline.log"))
+
+    # Telemetría: un registro JSON-lines por invocación de herramienta y un resumen por muestra y etapa al salir.
+    if config.get("tool_parameters", {}).get("telemetry", True):
+        profile_file = os.path.join(base_dir, "run_profile.jsonl")
+        configure_telemetry(profile_file)
+        atexit.register(summarize_run_profile, profile_file, os.path.join(base_dir, "run_profile_stages.jsonl"))
     
     logging.info("="*60 + "\n🚀 INICIANDO PIPELINE DE RNA-SEQ 🚀\n" + "="*60)
 
@@ -1052,12 +2060,26 @@ def main():
     tool_params = config.get("tool_parameters", {})
     threads = tool_params.get("threads", 8)
     download_threads = tool_params.get("download_threads", 8)
+    # Asignación real del job (SLURM / cgroups / nodo). Con 'resources.auto' sustituye a los hilos fijos del JSON.
+    resources_config = tool_params.get("resources", {})
+    auto_resources = resources_config.get("auto", False)
+    resources = detect_resources(resources_config)
+    if auto_resources:
+        threads = resources['cpus']
+        logging.info(f"🧮 Recursos del job ({resources['source']}): {threads} CPUs, {resources['memory_bytes'] / GiB:.1f} GB utilizables.")
+    elif threads > resources['cpus']:
+        logging.warning(f"⚠️ 'threads' ({threads}) supera las CPUs asignadas ({resources['cpus']}): habrá sobresuscripción. "
+                        f"'resources.auto: true' ajusta los hilos a la asignación.")
+    download_config = tool_params.get("downloads", {})
     counting_method = setup_params.get("counting_method", "featureCounts").lower()
 
     # =======================================================================
     # === LÓGICA CONDICIONAL PARA DISTINGUIR EL TIPO DE WORKFLOW ===
     # =======================================================================
 
+    if counting_method == "precomputed_csv" and args.dry_run:
+        logging.info("ℹ️  --dry-run: el workflow desde matriz precalculada no tiene pasos planificables."); return
+
     if counting_method == "precomputed_csv":
         # --- CAMINO A: Workflow desde Matriz de Conteos Precalculada ---
         logging.info("\n" + "="*20 + " INICIANDO WORKFLOW DESDE MATRIZ PRECALCULADA " + "="*20)
@@ -1076,10 +2098,10 @@ def main():
         if not gtf_urls:
             logging.error("❌ No se encontró una URL de archivo GTF en el JSON. Es necesario para la anotación."); return
 
-        run_parallel_downloads(gtf_urls, reference_dir, download_threads)
+        run_parallel_downloads(gtf_urls, reference_dir, download_threads, download_config)
         
         with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
-            unzip_files_parallel(reference_dir, executor)
+            unzip_files_parallel(reference_dir, executor, threads)
         
         _, gtf_file = get_reference_files(reference_dir)
         if not gtf_file:
@@ -1089,9 +2111,11 @@ def main():
         if not matrix_url:
             logging.error("❌ 'counting_method' es 'precomputed_csv' pero no se proveyó 'count_matrix_url'."); return
         
-        counts_file_path = download_and_prepare_matrix(matrix_url, counts_dir)
+        counts_file_path = download_and_prepare_matrix(matrix_url, counts_dir, download_config, source_params.get("matrix_max_memory_mb", 256),
+                                                       setup_params.get("quantification_options", {}).get("matrix_binary_format"))
         if not counts_file_path:
             logging.error("❌ No se pudo preparar la matriz de conteos. Abortando."); return
+        export_matrix_stores([counts_file_path], setup_params.get("quantification_options", {}))
 
         logging.info("\n--- PASO 2: Análisis de Expresión Diferencial (DESeq2) ---")
         run_deseq2(config, deseq2_dir, counts_file_path, gtf_file)
@@ -1117,16 +2141,47 @@ def main():
         # --- FASE 1: PREPARACIÓN DE RECURSOS GLOBALES (Genoma, Índices, Adaptadores) ---
         logging.info("\n--- FASE 1: Preparando Genoma y construyendo Índices ---")
         
-        run_parallel_downloads(source_params.get("genome_urls", []), reference_dir, download_threads)
+        # Pseudoalineamiento (Salmon/kallisto): índice de transcriptoma en lugar de genoma, sin BAMs.
+        pseudo_mode = counting_method.upper() in PSEUDO_ALIGNERS
+        aligner_choice = setup_params.get("aligner", "star").lower()
+        if pseudo_mode:
+            logging.info(f"🧠 'counting_method' = {counting_method}: cuantificación por pseudoalineamiento (se ignora 'aligner').")
+            aligners_to_run = [counting_method.upper()]
+        else:
+            aligners_to_run = ["STAR", "HISAT2"] if aligner_choice == "both" else [aligner_choice.upper()] if aligner_choice in ["star", "hisat2"] else []
+
+        # Planificador DAG: invalida exactamente el subgrafo obsoleto antes de que la reanudación por "existe" actúe.
+        planner_config = tool_params.get("planner", {})
+        if args.dry_run or planner_config.get("enabled", False):
+            plan_paths = {'fastq_dir': fastq_dir, 'trimmed_dir': trimmed_dir, 'reference_dir': reference_dir, 'aligners_to_run': aligners_to_run}
+            for aligner in aligners_to_run:
+                plan_paths[f'alignments_dir_{aligner}'] = os.path.join(base_dir, f"QUANT_{aligner}" if aligner in PSEUDO_ALIGNERS else f"ALIGMENTS_{aligner}")
+            fastq_list_path = source_params.get("fastq_list_file")
+            plan_samples = group_fastqs_into_samples(read_urls_from_file(fastq_list_path), setup_params.get("sequencing_type", "paired-end").lower()) if fastq_list_path else []
+            planned_fasta, planned_gtf = get_reference_files(reference_dir)
+            full_hash_max_mb = planner_config.get("full_hash_max_mb", 512)
+            steps = build_pipeline_steps(config, base_dir, plan_paths, plan_samples, planned_fasta, planned_gtf, counts_dir)
+            plan = plan_run(steps, load_manifest(base_dir), full_hash_max_mb)
+            logging.info("🗺️  Plan de ejecución:\n" + format_plan(plan))
+            if args.dry_run:
+                return
+            removed = invalidate_stale_outputs(plan)
+            if removed:
+                logging.info(f"♻️  {removed} salidas obsoletas eliminadas: se regenerarán en esta ejecución.")
+            atexit.register(lambda: record_manifest(base_dir, build_pipeline_steps(config, base_dir, plan_paths, plan_samples, *get_reference_files(reference_dir), counts_dir), full_hash_max_mb))
+        transcriptome_url = source_params.get("transcriptome_url")
+        genome_urls = source_params.get("genome_urls", [])
+        if pseudo_mode and transcriptome_url:
+            # Con el transcriptoma dado, del genoma solo hace falta el GTF (relación transcrito -> gen y anotación).
+            genome_urls = [url for url in genome_urls if url.endswith((".gtf.gz", ".gtf"))]
+
+        run_parallel_downloads(genome_urls, reference_dir, download_threads, download_config)
         with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
-            unzip_files_parallel(reference_dir, executor)
+            unzip_files_parallel(reference_dir, executor, threads)
         
         fasta_file, gtf_file = get_reference_files(reference_dir)
-        if not fasta_file or not gtf_file:
+        if not gtf_file or (not fasta_file and not (pseudo_mode and transcriptome_url)):
             logging.error("❌ No se encontraron archivos FASTA y/o GTF. Abortando."); return
-
-        aligner_choice = setup_params.get("aligner", "star").lower()
-        aligners_to_run = ["STAR", "HISAT2"] if aligner_choice == "both" else [aligner_choice.upper()] if aligner_choice in ["star", "hisat2"] else []
         
         # Diccionario 'paths' para pasar a los workers
         paths = {
@@ -1134,32 +2189,75 @@ def main():
             'fastqc_dir': fastqc_dir, 
             'trimmed_dir': trimmed_dir,
             'reference_dir': reference_dir,
+            'star_index_dir': reference_dir,
             'aligners_to_run': aligners_to_run
         }
         
-        with concurrent.futures.ProcessPoolExecutor(max_workers=len(aligners_to_run) or 1) as executor:
+        # Caché global de índices: proyectos con el mismo FASTA/GTF/versión reutilizan el índice vía symlink.
+        index_cache_config = tool_params.get("index_cache", {})
+        use_index_cache = index_cache_config.get("enabled", False)
+
+        # Las construcciones simultáneas se reparten los hilos; si no caben juntas en memoria, van de una en una.
+        if auto_resources:
+            index_threads, concurrent_builds = plan_index_builds(
+                {a: index_build_memory(a, fasta_file if a in ("STAR", "HISAT2") else None) for a in aligners_to_run}, resources)
+            logging.info(f"🧮 Índices: {', '.join(f'{a}={t} hilos' for a, t in index_threads.items())} ({concurrent_builds} a la vez).")
+        else:
+            index_threads, concurrent_builds = {a: threads for a in aligners_to_run}, len(aligners_to_run) or 1
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=concurrent_builds) as executor:
             futures = []
             if "STAR" in aligners_to_run:
                 alignments_dir_star = os.path.join(base_dir, "ALIGMENTS_STAR")
                 create_directory(alignments_dir_star)
                 paths['alignments_dir_STAR'] = alignments_dir_star
-                futures.append(executor.submit(build_star_index, fasta_file, gtf_file, reference_dir, images.get("star"), threads, tool_params.get("star", {}).get("sjdbOverhang", 99)))
+                sjdb_overhang = tool_params.get("star", {}).get("sjdbOverhang", 99)
+                if use_index_cache:
+                    paths['star_index_dir'] = os.path.join(reference_dir, "STAR_INDEX")
+                    futures.append(executor.submit(build_star_index_cached, fasta_file, gtf_file, paths['star_index_dir'], images.get("star"), index_threads["STAR"], sjdb_overhang, index_cache_config))
+                else:
+                    futures.append(executor.submit(build_star_index, fasta_file, gtf_file, reference_dir, images.get("star"), index_threads["STAR"], sjdb_overhang))
             if "HISAT2" in aligners_to_run:
                 alignments_dir_hisat2 = os.path.join(base_dir, "ALIGMENTS_HISAT2")
                 create_directory(alignments_dir_hisat2)
                 paths['alignments_dir_HISAT2'] = alignments_dir_hisat2
-                paths['hisat2_index_prefix'] = os.path.join(reference_dir, os.path.splitext(os.path.basename(fasta_file))[0])
-                futures.append(executor.submit(build_hisat2_index, fasta_file, gtf_file, paths['hisat2_index_prefix'], images.get("hisat2")))
+                hisat2_index_dir = os.path.join(reference_dir, "HISAT2_INDEX") if use_index_cache else reference_dir
+                paths['hisat2_index_prefix'] = os.path.join(hisat2_index_dir, os.path.splitext(os.path.basename(fasta_file))[0])
+                if use_index_cache:
+                    futures.append(executor.submit(build_hisat2_index_cached, fasta_file, gtf_file, paths['hisat2_index_prefix'], images.get("hisat2"), index_cache_config,
+                                                   index_threads["HISAT2"]))
+                else:
+                    futures.append(executor.submit(build_hisat2_index, fasta_file, gtf_file, paths['hisat2_index_prefix'], images.get("hisat2"), index_threads["HISAT2"]))
+            if pseudo_mode:
+                quantifier = aligners_to_run[0]
+                quant_dir = os.path.join(base_dir, f"QUANT_{quantifier}")
+                create_directory(quant_dir)
+                paths[f'alignments_dir_{quantifier}'] = quant_dir
+                paths['pseudo_index_dir'] = os.path.join(reference_dir, f"{quantifier}_INDEX")
+                futures.append(executor.submit(prepare_pseudo_index, quantifier, fasta_file, gtf_file, transcriptome_url, paths['pseudo_index_dir'],
+                                               images, index_threads[quantifier], tool_params.get(quantifier.lower(), {}), download_config,
+                                               index_cache_config if use_index_cache else None))
             concurrent.futures.wait(futures)
+            for future in futures:
+                if future.exception():
+                    logging.error(f"❌ Error preparando los índices de los alineadores: {future.exception()}"); return
+            if use_index_cache:
+                # El maestro hereda el cerrojo de uso de los workers antes de que terminen y lo mantiene toda la
+                # ejecución (incluidas las tareas SLURM): otro proyecto no puede expulsar estos índices mientras tanto.
+                for index_path in (paths.get('star_index_dir'), os.path.dirname(paths.get('hisat2_index_prefix', "")), paths.get('pseudo_index_dir')):
+                    if index_path: hold_index_entry(index_path)
 
         logging.info("👍 Índices de alineadores construidos.")
-        paths['adapters_file'] = prepare_adapters(base_dir, tool_params.get("trimmomatic", {}).get("adapter_fasta_url"))
+        paths['adapters_file'] = prepare_adapters(base_dir, tool_params.get("trimmomatic", {}).get("adapter_fasta_url"), download_config)
 
         # --- FASE 2: PROCESAMIENTO DE MUESTRAS EN PARALELO ---
         logging.info("\n--- FASE 2: Procesando todas las muestras en paralelo ---")
         
         fastq_list_path = source_params.get("fastq_list_file")
         fastq_urls = read_urls_from_file(fastq_list_path) if fastq_list_path else []
+        paths['fastq_md5'] = load_md5_map(md5_list_path_for(fastq_list_path)) if fastq_list_path else {}
+        if paths['fastq_md5']:
+            logging.info(f"🔐 Se verificarán {len(paths['fastq_md5'])} FASTQ contra los MD5 de ENA.")
         seq_type = setup_params.get("sequencing_type", "paired-end").lower()
         samples_to_process = group_fastqs_into_samples(fastq_urls, seq_type)
 
@@ -1169,9 +2267,53 @@ def main():
         logging.info(f"Se procesarán {len(samples_to_process)} muestras.")
         
         max_parallel_samples = tool_params.get("max_parallel_samples", 4)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_parallel_samples) as executor:
-            worker_func = partial(pipeline_worker_for_sample, config=config, paths=paths)
-            results = list(executor.map(worker_func, samples_to_process))
+        if auto_resources and tool_params.get("executor", {}).get("backend", "local").lower() != "slurm":
+            # Hilos por muestra y muestras en paralelo según la memoria de cada alineador (índice + ordenado BAM).
+            shared_genome = "STAR" in aligners_to_run and tool_params.get("star", {}).get("shared_memory_genome", False)
+            memory_model, shared_bytes = sample_memory_model(tool_params, paths, aligners_to_run, shared_genome)
+            scheduler_config = tool_params.get("stage_scheduler", {})
+            if scheduler_config.get("enabled", False):
+                shared_bytes += scheduler_config.get("qc_slots", 2) * QC_STAGE_BYTES
+            threads_per_sample, max_parallel_samples = plan_sample_slots(resources, memory_model, len(samples_to_process), shared_bytes,
+                                                                         tool_params.get("threads_per_sample", 2), resources_config.get("max_parallel_samples"))
+            # Los workers leen estos valores del config.
+            config["tool_parameters"] = tool_params
+            tool_params["threads_per_sample"], tool_params["max_parallel_samples"] = threads_per_sample, max_parallel_samples
+            logging.info(f"🧮 Muestras: {max_parallel_samples} en paralelo x {threads_per_sample} hilos "
+                         f"(~{memory_model(threads_per_sample) / GiB:.1f} GB por muestra, {shared_bytes / GiB:.1f} GB compartidos).")
+
+        # STAR dos pasadas de cohorte: la segunda pasada alinea contra un índice re-generado una sola vez.
+        if "STAR" in aligners_to_run and tool_params.get("star", {}).get("cohort_two_pass", False):
+            second_pass_index = run_star_cohort_two_pass(samples_to_process, config, paths, fasta_file, gtf_file, threads)
+            if not second_pass_index:
+                logging.error("❌ Falló la primera pasada STAR de cohorte. Abortando."); return
+            paths['star_index_dir'] = second_pass_index
+
+        executor_config = tool_params.get("executor", {})
+        use_slurm = executor_config.get("backend", "local").lower() == "slurm"
+
+        # Genoma STAR en memoria compartida: una sola copia para todas las muestras concurrentes.
+        star_shared_prefix = os.path.join(paths.get('alignments_dir_STAR', base_dir), "_genomeLoad_")
+        if use_slurm and tool_params.get("star", {}).get("shared_memory_genome", False):
+            # La memoria compartida es local al nodo maestro: las tareas del array no la verían.
+            logging.warning("⚠️ 'shared_memory_genome' no aplica con el backend SLURM: cada tarea cargará su propio índice.")
+        elif "STAR" in aligners_to_run and tool_params.get("star", {}).get("shared_memory_genome", False):
+            paths['star_shared_genome'] = manage_star_shared_genome(paths['star_index_dir'], images.get("star"), "LoadAndExit", star_shared_prefix)
+            if not paths['star_shared_genome']:
+                logging.warning("⚠️ No se pudo cargar el genoma en memoria compartida. Cada muestra cargará su propia copia.")
+
+        try:
+            if use_slurm:
+                results = run_samples_on_slurm(samples_to_process, config, paths, executor_config, check_sample_completed)
+            elif tool_params.get("stage_scheduler", {}).get("enabled", False):
+                results = run_staged_sample_scheduler(samples_to_process, config, paths)
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=max_parallel_samples) as executor:
+                    worker_func = partial(pipeline_worker_for_sample, config=config, paths=paths)
+                    results = list(executor.map(worker_func, samples_to_process))
+        finally:
+            if paths.get('star_shared_genome'):
+                manage_star_shared_genome(paths['star_index_dir'], images.get("star"), "Remove", star_shared_prefix)
 
         if any("ERROR" in res for res in results):
             logging.error("❌ Hubo errores durante el procesamiento de las muestras. Revisa el log. Abortando la fase de agregación."); return
@@ -1184,39 +2326,58 @@ def main():
         for aligner in aligners_to_run:
             logging.info(f"\n{'='*20} WORKFLOW PARA {aligner} {'='*20}")
             
-            alignments_dir = os.path.join(base_dir, f"ALIGMENTS_{aligner}")
+            alignments_dir = paths[f'alignments_dir_{aligner}']
+            counts_file = os.path.join(counts_dir, f"counts_{aligner}.txt")
+            matrix_prefix = os.path.join(counts_dir, f"{aligner}")
             
             # --- PASO 5.5 (Opcional): Cuantificación (StringTie) y Análisis Exploratorio ---
             quant_options = setup_params.get("quantification_options", {})
             eda_output_dir = None
-            if quant_options and quant_options.get("run_for", {}).get(aligner.lower()):
+            if aligner in PSEUDO_ALIGNERS:
+                # Conteos estimados (formato featureCounts) y TPM a nivel de gen, directamente desde Salmon/kallisto.
+                logging.info(f"\n--- PASO FINAL 1 ({aligner}): Agregación a nivel de gen ---")
+                if not aggregate_pseudo_quantification(alignments_dir, aligner, gtf_file, counts_file, f"{matrix_prefix}_tpm_matrix.tsv", threads):
+                    logging.error(f"❌ No se pudo generar la matriz de conteo de {aligner}. Abortando."); return
+                export_matrix_columnar(f"{matrix_prefix}_tpm_matrix.tsv", quant_options.get("matrix_binary_format"))
+                export_matrix_stores([f"{matrix_prefix}_tpm_matrix.tsv"], quant_options)
+            elif quant_options and quant_options.get("run_for", {}).get(aligner.lower()):
                 logging.info(f"\n--- PASO ADICIONAL ({aligner}): Cuantificación y EDA ---")
                 stringtie_dir = os.path.join(base_dir, f"STRINGTIE_{aligner}")
-                matrix_prefix = os.path.join(counts_dir, f"{aligner}")
-                run_stringtie_quantification(alignments_dir, gtf_file, stringtie_dir, images.get("stringtie"), threads)
+                failed_stringtie = run_stringtie_quantification(alignments_dir, gtf_file, stringtie_dir, images.get("stringtie"), threads,
+                                                                threads_per_sample=quant_options.get("stringtie_threads_per_sample"))
+                if failed_stringtie:
+                    logging.warning(f"⚠️ Las matrices de {aligner} se ensamblarán sin: {', '.join(failed_stringtie)}")
                 quant_methods = quant_options.get("run_for", {}).get(aligner.lower(), [])
                 if quant_methods:
-                    assemble_normalized_matrices(stringtie_dir, matrix_prefix, quant_methods)
+                    assemble_normalized_matrices(stringtie_dir, matrix_prefix, quant_methods, max_workers=threads,
+                                                 binary_format=quant_options.get("matrix_binary_format"))
+                    export_matrix_stores([f"{matrix_prefix}_{m}_matrix.tsv" for m in quant_methods], quant_options)
                 
-                if quant_options.get("run_exploratory_analysis", False):
-                    for matrix_type in quant_options.get("explore_on", []):
-                        matrix_file_to_explore = f"{matrix_prefix}_{matrix_type}_matrix.tsv"
-                        if os.path.exists(matrix_file_to_explore):
-                            eda_output_dir = os.path.join(base_dir, f"EDA_RESULTS_{aligner}_{matrix_type.upper()}")
-                            run_exploratory_analysis(config, matrix_file_to_explore, eda_output_dir)
-                        else:
-                            logging.warning(f"⚠️ No se encontró la matriz {matrix_file_to_explore} para EDA.")
+            if quant_options.get("run_exploratory_analysis", False) and \
+                    (aligner in PSEUDO_ALIGNERS or quant_options.get("run_for", {}).get(aligner.lower())):
+                for matrix_type in quant_options.get("explore_on", []):
+                    matrix_file_to_explore = f"{matrix_prefix}_{matrix_type}_matrix.tsv"
+                    if os.path.exists(matrix_file_to_explore):
+                        eda_output_dir = os.path.join(base_dir, f"EDA_RESULTS_{aligner}_{matrix_type.upper()}")
+                        run_exploratory_analysis(config, matrix_file_to_explore, eda_output_dir)
+                    else:
+                        logging.warning(f"⚠️ No se encontró la matriz {matrix_file_to_explore} para EDA.")
             
             # --- PASO 6: Conteo (featureCounts) ---
-            counts_file = os.path.join(counts_dir, f"counts_{aligner}.txt")
-            logging.info(f"\n--- PASO FINAL 1 ({aligner}): Conteo ---")
-            strand_val = tool_params.get("featurecounts", {}).get("strand_specific", 0)
-            generate_count_matrix(alignments_dir, gtf_file, counts_file, images.get("featurecounts"), seq_type, threads, strand_val)
+            if aligner not in PSEUDO_ALIGNERS:
+                logging.info(f"\n--- PASO FINAL 1 ({aligner}): Conteo ---")
+                strand_val = tool_params.get("featurecounts", {}).get("strand_specific", 0)
+                generate_count_matrix(alignments_dir, gtf_file, counts_file, images.get("featurecounts"), seq_type, threads, strand_val,
+                                      incremental=tool_params.get("featurecounts", {}).get("incremental", False))
+            export_matrix_columnar(counts_file, quant_options.get("matrix_binary_format"), featurecounts_format=True)
+            export_matrix_stores([counts_file], quant_options)
             
             # --- PASO 7: Análisis Diferencial (DESeq2) ---
             deseq2_dir = os.path.join(base_dir, f"DESEQ2_RESULTS_{aligner}")
             logging.info(f"\n--- PASO FINAL 2 ({aligner}): DESeq2 ---")
-            run_deseq2(config, deseq2_dir, counts_file, gtf_file)
+            # La matriz de Salmon/kallisto tiene el formato de featureCounts: el script de R la lee igual.
+            run_deseq2(config, deseq2_dir, counts_file, gtf_file,
+                       counting_method="featureCounts" if aligner in PSEUDO_ALIGNERS else None)
             # --- PASO 7.5: Visualizaciones y Reportes (Controlado por JSON), apagado encendido opciones de análisis de enrriquecimiento funcional y generacion pdf gprofiler
             func_config = config.get("functional_analysis", {})
 
@@ -1240,7 +2401,7 @@ def main():
                 paths_for_multiqc.append(eda_output_dir)
             run_multiqc(paths_for_multiqc, multiqc_dir, images.get("multiqc"))
 
-        if aligner_choice == "both":
+        if aligner_choice == "both" and not pseudo_mode:
             compare_and_analyze_workflows(config)
 
     logging.info("\n🎉 ENHORABUENA. Pipeline completado exitosamente. 🎉")
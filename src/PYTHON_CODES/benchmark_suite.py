@@ -0,0 +1,234 @@
+import os
+import sys
+import gzip
+import glob
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib.util
+
+# ==============================================================================
+# BENCHMARKS DE LAS RUTAS CALIENTES DEL PIPELINE (LADO PYTHON)
+# ==============================================================================
+# Genera fixtures sintéticos (FASTQ, GTF, gene_abundances.tsv de StringTie, matriz
+# estilo featureCounts y resultados DESeq2/g:Profiler) a escala configurable y mide
+# las funciones Python del core sin herramientas externas: la "descarga" de la matriz
+# se sirve desde una ruta local. Informa de MB/s y muestras/s para detectar regresiones.
+
+CHROMOSOMES = ["1", "2", "3", "X"]
+
+
+def load_pipeline_core():
+    """Importa 01_pipeline_core.py (su nombre no es un identificador Python válido)."""
+    core_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "01_pipeline_core.py")
+    spec = importlib.util.spec_from_file_location("pipeline_core", core_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(core_path))
+    spec.loader.exec_module(module)
+    return module
+
+
+# ------------------------------------------------------------------------------
+# Generadores de fixtures
+# ------------------------------------------------------------------------------
+
+def write_synthetic_fastq_gz(path, n_reads, read_length, rng):
+    bases = "ACGT"
+    quality = "I" * read_length
+    with gzip.open(path, 'wt', compresslevel=6) as f:
+        for i in range(n_reads):
+            seq = "".join(rng.choice(bases) for _ in range(read_length))
+            f.write(f"@SYN.{i} {i}/1\n{seq}\n+\n{quality}\n")
+
+
+def write_synthetic_gtf(path, n_genes, rng):
+    with open(path, 'w') as f:
+        f.write("#!genome-build SYNTHETIC\n")
+        for g in range(n_genes):
+            chrom = CHROMOSOMES[g % len(CHROMOSOMES)]
+            start = 1000 + g * 5000
+            strand = "+" if g % 2 == 0 else "-"
+            gene_id, tx_id = f"ENSSYN{g:011d}", f"ENSSYNT{g:010d}"
+            attrs = f'gene_id "{gene_id}"; gene_version "1"; gene_name "SYN{g}"; gene_biotype "protein_coding";'
+            f.write(f"{chrom}\tsynthetic\tgene\t{start}\t{start + 3000}\t.\t{strand}\t.\t{attrs}\n")
+            f.write(f"{chrom}\tsynthetic\ttranscript\t{start}\t{start + 3000}\t.\t{strand}\t.\t{attrs} transcript_id \"{tx_id}\";\n")
+            for e in range(3):
+                e_start = start + e * 1000
+                f.write(f"{chrom}\tsynthetic\texon\t{e_start}\t{e_start + 500}\t.\t{strand}\t.\t{attrs} transcript_id \"{tx_id}\"; exon_number \"{e + 1}\";\n")
+
+
+def write_stringtie_outputs(stringtie_dir, n_samples, n_genes, rng):
+    """Un gene_abundances.tsv por muestra, con el formato de 'stringtie -e -A' (incluye IDs duplicados)."""
+    for s in range(n_samples):
+        sample_dir = os.path.join(stringtie_dir, f"SAMPLE{s:04d}")
+        os.makedirs(sample_dir, exist_ok=True)
+        with open(os.path.join(sample_dir, "gene_abundances.tsv"), 'w') as f:
+            f.write("Gene ID\tGene Name\tReference\tStrand\tStart\tEnd\tCoverage\tFPKM\tTPM\n")
+            for g in range(n_genes):
+                chrom = CHROMOSOMES[g % len(CHROMOSOMES)]
+                start = 1000 + g * 5000
+                f.write(f"ENSSYN{g:011d}\tSYN{g}\t{chrom}\t+\t{start}\t{start + 3000}\t"
+                        f"{rng.random() * 50:.6f}\t{rng.random() * 100:.6f}\t{rng.random() * 200:.6f}\n")
+            # StringTie repite genes en varios loci: el ensamblado debe sumarlos.
+            for g in range(0, n_genes, 97):
+                f.write(f"ENSSYN{g:011d}\tSYN{g}\tY\t+\t1\t100\t1.000000\t1.000000\t1.000000\n")
+
+
+def write_featurecounts_matrix_gz(path, n_samples, n_genes, rng):
+    """Matriz con columnas de anotación de featureCounts, nombres con guiones (como en GEO) y comprimida."""
+    with gzip.open(path, 'wt') as f:
+        f.write("# Program:featureCounts v2.0.3; Command:\"featureCounts\" (sintético)\n")
+        f.write("Geneid\tChr\tStart\tEnd\tStrand\tLength\t" + "\t".join(f"SAMPLE-{s:04d}" for s in range(n_samples)) + "\n")
+        for g in range(n_genes):
+            counts = "\t".join(str(int(rng.expovariate(1 / 300))) for _ in range(n_samples))
+            f.write(f"ENSSYN{g:011d}\t1\t{1000 + g}\t{4000 + g}\t+\t3001\t{counts}\n")
+
+
+def write_deseq2_results(base_dir, n_genes, n_terms, rng, contrasts=("Tratado_vs_Control",)):
+    for aligner in ("STAR", "HISAT2"):
+        out_dir = os.path.join(base_dir, f"DESEQ2_RESULTS_{aligner}")
+        os.makedirs(out_dir, exist_ok=True)
+        for contrast in contrasts:
+            genes = rng.sample(range(n_genes * 2), n_genes)
+            with open(os.path.join(out_dir, f"Resultados_Significativos_{contrast}.txt"), 'w') as f:
+                f.write("gene_id\tsymbol\tbaseMean\tlog2FoldChange\tpadj\n")
+                for g in genes:
+                    f.write(f"ENSSYN{g:011d}\tSYN{g}\t{rng.random() * 1000:.3f}\t{rng.gauss(0, 2):.4f}\t{rng.random() * 0.05:.3e}\n")
+            terms = rng.sample(range(n_terms * 2), n_terms)
+            with open(os.path.join(out_dir, f"Analisis_Rutas_Enriquecidas_{contrast}.txt"), 'w') as f:
+                f.write("term_id\tterm_name\tsource\tp_value\tintersection_size\n")
+                for t in terms:
+                    f.write(f"GO:{t:07d}\tsynthetic term {t}\tGO:BP\t{rng.random() * 0.05:.3e}\t{rng.randint(3, 200)}\n")
+
+
+def directory_size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1024 ** 2
+    return sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(path) for f in fs) / 1024 ** 2
+
+
+# ------------------------------------------------------------------------------
+# Ejecución de benchmarks
+# ------------------------------------------------------------------------------
+
+def time_call(func, repeat, setup=None):
+    """Mejor tiempo (s) de 'repeat' ejecuciones; 'setup' se ejecuta antes de cada una sin cronometrar."""
+    timings = []
+    for _ in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmarks(core, workdir, n_samples, n_genes, n_reads, read_length, repeat, seed):
+    rng = random.Random(seed)
+    results = []
+
+    def record(name, seconds, input_mb, samples):
+        results.append({
+            'benchmark': name, 'seconds': round(seconds, 4), 'input_mb': round(input_mb, 2), 'samples': samples,
+            'mb_per_s': round(input_mb / seconds, 2) if seconds and input_mb else None,
+            'samples_per_s': round(samples / seconds, 2) if seconds and samples else None
+        })
+
+    # 1. group_fastqs_into_samples: agrupación de URLs R1/R2 (paired-end y single-end).
+    urls = [f"ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR{s:07d}/SRR{s:07d}_{r}.fastq.gz" for s in range(n_samples * 50) for r in (1, 2)]
+    rng.shuffle(urls)
+    url_mb = sum(len(u) + 1 for u in urls) / 1024 ** 2
+    record("group_fastqs_into_samples[paired-end]", time_call(lambda: core.group_fastqs_into_samples(urls, "paired-end"), repeat), url_mb, n_samples * 50)
+    record("group_fastqs_into_samples[single-end]", time_call(lambda: core.group_fastqs_into_samples(urls, "single-end"), repeat), url_mb, len(urls))
+
+    # 2. unzip_single_file: descompresión de un FASTQ.gz (se restaura el .gz antes de cada repetición).
+    fastq_dir = os.path.join(workdir, "FASTQ_FILES")
+    os.makedirs(fastq_dir, exist_ok=True)
+    fixture_gz = os.path.join(workdir, "fixture_1.fastq.gz")
+    write_synthetic_fastq_gz(fixture_gz, n_reads, read_length, rng)
+    target_gz = os.path.join(fastq_dir, "SAMPLE0000_1.fastq.gz")
+
+    def restore_gz():
+        if os.path.exists(target_gz[:-3]): os.remove(target_gz[:-3])
+        shutil.copyfile(fixture_gz, target_gz)
+    seconds = time_call(lambda: core.unzip_single_file(target_gz), repeat, setup=restore_gz)
+    record("unzip_single_file", seconds, directory_size_mb(target_gz[:-3]), 1)
+
+    # 3. assemble_normalized_matrices: matrices TPM y FPKM desde StringTie.
+    stringtie_dir = os.path.join(workdir, "STRINGTIE_STAR")
+    write_stringtie_outputs(stringtie_dir, n_samples, n_genes, rng)
+    counts_dir = os.path.join(workdir, "COUNTS")
+    os.makedirs(counts_dir, exist_ok=True)
+    seconds = time_call(lambda: core.assemble_normalized_matrices(stringtie_dir, os.path.join(counts_dir, "STAR"), ["tpm", "fpkm"]), repeat)
+    record("assemble_normalized_matrices[tpm+fpkm]", seconds, directory_size_mb(stringtie_dir), n_samples)
+
+    # 4. download_and_prepare_matrix: "descarga" local (sustituto de GEO) + estandarización.
+    matrix_gz = os.path.join(workdir, "GSE000000_RawReadCounts.tsv.gz")
+    write_featurecounts_matrix_gz(matrix_gz, n_samples, n_genes, rng)
+    matrix_out = os.path.join(workdir, "PRECOMPUTED")
+
+    def reset_matrix_dir():
+        shutil.rmtree(matrix_out, ignore_errors=True)
+    seconds = time_call(lambda: core.download_and_prepare_matrix(matrix_gz, matrix_out), repeat, setup=reset_matrix_dir)
+    with gzip.open(matrix_gz, 'rb') as f:
+        matrix_mb = len(f.read()) / 1024 ** 2
+    record("download_and_prepare_matrix", seconds, matrix_mb, n_samples)
+
+    # 5. compare_and_analyze_workflows: comparación STAR vs HISAT2 de genes y términos.
+    compare_base = os.path.join(workdir, "COMPARE")
+    write_deseq2_results(compare_base, n_genes // 4, max(n_genes // 40, 10), rng)
+    config = {"project_setup": {"base_dir": compare_base}}
+    seconds = time_call(lambda: core.compare_and_analyze_workflows(config), repeat)
+    record("compare_and_analyze_workflows", seconds, directory_size_mb(os.path.join(compare_base, "DESEQ2_RESULTS_STAR")) * 2, 1)
+
+    # 6. load_transcript_gene_map: índice de la anotación, en frío (una pasada por el GTF) y desde la caché .gtfidx.npz.
+    gtf_file = os.path.join(workdir, "synthetic.gtf")
+    write_synthetic_gtf(gtf_file, n_genes, rng)
+    gtf_mb = directory_size_mb(gtf_file)
+
+    def remove_gtf_index():
+        for path in glob.glob(f"{gtf_file}.gtfidx.npz*"): os.remove(path)
+    seconds = time_call(lambda: core.load_transcript_gene_map(gtf_file), repeat, setup=remove_gtf_index)
+    record("load_transcript_gene_map[cold]", seconds, gtf_mb, 1)
+    seconds = time_call(lambda: core.load_transcript_gene_map(gtf_file), repeat)
+    record("load_transcript_gene_map[cached]", seconds, gtf_mb, 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de las rutas calientes Python del pipeline con datos sintéticos.")
+    parser.add_argument("--samples", type=int, default=24, help="Número de muestras sintéticas.")
+    parser.add_argument("--genes", type=int, default=20000, help="Número de genes sintéticos.")
+    parser.add_argument("--reads", type=int, default=200000, help="Lecturas del FASTQ sintético.")
+    parser.add_argument("--read_length", type=int, default=100, help="Longitud de lectura del FASTQ sintético.")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticiones por benchmark (se informa el mejor tiempo).")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla de los datos sintéticos.")
+    parser.add_argument("--workdir", help="Directorio de trabajo (por defecto uno temporal que se borra al terminar).")
+    parser.add_argument("--json", help="Guarda los resultados en JSON para compararlos entre revisiones.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] - %(message)s")
+    core = load_pipeline_core()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="omnirna_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        print(f"INFO: Benchmarks con {args.samples} muestras, {args.genes} genes, {args.reads} lecturas (workdir: {workdir})", flush=True)
+        results = run_benchmarks(core, workdir, args.samples, args.genes, args.reads, args.read_length, args.repeat, args.seed)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'BENCHMARK':<42}{'TIEMPO(s)':>11}{'MB':>10}{'MB/s':>10}{'MUESTRAS/s':>12}")
+    for r in results:
+        print(f"{r['benchmark']:<42}{r['seconds']:>11.4f}{r['input_mb']:>10.2f}{(r['mb_per_s'] or 0):>10.2f}{(r['samples_per_s'] or 0):>12.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+        print(f"\nResultados guardados en: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ import pandas as pd
 import sys
 from io import StringIO
 
+from download_manager import md5_list_path_for
+from http_cache import cached_get, configure_http_cache
+
 def fetch_fastq_urls(project_id, output_file):
     """
     Se conecta al API de ENA para obtener las URLs de los archivos FASTQ
@@ -16,14 +19,14 @@ def fetch_fastq_urls(project_id, output_file):
         f"https://www.ebi.ac.uk/ena/portal/api/filereport?"
         f"accession={project_id}"
         f"&result=read_run"
-        f"&fields=run_accession,fastq_ftp"
+        f"&fields=run_accession,fastq_ftp,fastq_md5"
         f"&format=tsv"
         f"&download=true"
     )
     
     try:
         # Realizar la petición al API
-        response = requests.get(ENA_API_URL)
+        response = cached_get(ENA_API_URL, timeout=120)
         response.raise_for_status()  
         
         if not response.text.strip():
@@ -39,10 +42,14 @@ def fetch_fastq_urls(project_id, output_file):
             open(output_file, 'w').close()
             return
 
-        # Procesar las URLs
+        # Procesar las URLs (y sus MD5, en el mismo orden separado por ';')
         all_urls = []
-        for urls in df['fastq_ftp'].dropna():
-            all_urls.extend(urls.split(';'))
+        all_md5 = []
+        for _, row in df.dropna(subset=['fastq_ftp']).iterrows():
+            urls = row['fastq_ftp'].split(';')
+            md5s = str(row.get('fastq_md5', '') or '').split(';')
+            all_urls.extend(urls)
+            all_md5.extend(md5s if len(md5s) == len(urls) else [''] * len(urls))
             
         if not all_urls:
             print(f"AVISO: No se encontraron URLs de FASTQ para el proyecto {project_id}.")
@@ -52,8 +59,15 @@ def fetch_fastq_urls(project_id, output_file):
         with open(output_file, 'w') as f:
             for url in all_urls:
                 f.write(f"ftp://{url}\n")
+
+        # MD5 de ENA para que el pipeline verifique cada descarga.
+        md5_file = md5_list_path_for(output_file)
+        with open(md5_file, 'w') as f:
+            for url, md5 in zip(all_urls, all_md5):
+                if md5 and md5 != 'nan':
+                    f.write(f"ftp://{url}\t{md5}\n")
         
-        print(f"\n¡ÉXITO! Se ha generado el archivo '{output_file}' con {len(all_urls)} URLs.")
+        print(f"\n¡ÉXITO! Se ha generado el archivo '{output_file}' con {len(all_urls)} URLs (MD5 en '{md5_file}').")
 
     except requests.exceptions.RequestException as e:
         print(f"ERROR: Fallo en la conexión con el API de ENA: {e}")
@@ -67,8 +81,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generador automático de URLs de FASTQ a partir de un ID de proyecto SRA/GEO.")
     parser.add_argument("project_id", help="El ID del proyecto.")
     parser.add_argument("-o", "--output", help="Nombre del archivo de salida (opcional). Por defecto, se usará 'ID_DEL_PROYECTO_fastq_urls.txt'.")
+    parser.add_argument("--offline", action="store_true", help="Usa solo la caché HTTP local, sin acceder a la red.")
     
     args = parser.parse_args()
+    if args.offline:
+        configure_http_cache(offline=True)
     
     output_filename = args.output
     if not output_filename:
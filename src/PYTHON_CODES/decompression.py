@@ -0,0 +1,140 @@
+import os
+import gzip
+import zlib
+import struct
+import shutil
+import argparse
+import subprocess
+import concurrent.futures
+
+# ==============================================================================
+# DESCOMPRESIÓN GZIP CON VARIOS NÚCLEOS
+# ==============================================================================
+# Un FASTA de genoma .gz de varios GB se descomprimía en un solo núcleo (gzip + copyfileobj
+# con búfer de 16 KiB) mientras el resto del nodo esperaba. Orden de preferencia:
+#   1. BGZF (bloques gzip independientes, p. ej. salidas de bgzip): los bloques se
+#      descomprimen en paralelo con hilos (zlib libera el GIL) y se escriben en orden.
+#   2. pigz / igzip, si están en el PATH (igzip es varias veces más rápido que zlib; pigz
+#      descomprime en un hilo pero lee, escribe y calcula el CRC en otros).
+#   3. Módulo gzip de Python con un búfer grande.
+# OMNIRNA_DECOMPRESSOR=pigz|igzip|python fuerza el motor (útil para pruebas y comparativas).
+
+DECOMPRESSOR_ENV_VAR = "OMNIRNA_DECOMPRESSOR"
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BLOCKS_PER_THREAD = 64
+
+
+def external_decompressor(threads):
+    """Comando (lista) de pigz o igzip para descomprimir a stdout, o None si no hay ninguno."""
+    forced = os.environ.get(DECOMPRESSOR_ENV_VAR, "").lower()
+    candidates = {"pigz": ["pigz", "-d", "-c", "-p", str(threads)], "igzip": ["igzip", "-d", "-c", "-T", str(threads)]}
+    if forced == "python":
+        return None
+    for name in ([forced] if forced in candidates else ["pigz", "igzip"]):
+        if shutil.which(name):
+            return candidates[name]
+    return None
+
+
+def is_bgzf(path):
+    """True si el archivo empieza por un bloque BGZF (cabecera gzip con subcampo extra 'BC')."""
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def iter_bgzf_blocks(f):
+    """Devuelve (datos deflate, crc, tamaño descomprimido) de cada bloque BGZF del archivo."""
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:4] != BGZF_MAGIC:
+            raise ValueError("bloque BGZF mal formado")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = f.read(xlen)
+        block_size, pos = None, 0
+        while pos + 4 <= len(extra):
+            subfield_len = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == b"BC":
+                block_size = struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+            pos += 4 + subfield_len
+        if block_size is None:
+            raise ValueError("bloque gzip sin subcampo BC (no es BGZF)")
+        body = f.read(block_size - 12 - xlen)
+        if len(body) != block_size - 12 - xlen:
+            raise ValueError("archivo BGZF truncado")
+        crc, size = struct.unpack("<II", body[-8:])
+        yield body[:-8], crc, size
+
+
+def decode_bgzf_block(block):
+    data, crc, size = block
+    raw = zlib.decompress(data, -15)
+    if len(raw) != size or zlib.crc32(raw) != crc:
+        raise ValueError("CRC o tamaño incorrecto en un bloque BGZF")
+    return raw
+
+
+def decompress_bgzf(gz_path, out_path, threads):
+    """Descompresión paralela de BGZF: lotes de bloques repartidos entre hilos y escritos en orden."""
+    batch_size = max(1, threads) * BLOCKS_PER_THREAD
+    with open(gz_path, 'rb') as f_in, open(out_path, 'wb') as f_out, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        batch = []
+        for block in iter_bgzf_blocks(f_in):
+            batch.append(block)
+            if len(batch) == batch_size:
+                f_out.writelines(executor.map(decode_bgzf_block, batch)); batch = []
+        f_out.writelines(executor.map(decode_bgzf_block, batch))
+
+
+def decompress_gzip_file(gz_path, out_path, threads=1):
+    """
+    Descomprime 'gz_path' en 'out_path' (vía '<out_path>.tmp' y renombrado, para que una
+    descompresión interrumpida no pase por completa). Devuelve el motor utilizado.
+    """
+    tmp_path = f"{out_path}.tmp"
+    try:
+        if threads > 1 and not os.environ.get(DECOMPRESSOR_ENV_VAR) and is_bgzf(gz_path):
+            decompress_bgzf(gz_path, tmp_path, threads); engine = f"bgzf x{threads}"
+        elif (command := external_decompressor(threads)) is not None:
+            with open(tmp_path, 'wb') as f_out:
+                subprocess.run(command + [gz_path], stdout=f_out, stderr=subprocess.PIPE, check=True)
+            engine = command[0]
+        else:
+            with gzip.open(gz_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+            engine = "python"
+        os.replace(tmp_path, out_path)
+        return engine
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_bgzf(input_path, output_path, level=6, block_size=65280):
+    """Comprime en BGZF (bloques de <64 KiB y bloque EOF final), para pruebas sin bgzip."""
+    with open(input_path, 'rb') as f_in, open(output_path, 'wb') as f_out:
+        for chunk in iter(lambda: f_in.read(block_size), b""):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(chunk) + compressor.flush()
+            header = BGZF_MAGIC + b"\x00\x00\x00\x00\x00\xff" + struct.pack("<H", 6) + b"BC" + struct.pack("<HH", 2, len(data) + 25)
+            f_out.write(header + data + struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+        f_out.write(bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Descomprime un .gz con el motor más rápido disponible.")
+    parser.add_argument("gz_file")
+    parser.add_argument("-o", "--output", help="Archivo de salida (por defecto, sin la extensión .gz).")
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--make_bgzf", metavar="ENTRADA", help="En lugar de descomprimir, comprime ENTRADA en BGZF hacia gz_file.")
+    args = parser.parse_args()
+    if args.make_bgzf:
+        write_bgzf(args.make_bgzf, args.gz_file); print(f"BGZF escrito: {args.gz_file}")
+    else:
+        output = args.output or args.gz_file[:-3]
+        print(f"{output} (motor: {decompress_gzip_file(args.gz_file, output, args.threads)})")
@@ -0,0 +1,346 @@
+import os
+import sys
+import time
+import ftplib
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import urllib3
+import requests
+
+from http_cache import cached_get
+
+# ==============================================================================
+# SUBSISTEMA DE DESCARGAS: REANUDABLES, CON REINTENTOS Y VERIFICACIÓN MD5/CHECKSUMS
+# ==============================================================================
+# - Descarga sobre '<destino>.part' y renombra solo al terminar (y verificar): si el
+#   destino existe, está completo. Un .part de un job cancelado se reanuda.
+# - HTTP(S) reanuda con cabecera Range; FTP con el comando REST.
+# - Conexiones reutilizadas por host (una sesión/conexión FTP por hilo y host).
+# - Reintentos con espera exponencial y verificación contra el 'fastq_md5' de ENA o
+#   los CHECKSUMS (suma BSD) que Ensembl publica junto a cada genoma y GTF.
+
+CHUNK_SIZE = 1024 * 1024
+HTTP_CHUNK_SIZE = 64 * 1024
+RETRYABLE_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError,
+                    subprocess.CalledProcessError, OSError) + ftplib.all_errors
+_thread_state = threading.local()
+
+
+class DownloadError(Exception):
+    """Fallo definitivo de una descarga tras agotar los reintentos."""
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE * 8), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_bsd_sum(path):
+    """Suma BSD ('sum' de coreutils) en el formato normalizado de los CHECKSUMS de Ensembl: 'suma bloques'."""
+    checksum, blocks = subprocess.run(["sum", path], check=True, capture_output=True, text=True).stdout.split()[:2]
+    return f"{int(checksum)} {int(blocks)}"
+
+
+def parse_ensembl_checksums(text):
+    """Líneas 'suma bloques archivo' de un CHECKSUMS de Ensembl -> {archivo: 'suma bloques'}."""
+    checksums = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+            checksums[fields[2]] = f"{int(fields[0])} {int(fields[1])}"
+    return checksums
+
+
+def load_ensembl_checksums(urls):
+    """CHECKSUMS de las carpetas de Ensembl de 'urls' (uno por carpeta, vía caché HTTP) -> {archivo: 'suma bloques'}."""
+    checksums = {}
+    for directory in sorted({url.rsplit('/', 1)[0] for url in urls if "ensembl.org/pub/" in url}):
+        try:
+            response = cached_get(f"{directory}/CHECKSUMS")
+            response.raise_for_status()
+            checksums.update(parse_ensembl_checksums(response.text))
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"⚠️ No se pudo obtener {directory}/CHECKSUMS ({e}). Se descargará sin verificar.")
+    return checksums
+
+
+def md5_list_path_for(fastq_list_file):
+    """Ruta del TSV de MD5 asociado a una lista de URLs de FASTQ ('X_fastq_urls.txt' -> 'X_fastq_urls_md5.tsv')."""
+    return f"{os.path.splitext(fastq_list_file)[0]}_md5.tsv"
+
+
+def load_md5_map(md5_list_file):
+    """Lee el TSV 'url<TAB>md5' que genera data_conector.py; devuelve {nombre_archivo: md5}."""
+    md5_map = {}
+    if not md5_list_file or not os.path.exists(md5_list_file):
+        return md5_map
+    with open(md5_list_file, 'r') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) == 2 and fields[1]:
+                md5_map[os.path.basename(fields[0])] = fields[1].lower()
+    return md5_map
+
+
+def _get_http_session(host):
+    sessions = getattr(_thread_state, 'http_sessions', None)
+    if sessions is None:
+        sessions = _thread_state.http_sessions = {}
+    if host not in sessions:
+        sessions[host] = requests.Session()
+    return sessions[host]
+
+
+def _get_ftp_connection(host, timeout):
+    connections = getattr(_thread_state, 'ftp_connections', None)
+    if connections is None:
+        connections = _thread_state.ftp_connections = {}
+    ftp = connections.get(host)
+    if ftp is not None:
+        try:
+            ftp.voidcmd("NOOP")
+            return ftp
+        except ftplib.all_errors:
+            _drop_ftp_connection(host)
+    ftp = ftplib.FTP(host, timeout=timeout)
+    ftp.login()
+    ftp.voidcmd("TYPE I")
+    connections[host] = ftp
+    return ftp
+
+
+def _drop_ftp_connection(host):
+    connections = getattr(_thread_state, 'ftp_connections', {})
+    ftp = connections.pop(host, None)
+    if ftp is not None:
+        try: ftp.close()
+        except ftplib.all_errors: pass
+
+
+def _remote_size_after_416(response, url, session, timeout):
+    """Tamaño remoto tras un 416: 'Content-Range: bytes */N' o, si no viene, Content-Length de un HEAD."""
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    try:
+        head = session.head(url, allow_redirects=True, timeout=(10, timeout))
+        length = head.headers.get("Content-Length", "")
+        if head.ok and length.isdigit():
+            return int(length)
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+
+def _download_http(url, part_path, timeout):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    session = _get_http_session(urlparse(url).netloc)
+    with session.get(url, headers=headers, stream=True, timeout=(10, timeout)) as response:
+        if response.status_code != 416:
+            response.raise_for_status()
+            mode = 'ab' if offset and response.status_code == 206 else 'wb'
+            # read1 devuelve lo que ya ha llegado (hasta HTTP_CHUNK_SIZE) en lugar de esperar al bloque completo:
+            # si la conexión se corta, lo recibido hasta ese momento ya está en el .part y se reanuda desde ahí.
+            read_chunk = getattr(response.raw, "read1", response.raw.read)  # urllib3 < 2 no tiene read1
+            with open(part_path, mode) as f:
+                while True:
+                    chunk = read_chunk(HTTP_CHUNK_SIZE, decode_content=True)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            return
+        remote_size = _remote_size_after_416(response, url, session, timeout)
+    # 416: el rango pedido empieza en o después del final remoto. Solo es el archivo completo si los tamaños coinciden.
+    if remote_size == offset:
+        return
+    logging.warning(f"⚠️ {os.path.basename(part_path)} ({offset} bytes) no coincide con el tamaño remoto ({remote_size}). Se descarga de nuevo.")
+    os.remove(part_path)
+    _download_http(url, part_path, timeout)
+
+
+def _download_ftp(url, part_path, timeout):
+    parsed = urlparse(url)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    try:
+        ftp = _get_ftp_connection(parsed.hostname, timeout)
+        remote_size = ftp.size(parsed.path)
+        if remote_size is not None and offset == remote_size:
+            return
+        if remote_size is not None and offset > remote_size:
+            # Un .part mayor que el remoto viene de otra versión del archivo: no se puede reanudar.
+            logging.warning(f"⚠️ {os.path.basename(part_path)} ({offset} bytes) supera el tamaño remoto ({remote_size}). Se descarga de nuevo.")
+            os.remove(part_path)
+            offset = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            ftp.retrbinary(f"RETR {parsed.path}", f.write, blocksize=CHUNK_SIZE, rest=offset or None)
+    except ftplib.all_errors:
+        _drop_ftp_connection(parsed.hostname)
+        raise
+
+
+def _download_local(url, part_path, timeout):
+    """Rutas locales o 'file://' (modo manual): copia directa, también reanudable."""
+    source_path = urlparse(url).path if url.startswith("file://") else url
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    with open(source_path, 'rb') as f_in, open(part_path, 'ab' if offset else 'wb') as f_out:
+        f_in.seek(offset)
+        shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+
+
+def _download_wget(url, part_path, timeout):
+    subprocess.run(["wget", "-q", "-c", "-T", str(timeout), "-O", part_path, url], check=True, capture_output=True, text=True)
+
+
+def download_file(url, dest_path, expected_md5=None, download_config=None, expected_sum=None):
+    """
+    Descarga 'url' en 'dest_path' de forma reanudable y verificada (MD5 de ENA y/o suma BSD de los
+    CHECKSUMS de Ensembl). Devuelve 'SALTADO' si ya estaba completa u 'OK' si se descargó; lanza
+    DownloadError si falla tras los reintentos.
+    """
+    download_config = download_config or {}
+    retries = download_config.get("retries", 5)
+    backoff = download_config.get("backoff_seconds", 2)
+    timeout = download_config.get("timeout_seconds", 120)
+    verify_md5 = download_config.get("verify_md5", True) and bool(expected_md5)
+    part_path = f"{dest_path}.part"
+    # Verificaciones a aplicar: (marcador, valor esperado, función). Ensembl publica sumas BSD ('sum').
+    checks = [(f"{dest_path}.md5", expected_md5, file_md5)] if verify_md5 else []
+    if expected_sum and shutil.which("sum"):
+        checks.append((f"{dest_path}.sum", expected_sum, file_bsd_sum))
+
+    if os.path.exists(dest_path):
+        pending_checks = [check for check in checks if not os.path.exists(check[0])]
+        if not pending_checks:
+            return 'SALTADO'
+        # Archivo heredado (p. ej. de wget) sin verificar: se comprueba antes de reutilizarlo.
+        if all(func(dest_path) == expected for _, expected, func in pending_checks):
+            for marker, expected, _ in pending_checks:
+                with open(marker, 'w') as f: f.write(f"{expected}\n")
+            return 'SALTADO'
+        logging.warning(f"⚠️ {os.path.basename(dest_path)} no coincide con su checksum (¿truncado?). Se vuelve a descargar.")
+        os.remove(dest_path)
+
+    scheme = urlparse(url).scheme
+    if download_config.get("engine", "native") == "wget":
+        fetch = _download_wget
+    elif scheme == "ftp":
+        fetch = _download_ftp
+    elif scheme in ("http", "https"):
+        fetch = _download_http
+    elif scheme in ("", "file"):
+        fetch = _download_local
+    else:
+        raise DownloadError(f"Esquema de URL no soportado: {url}")
+
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            wait_seconds = min(backoff * 2 ** (attempt - 1), 300)
+            logging.warning(f"🔁 Reintento {attempt}/{retries} de {os.path.basename(dest_path)} en {wait_seconds}s ({last_error}).")
+            time.sleep(wait_seconds)
+        try:
+            fetch(url, part_path, timeout)
+        except RETRYABLE_ERRORS as e:
+            last_error = e
+            continue
+
+        mismatches = [f"{func.__name__} {actual} != {expected}" for _, expected, func in checks
+                      for actual in [func(part_path)] if actual != expected]
+        if mismatches:
+            last_error = "; ".join(mismatches)
+            os.remove(part_path)  # Un .part corrupto no se puede reanudar: se empieza de cero.
+            continue
+        for marker, expected, _ in checks:
+            with open(marker, 'w') as f: f.write(f"{expected}\n")
+        os.replace(part_path, dest_path)
+        return 'OK'
+
+    raise DownloadError(f"No se pudo descargar {url} tras {retries + 1} intentos: {last_error}")
+
+
+# ==============================================================================
+# SERVIDOR LOCAL DE PRUEBAS (sustituto offline de ENA/Ensembl)
+# ==============================================================================
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Servidor de archivos estático con soporte de 'Range' y cortes simulados de conexión."""
+    fail_after_bytes = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        range_header = self.headers.get('Range')
+        if os.path.isdir(path) or not range_header or not range_header.startswith('bytes='):
+            return super().send_head()
+        if not os.path.exists(path):
+            self.send_error(404, "File not found"); return None
+        size = os.path.getsize(path)
+        start = int(range_header[len('bytes='):].split('-')[0] or 0)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.fail_after_bytes is None:
+            return super().copyfile(source, outputfile)
+        # Envía solo 'fail_after_bytes' y corta la conexión para probar la reanudación.
+        outputfile.write(source.read(self.fail_after_bytes))
+        outputfile.flush()
+        self.close_connection = True
+
+
+def serve_directory(directory, port, fail_after_bytes=None):
+    handler = type("ConfiguredRangeHandler", (RangeRequestHandler,), {'fail_after_bytes': fail_after_bytes})
+    server = ThreadingHTTPServer(("127.0.0.1", port), lambda *a, **kw: handler(*a, directory=directory, **kw))
+    print(f"INFO: Sirviendo {directory} en http://127.0.0.1:{port}/ (Ctrl+C para detener)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Descargas reanudables y verificadas (y servidor local de pruebas).")
+    parser.add_argument("url", nargs="?", help="URL a descargar.")
+    parser.add_argument("-o", "--output", help="Ruta de destino (por defecto, el nombre del archivo en la URL).")
+    parser.add_argument("--md5", help="MD5 esperado del archivo.")
+    parser.add_argument("--retries", type=int, default=5, help="Número de reintentos.")
+    parser.add_argument("--serve", metavar="DIR", help="Modo servidor local: sirve DIR por HTTP con soporte de Range.")
+    parser.add_argument("--port", type=int, default=8000, help="Puerto del servidor local.")
+    parser.add_argument("--fail_after", type=int, help="(Servidor) corta cada respuesta tras N bytes para simular descargas truncadas.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] - %(message)s")
+
+    if args.serve:
+        serve_directory(os.path.abspath(args.serve), args.port, args.fail_after)
+    elif args.url:
+        output = args.output or os.path.basename(urlparse(args.url).path)
+        try:
+            status = download_file(args.url, output, args.md5, {"retries": args.retries})
+            print(f"{status}: {output}")
+        except DownloadError as e:
+            print(f"ERROR: {e}"); sys.exit(1)
+    else:
+        parser.print_help(); sys.exit(1)
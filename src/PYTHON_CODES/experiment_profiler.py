@@ -6,9 +6,14 @@ import argparse
 import sys
 import time
 import re
+import threading
+import concurrent.futures
 from xml.etree import ElementTree as ET
 import os
 
+from http_cache import cached_fetch, cached_get, cached_head, configure_http_cache
+from download_manager import load_ensembl_checksums
+
 try:
     from bs4 import BeautifulSoup, NavigableString
 except ImportError:
@@ -19,6 +24,7 @@ except ImportError:
 EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 GEO_BROWSE_URL = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi"
 ENA_API_URL = "https://www.ebi.ac.uk/ena/portal/api/filereport"
+ENSEMBL_BASE_URL = "https://ftp.ensembl.org/pub"
 
 # --- Base de datos de adaptadores comunes ---
 ADAPTER_SEQUENCES = {
@@ -27,10 +33,92 @@ ADAPTER_SEQUENCES = {
     "small rna": "TGGAATTCTCGG"
 }
 
-def api_request_xml(url: str):
+# --- Límites de NCBI: 3 peticiones/s sin API key, 10/s con ella (NCBI_API_KEY) ---
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY")
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_thread_state = threading.local()
+
+
+class TokenBucket:
+    """Limitador de tasa compartido entre hilos: 'rate' peticiones/s con ráfagas de hasta 'capacity'."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+NCBI_LIMITER = TokenBucket(10 if NCBI_API_KEY else 3)
+# Las páginas HTML de GEO (acc.cgi) no son E-utilities: la API key no les sube el límite, siguen en 3/s.
+GEO_LIMITER = TokenBucket(3)
+ENA_LIMITER = TokenBucket(10, capacity=5)
+
+
+def set_ncbi_api_key(api_key: str):
+    """Activa la API key de NCBI (parámetro 'api_key' en E-utilities y límite de 10 peticiones/s)."""
+    global NCBI_API_KEY, NCBI_LIMITER
+    NCBI_API_KEY = api_key
+    NCBI_LIMITER = TokenBucket(10)
+
+
+def _get_session() -> requests.Session:
+    """Una sesión por hilo: las conexiones keep-alive a NCBI/ENA se reutilizan entre peticiones."""
+    session = getattr(_thread_state, 'session', None)
+    if session is None:
+        session = _thread_state.session = requests.Session()
+    return session
+
+
+def http_request(url: str, params: dict = None, data: dict = None, timeout: int = 30, retries: int = 4) -> requests.Response:
+    """
+    GET (o POST si se pasa 'data') a través de la caché HTTP persistente. Si hay que ir a la red, se aplica
+    el límite de tasa por servicio y los reintentos con espera exponencial (429/5xx y errores de red).
+    """
+    ncbi = "ncbi.nlm.nih.gov" in url
+    limiter = GEO_LIMITER if url.startswith(GEO_BROWSE_URL) else NCBI_LIMITER if ncbi else ENA_LIMITER
+    params = dict(params or {})
+    if ncbi and NCBI_API_KEY and url.startswith(EUTILS_BASE_URL):
+        params["api_key"] = NCBI_API_KEY
+
+    def fetch(extra_headers):
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            try:
+                if data is None:
+                    response = _get_session().get(url, params=params, headers=extra_headers, timeout=timeout)
+                else:
+                    response = _get_session().post(url, params=params, data=data, headers=extra_headers, timeout=timeout)
+                if response.status_code not in RETRYABLE_STATUS or attempt == retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == retries:
+                    raise
+                delay = 2 ** attempt
+            time.sleep(delay)
+
+    return cached_fetch(fetch, "POST" if data is not None else "GET", url, params, data)
+
+
+def api_request_xml(url: str, params: dict = None, data: dict = None):
     try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
+        response = http_request(url, params=params, data=data)
         return ET.fromstring(response.content)
     except requests.exceptions.RequestException as e:
         print(f"ERROR: Fallo en la petición a la API: {e}")
@@ -61,7 +149,7 @@ def get_study_info_from_page(gse_id: str, first_gsm_id: str = None) -> dict:
     }
     try:
         if first_gsm_id:
-            gsm_response = requests.get(f"{GEO_BROWSE_URL}?acc={first_gsm_id}", timeout=30)
+            gsm_response = http_request(GEO_BROWSE_URL, params={"acc": first_gsm_id})
             gsm_soup = BeautifulSoup(gsm_response.text, 'lxml')
 
             def find_field_text(soup_obj, field_name):
@@ -79,7 +167,7 @@ def get_study_info_from_page(gse_id: str, first_gsm_id: str = None) -> dict:
             library_prep_text = find_field_text(gsm_soup, "Extraction protocol") or ""
         
         # Obtenemos Título y Resumen general de la página principal del estudio
-        gse_response = requests.get(f"{GEO_BROWSE_URL}?acc={gse_id}", timeout=30)
+        gse_response = http_request(GEO_BROWSE_URL, params={"acc": gse_id})
         gse_soup = BeautifulSoup(gse_response.text, 'lxml')
         info["title"] = find_field_text(gse_soup, "Title") or info["title"]
         info["summary"] = find_field_text(gse_soup, "Summary") or info["summary"]
@@ -105,16 +193,20 @@ def get_study_info_from_page(gse_id: str, first_gsm_id: str = None) -> dict:
         print(f"AVISO: No se pudieron extraer los metadatos: {e}")
     return info
 
+def get_gds_uid(gse_id: str) -> str | None:
+    """UID interno de la base 'gds' para un GSE (necesario para esummary/elink)."""
+    root = api_request_xml(f"{EUTILS_BASE_URL}esearch.fcgi", params={"db": "gds", "term": f"{gse_id}[Accession]"})
+    if root is None: return None
+    gds_id = root.find(".//Id")
+    return gds_id.text if gds_id is not None else None
+
 def get_gsm_list_from_gse(gse_id: str) -> list[dict]:
     """Obtiene la lista básica de muestras (GSM y Título) de un GSE."""
     print(f"INFO: 3/4 - Obteniendo lista de muestras (GSM) para {gse_id}...")
     samples = []
-    search_url = f"{EUTILS_BASE_URL}esearch.fcgi?db=gds&term={gse_id}[Accession]"
-    root = api_request_xml(search_url)
-    if root is None: return []
-    gds_id = root.find(".//Id")
-    if gds_id is None: return []
-    summary_url = f"{EUTILS_BASE_URL}esummary.fcgi?db=gds&id={gds_id.text}"
+    gds_uid = get_gds_uid(gse_id)
+    if gds_uid is None: return []
+    summary_url = f"{EUTILS_BASE_URL}esummary.fcgi?db=gds&id={gds_uid}"
     summary_root = api_request_xml(summary_url)
     if summary_root is None: return []
     for item in summary_root.findall(".//Item[@Name='Sample']"):
@@ -128,26 +220,180 @@ def get_gsm_list_from_gse(gse_id: str) -> list[dict]:
 def get_srr_from_gsm_page(gsm_id: str) -> str:
     """Visita la página de un GSM individual, extrae el SRX y lo convierte a SRR."""
     try:
-        gsm_url = f"{GEO_BROWSE_URL}?acc={gsm_id}"
-        response = requests.get(gsm_url, timeout=30)
-        response.raise_for_status()
+        response = http_request(GEO_BROWSE_URL, params={"acc": gsm_id})
         soup = BeautifulSoup(response.text, 'lxml')
         sra_link = soup.find('a', href=re.compile(r"term=SRX\d+"))
         if not sra_link: return "SRX not found"
         srx_id = sra_link.text.strip()
-        ena_url = f"{ENA_API_URL}?accession={srx_id}&result=read_run&fields=run_accession&format=tsv"
-        srr_response = requests.get(ena_url, timeout=30)
-        srr_response.raise_for_status()
+        srr_response = http_request(ENA_API_URL, params={"accession": srx_id, "result": "read_run", "fields": "run_accession", "format": "tsv"})
         srr_data = srr_response.text.strip().split('\n')
         if len(srr_data) > 1: return srr_data[1].strip()
         else: return "SRR not found"
     except Exception:
         return "Error"
 
+def parse_sra_experiment_packages(root) -> dict:
+    """De un efetch db=sra (EXPERIMENT_PACKAGE_SET) extrae {GSM: {'srx', 'study', 'runs'}}."""
+    packages = {}
+    for package in root.iter("EXPERIMENT_PACKAGE"):
+        experiment = package.find("EXPERIMENT")
+        if experiment is None: continue
+        # El GSM aparece como identificador externo 'GEO' de la muestra o como alias/título del experimento.
+        candidates = [el.text or "" for el in package.findall("SAMPLE/IDENTIFIERS/EXTERNAL_ID[@namespace='GEO']")]
+        candidates += [experiment.get("alias", ""), package.findtext("SAMPLE/IDENTIFIERS/SUBMITTER_ID") or "",
+                       package.find("SAMPLE").get("alias", "") if package.find("SAMPLE") is not None else "",
+                       experiment.findtext("TITLE") or ""]
+        gsm = next((m.group(0) for c in candidates for m in [re.search(r"GSM\d+", c)] if m), None)
+        if not gsm: continue
+        study = package.find("STUDY")
+        packages[gsm] = {
+            "srx": experiment.get("accession"),
+            "study": study.get("accession") if study is not None else None,
+            "runs": [run.get("accession") for run in package.findall("RUN_SET/RUN") if run.get("accession")]
+        }
+    return packages
+
+def resolve_srrs_bulk(gse_id: str, gsm_ids: list[str], batch_size: int = 200) -> dict:
+    """
+    Resuelve GSM -> SRX -> SRR para todo el GSE con unas pocas consultas agrupadas: elink gds->sra,
+    efetch db=sra por lotes de IDs y un filereport de ENA por estudio. Devuelve {GSM: SRR}; los GSM
+    que falten se resuelven después por la vía antigua (scraping de la página GEO).
+    """
+    gds_uid = get_gds_uid(gse_id)
+    if gds_uid is None: return {}
+    link_root = api_request_xml(f"{EUTILS_BASE_URL}elink.fcgi", params={"dbfrom": "gds", "db": "sra", "id": gds_uid})
+    if link_root is None: return {}
+    sra_uids = [el.text for el in link_root.findall(".//LinkSetDb/Link/Id")]
+    if not sra_uids: return {}
+
+    packages = {}
+    for start in range(0, len(sra_uids), batch_size):
+        # POST: listas largas de IDs no caben en la URL.
+        root = api_request_xml(f"{EUTILS_BASE_URL}efetch.fcgi", params={"db": "sra", "retmode": "xml"},
+                               data={"id": ",".join(sra_uids[start:start + batch_size])})
+        if root is not None:
+            packages.update(parse_sra_experiment_packages(root))
+
+    # ENA: un único filereport por estudio con el primer run de cada experimento (mismo criterio que por SRX).
+    first_run_by_srx = {}
+    for study in sorted({p["study"] for p in packages.values() if p["study"]}):
+        try:
+            response = http_request(ENA_API_URL, params={"accession": study, "result": "read_run",
+                                                         "fields": "run_accession,experiment_accession", "format": "tsv"})
+        except requests.exceptions.RequestException as e:
+            print(f"AVISO: No se pudo consultar ENA para {study}: {e}")
+            continue
+        lines = response.text.strip().split('\n')
+        header = lines[0].split('\t') if lines else []
+        if "run_accession" not in header or "experiment_accession" not in header: continue
+        run_col, exp_col = header.index("run_accession"), header.index("experiment_accession")
+        for line in lines[1:]:
+            fields = line.split('\t')
+            if len(fields) > max(run_col, exp_col):
+                first_run_by_srx.setdefault(fields[exp_col].strip(), fields[run_col].strip())
+
+    srr_map = {}
+    for gsm in gsm_ids:
+        package = packages.get(gsm)
+        if package is None: continue
+        srr = first_run_by_srx.get(package["srx"]) or (package["runs"][0] if package["runs"] else None)
+        srr_map[gsm] = srr or "SRR not found"
+    return srr_map
+
+def fetch_srrs_concurrently(gsm_ids: list[str], workers: int = 8) -> list[str]:
+    """Resuelve GSM -> SRR en paralelo; el ritmo lo marcan los limitadores, no el número de hilos. Conserva el orden."""
+    done = [0]
+    progress_lock = threading.Lock()
+
+    def resolve(gsm_id):
+        srr = get_srr_from_gsm_page(gsm_id)
+        with progress_lock:
+            done[0] += 1
+            print(f"      Procesadas {done[0]}/{len(gsm_ids)} muestras ({gsm_id})", end='\r')
+        return srr
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(resolve, gsm_ids))
+
+def list_ensembl_directory(url: str) -> list[str] | None:
+    """Nombres de archivo/carpeta del índice HTML de una carpeta de Ensembl (cacheado); None si no existe."""
+    try:
+        response = cached_get(url, timeout=30)
+        if response.status_code != 200: return None
+    except requests.exceptions.RequestException:
+        return None
+    return [name.rstrip('/') for name in re.findall(r'href="([^"?/][^"]*)"', response.text)]
+
+def latest_ensembl_release() -> str | None:
+    listing = list_ensembl_directory(f"{ENSEMBL_BASE_URL}/") or []
+    releases = [int(m.group(1)) for name in listing for m in [re.fullmatch(r"release-(\d+)", name)] if m]
+    return str(max(releases)) if releases else None
+
+def pick_ensembl_fasta(files: list[str], organism_filename: str, assembly_short_name: str) -> str | None:
+    """Prefiere el ensamblaje indicado y, dentro de él, 'primary_assembly' (solo existe en genomas grandes) sobre 'toplevel'."""
+    candidates = []
+    for name in files:
+        m = re.fullmatch(rf"{re.escape(organism_filename)}\.(.+)\.dna\.(primary_assembly|toplevel)\.fa\.gz", name, re.IGNORECASE)
+        if m:
+            candidates.append((m.group(1) != assembly_short_name, m.group(2) != "primary_assembly", name))
+    return min(candidates)[2] if candidates else None
+
+def pick_ensembl_gtf(files: list[str], organism_filename: str, assembly_short_name: str, release: str) -> str | None:
+    """GTF principal de la release (excluye las variantes .chr, .abinitio y .chr_patch_hapl_scaff)."""
+    candidates = []
+    for name in files:
+        m = re.fullmatch(rf"{re.escape(organism_filename)}\.(.+)\.{release}\.gtf\.gz", name, re.IGNORECASE)
+        if m:
+            candidates.append((m.group(1) != assembly_short_name, name))
+    return min(candidates)[1] if candidates else None
+
+def resolve_ensembl_release(release: str, organism_path: str, organism_filename: str, assembly_short_name: str) -> dict:
+    """Busca FASTA y GTF en una release: con el listado de sus carpetas o, si no está disponible, sondeando candidatos en paralelo."""
+    base_url = f"{ENSEMBL_BASE_URL}/release-{release}"
+    fasta_dir, gtf_dir = f"{base_url}/fasta/{organism_path}/dna", f"{base_url}/gtf/{organism_path}"
+    found = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        fasta_listing, gtf_listing = executor.map(list_ensembl_directory, [f"{fasta_dir}/", f"{gtf_dir}/"])
+
+    if fasta_listing is not None:
+        found["fasta"] = pick_ensembl_fasta(fasta_listing, organism_filename, assembly_short_name)
+    if gtf_listing is not None:
+        found["gtf"] = pick_ensembl_gtf(gtf_listing, organism_filename, assembly_short_name, release)
+
+    # Sin listado: HEAD concurrentes sobre los nombres esperados, en orden de preferencia.
+    probes = []
+    if fasta_listing is None:
+        probes += [("fasta", f"{organism_filename}.{assembly_short_name}.dna.{kind}.fa.gz") for kind in ("primary_assembly", "toplevel")]
+    if gtf_listing is None:
+        probes.append(("gtf", f"{organism_filename}.{assembly_short_name}.{release}.gtf.gz"))
+
+    def probe(item):
+        kind, filename = item
+        try:
+            return cached_head(f"{fasta_dir if kind == 'fasta' else gtf_dir}/{filename}").status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(probes))) as executor:
+        for (kind, filename), exists in zip(probes, executor.map(probe, probes)):
+            if exists and not found.get(kind):
+                found[kind] = filename
+
+    result = {}
+    for kind, directory in (("fasta", fasta_dir), ("gtf", gtf_dir)):
+        if found.get(kind):
+            checksums = load_ensembl_checksums([f"{directory}/{found[kind]}"])
+            result[kind] = f"{directory}/{found[kind]}"
+            result[f"{kind}_checksum"] = checksums.get(found[kind])
+    return result
+
 def find_ensembl_urls(organism: str, data_processing_text: str) -> dict:
-    """Construye y verifica los enlaces de descarga de Ensembl para el genoma y la anotación."""
+    """
+    Localiza en Ensembl el genoma y la anotación del estudio (release indicada en 'Data processing' o,
+    si no existen en ella, la más reciente) junto con sus entradas de CHECKSUMS ('suma bloques').
+    """
     print("INFO: 4/4 - Buscando enlaces de genoma y anotación en Ensembl...")
-    urls = {"fasta": "No encontrado", "gtf": "No encontrado"}
+    urls = {"fasta": "No encontrado", "gtf": "No encontrado", "fasta_checksum": None, "gtf_checksum": None}
     if not organism or not data_processing_text or organism == "No encontrado":
         return urls
     
@@ -157,20 +403,17 @@ def find_ensembl_urls(organism: str, data_processing_text: str) -> dict:
     assembly_full_name, version = match.group(1).strip(), match.group(2).strip()
     organism_path = organism.lower().replace(" ", "_")
     organism_filename = organism.capitalize().replace(" ", "_")
-    base_url = f"http://ftp.ensembl.org/pub/release-{version}"
     assembly_short_name = assembly_full_name.split('.')[-1]
-    
-    fasta_filename = f"{organism_filename}.{assembly_short_name}.dna.toplevel.fa.gz"
-    gtf_filename = f"{organism_filename}.{assembly_short_name}.{version}.gtf.gz"
-    fasta_url = f"{base_url}/fasta/{organism_path}/dna/{fasta_filename}"
-    gtf_url = f"{base_url}/gtf/{organism_path}/{gtf_filename}"
-    
-    try:
-        if requests.head(fasta_url, timeout=10).status_code == 200: urls["fasta"] = fasta_url
-    except: pass
-    try:
-        if requests.head(gtf_url, timeout=10).status_code == 200: urls["gtf"] = gtf_url
-    except: pass
+
+    for release in [version, "latest"]:
+        if release == "latest":
+            release = latest_ensembl_release()
+            if not release or release == version: break
+            print(f"AVISO: Release {version} sin archivos para {organism}; probando la release {release}.")
+        found = resolve_ensembl_release(release, organism_path, organism_filename, assembly_short_name)
+        if found:
+            urls.update(found)
+            break
     return urls
 
 def write_simple_sample_list(filename: str, samples: list[dict]):
@@ -188,7 +431,14 @@ def main():
     parser = argparse.ArgumentParser(description="Genera un informe y una lista de muestras para un estudio de NCBI.")
     parser.add_argument("project_id", help="El ID del BioProject (ej. PRJNA843039) o GSE.")
     parser.add_argument("-d", "--directory", default=".", help="Directorio donde guardar los archivos de salida.")
+    parser.add_argument("--api_key", default=NCBI_API_KEY, help="API key de NCBI (o variable NCBI_API_KEY): sube el límite de 3 a 10 peticiones/s.")
+    parser.add_argument("--workers", type=int, default=8, help="Peticiones de metadatos concurrentes (el límite de tasa de NCBI se respeta igualmente).")
+    parser.add_argument("--offline", action="store_true", help="Usa solo la caché HTTP local, sin acceder a la red.")
     args = parser.parse_args()
+    if args.offline:
+        configure_http_cache(offline=True)
+    if args.api_key:
+        set_ncbi_api_key(args.api_key)
     
     project_id = args.project_id.upper()
     gse_id = None
@@ -205,11 +455,15 @@ def main():
     study_info = get_study_info_from_page(gse_id, first_gsm_id)
     ensembl_urls = find_ensembl_urls(study_info['organism'], study_info['data_processing'])
     
-    print(f"INFO: Buscando SRR para cada muestra. Esto puede tardar...")
-    for i, sample in enumerate(samples):
-        print(f"      Procesando muestra {i+1}/{len(samples)}: {sample['gsm']}", end='\r')
-        sample['srr'] = get_srr_from_gsm_page(sample['gsm'])
-        time.sleep(0.5)
+    print("INFO: Buscando SRR para cada muestra...")
+    srr_map = resolve_srrs_bulk(gse_id, [sample['gsm'] for sample in samples]) if samples else {}
+    print(f"INFO: Resolución agrupada (E-utilities/ENA): {len(srr_map)}/{len(samples)} muestras.")
+    pending = [sample['gsm'] for sample in samples if sample['gsm'] not in srr_map]
+    if pending:
+        print(f"INFO: Recurriendo a las páginas GEO para {len(pending)} muestras ({args.workers} en paralelo, {GEO_LIMITER.rate:g} peticiones/s a GEO)...")
+        srr_map.update(zip(pending, fetch_srrs_concurrently(pending, args.workers)))
+    for sample in samples:
+        sample['srr'] = srr_map[sample['gsm']]
     print("\nINFO: Búsqueda completada.")
     
     # --- Generar los dos archivos de salida ---
@@ -232,7 +486,9 @@ def main():
         "\n--- SUGERENCIAS PARA REPRODUCIBILIDAD ---",
         f"Se han encontrado los siguientes archivos en Ensembl para este ensamblaje:",
         f" - Genoma de Referencia (FASTA): {ensembl_urls['fasta']}",
+        f"   CHECKSUMS (sum):              {ensembl_urls['fasta_checksum'] or 'No disponible'}",
         f" - Anotación del Genoma (GTF):   {ensembl_urls['gtf']}",
+        f"   CHECKSUMS (sum):              {ensembl_urls['gtf_checksum'] or 'No disponible'}",
         f" - Adaptador sugerido (Trimming): {study_info['adapter_seq']} (basado en el kit/instrumento: '{study_info['adapter_kit']}')",
         "\n--- MUESTRAS ---",
         "GSM\t\tSRR\t\tTítulo",
@@ -0,0 +1,242 @@
+import os
+import re
+import gzip
+import argparse
+import logging
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from index_cache import file_sha256
+
+# ==============================================================================
+# ÍNDICE BINARIO DE LA ANOTACIÓN (GTF)
+# ==============================================================================
+# El GTF humano (~1.5 GB) se leía entero varias veces por ejecución: los scripts
+# hisat2_extract_* del contenedor y la relación transcrito -> gen de Salmon/kallisto.
+# Se recorre una sola vez en streaming y se guarda un índice compacto (arrays NumPy)
+# junto al GTF, '<gtf>.gtfidx.npz', ligado a su SHA-256: si el GTF cambia se reconstruye.
+# Del índice salen en segundos los splice sites y exones de HISAT2 (mismo formato que
+# hisat2_extract_splice_sites.py / hisat2_extract_exons.py), la tabla de genes con
+# longitudes (unión de exones, como 'Length' de featureCounts) y los mapas de IDs.
+
+INDEX_FORMAT_VERSION = 1
+INDEX_SUFFIX = ".gtfidx.npz"
+# hisat2_extract_*: exones separados por intrones de <= 5 pb se fusionan.
+HISAT2_MERGE_DISTANCE = 5
+
+ATTRIBUTE_RES = {name: re.compile(rf'{name} "([^"]*)"') for name in
+                 ("gene_id", "transcript_id", "gene_name", "gene_biotype", "gene_type")}
+
+
+def open_text(path):
+    return gzip.open(path, 'rt') if path.endswith(".gz") else open(path, 'r')
+
+
+def parse_gtf(gtf_file):
+    """Recorre el GTF una vez y devuelve el índice como diccionario de arrays."""
+    chrom_index, gene_index, tx_index = {}, {}, {}
+    gene_chrom, gene_start, gene_end, gene_strand, gene_name, gene_biotype = [], [], [], [], [], []
+    tx_gene, tx_chrom, tx_strand = [], [], []
+    exon_tx, exon_start, exon_end = [], [], []
+
+    with open_text(gtf_file) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9: continue
+            feature, attributes = fields[2], fields[8]
+            if feature not in ("gene", "transcript", "exon"): continue
+            gene_match = ATTRIBUTE_RES["gene_id"].search(attributes)
+            if not gene_match: continue
+            chrom, start, end, strand = fields[0], int(fields[3]), int(fields[4]), fields[6]
+            chrom_id = chrom_index.setdefault(chrom, len(chrom_index))
+
+            gene_id = gene_match.group(1)
+            g = gene_index.get(gene_id)
+            if g is None:
+                g = gene_index[gene_id] = len(gene_index)
+                name_match = ATTRIBUTE_RES["gene_name"].search(attributes)
+                biotype_match = ATTRIBUTE_RES["gene_biotype"].search(attributes) or ATTRIBUTE_RES["gene_type"].search(attributes)
+                gene_chrom.append(chrom_id); gene_start.append(start); gene_end.append(end); gene_strand.append(strand)
+                gene_name.append(name_match.group(1) if name_match else "")
+                gene_biotype.append(biotype_match.group(1) if biotype_match else "")
+            else:
+                gene_start[g] = min(gene_start[g], start); gene_end[g] = max(gene_end[g], end)
+            if feature == "gene": continue
+
+            tx_match = ATTRIBUTE_RES["transcript_id"].search(attributes)
+            if not tx_match: continue
+            t = tx_index.get(tx_match.group(1))
+            if t is None:
+                t = tx_index[tx_match.group(1)] = len(tx_index)
+                tx_gene.append(g); tx_chrom.append(chrom_id); tx_strand.append(strand)
+            if feature == "exon":
+                exon_tx.append(t); exon_start.append(start); exon_end.append(end)
+
+    exon_tx, exon_start, exon_end = np.asarray(exon_tx, np.int32), np.asarray(exon_start, np.int64), np.asarray(exon_end, np.int64)
+    order = np.lexsort((exon_end, exon_start, exon_tx))
+    return {
+        'chroms': np.asarray(list(chrom_index), dtype=str),
+        'gene_ids': np.asarray(list(gene_index), dtype=str),
+        'gene_names': np.asarray(gene_name, dtype=str),
+        'gene_biotypes': np.asarray(gene_biotype, dtype=str),
+        'gene_chrom': np.asarray(gene_chrom, np.int32),
+        'gene_start': np.asarray(gene_start, np.int64),
+        'gene_end': np.asarray(gene_end, np.int64),
+        'gene_strand': np.asarray(gene_strand, dtype='U1'),
+        'tx_ids': np.asarray(list(tx_index), dtype=str),
+        'tx_gene': np.asarray(tx_gene, np.int32),
+        'tx_chrom': np.asarray(tx_chrom, np.int32),
+        'tx_strand': np.asarray(tx_strand, dtype='U1'),
+        'exon_tx': exon_tx[order],
+        'exon_start': exon_start[order],
+        'exon_end': exon_end[order],
+    }
+
+
+def compute_gene_lengths(index):
+    """Longitud de cada gen como unión de sus exones (definición de 'Length' en featureCounts)."""
+    exon_gene = index['tx_gene'][index['exon_tx']]
+    order = np.lexsort((index['exon_start'], exon_gene))
+    lengths = np.zeros(len(index['gene_ids']), np.int64)
+    current_gene, block_start, block_end = -1, 0, -1
+    for g, start, end in zip(exon_gene[order].tolist(), index['exon_start'][order].tolist(), index['exon_end'][order].tolist()):
+        if g != current_gene or start > block_end + 1:
+            if current_gene >= 0:
+                lengths[current_gene] += block_end - block_start + 1
+            if g != current_gene:
+                current_gene = g
+            block_start, block_end = start, end
+        else:
+            block_end = max(block_end, end)
+    if current_gene >= 0:
+        lengths[current_gene] += block_end - block_start + 1
+    return lengths
+
+
+def index_path_for(gtf_file):
+    return f"{gtf_file}{INDEX_SUFFIX}"
+
+
+def load_gtf_index(gtf_file):
+    """
+    Devuelve el GtfIndex del GTF: lo lee de '<gtf>.gtfidx.npz' si corresponde al hash actual
+    del GTF, o lo construye (una sola pasada) y lo guarda para las siguientes llamadas.
+    """
+    gtf_hash = file_sha256(gtf_file)
+    index_file = index_path_for(gtf_file)
+    if os.path.exists(index_file):
+        try:
+            with np.load(index_file, allow_pickle=False) as data:
+                if str(data['gtf_sha256']) == gtf_hash and int(data['format_version']) == INDEX_FORMAT_VERSION:
+                    return GtfIndex({k: data[k] for k in data.files})
+        except (OSError, ValueError, KeyError):
+            pass
+        logging.info(f"♻️ Índice de {os.path.basename(gtf_file)} desactualizado. Reconstruyendo...")
+
+    logging.info(f"🧬 Indexando anotación {os.path.basename(gtf_file)} (una sola pasada)...")
+    index = parse_gtf(gtf_file)
+    index['gene_length'] = compute_gene_lengths(index)
+    index['gtf_sha256'] = np.asarray(gtf_hash)
+    index['format_version'] = np.asarray(INDEX_FORMAT_VERSION)
+    try:
+        with open(f"{index_file}.tmp", 'wb') as f:
+            np.savez(f, **index)
+        os.replace(f"{index_file}.tmp", index_file)
+        logging.info(f"✅ Índice de anotación: {len(index['gene_ids'])} genes, {len(index['tx_ids'])} transcritos, "
+                     f"{len(index['exon_tx'])} exones -> {index_file}")
+    except OSError as e:
+        logging.warning(f"⚠️ No se pudo guardar el índice de anotación ({e}); se usará solo en memoria.")
+    return GtfIndex(index)
+
+
+class GtfIndex:
+    """Vista sobre los arrays del índice con las derivaciones que consume el pipeline."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['arrays'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def transcript_gene_map(self):
+        """{transcript_id: gene_id}."""
+        return dict(zip(self.tx_ids.tolist(), self.gene_ids[self.tx_gene].tolist()))
+
+    def gene_coordinates(self):
+        """{gene_id: (cromosoma, inicio, fin, hebra)}, como load_transcript_gene_map()."""
+        chroms = self.chroms[self.gene_chrom].tolist()
+        return {gene: (chrom, start, end, strand) for gene, chrom, start, end, strand in
+                zip(self.gene_ids.tolist(), chroms, self.gene_start.tolist(), self.gene_end.tolist(), self.gene_strand.tolist())}
+
+    def gene_table(self):
+        """Tabla de genes: nombre, biotipo, coordenadas y longitud (unión de exones)."""
+        table = pd.DataFrame({'gene_name': self.gene_names, 'gene_biotype': self.gene_biotypes,
+                              'Chr': self.chroms[self.gene_chrom], 'Start': self.gene_start, 'End': self.gene_end,
+                              'Strand': self.gene_strand, 'Length': self.gene_length},
+                             index=pd.Index(self.gene_ids, name='gene_id'))
+        return table
+
+    def merged_transcript_exons(self):
+        """Exones de cada transcrito en coordenadas 0-based, fusionados como hisat2_extract_*: (cromosoma, hebra, [[izq, der], ...])."""
+        transcripts = defaultdict(list)
+        for t, start, end in zip(self.exon_tx.tolist(), self.exon_start.tolist(), self.exon_end.tolist()):
+            left, right = start - 1, end - 1
+            if left >= right: continue
+            exons = transcripts[t]
+            if exons and left - exons[-1][1] <= HISAT2_MERGE_DISTANCE:
+                exons[-1][1] = max(exons[-1][1], right)
+            else:
+                exons.append([left, right])
+        chroms, strands = self.chroms[self.tx_chrom].tolist(), self.tx_strand.tolist()
+        return [(chroms[t], strands[t], exons) for t, exons in transcripts.items()]
+
+    def write_splice_sites(self, output_file):
+        """Equivalente a 'hisat2_extract_splice_sites.py <gtf>'."""
+        junctions = set()
+        for chrom, strand, exons in self.merged_transcript_exons():
+            for i in range(1, len(exons)):
+                junctions.add((chrom, exons[i - 1][1], exons[i][0], strand))
+        with open(output_file, 'w') as f:
+            for chrom, left, right, strand in sorted(junctions):
+                f.write(f"{chrom}\t{left}\t{right}\t{strand}\n")
+        return len(junctions)
+
+    def write_exons(self, output_file):
+        """Equivalente a 'hisat2_extract_exons.py <gtf>'."""
+        exons = set()
+        for chrom, strand, tx_exons in self.merged_transcript_exons():
+            for left, right in tx_exons:
+                exons.add((chrom, left, right, strand))
+        with open(output_file, 'w') as f:
+            for chrom, left, right, strand in sorted(exons):
+                f.write(f"{chrom}\t{left}\t{right}\t{strand}\n")
+        return len(exons)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Indexa un GTF una vez y deriva de él tablas y archivos auxiliares.")
+    parser.add_argument("gtf_file")
+    parser.add_argument("--splice_sites", help="Escribe los splice sites para hisat2-build (--ss).")
+    parser.add_argument("--exons", help="Escribe los exones para hisat2-build (--exon).")
+    parser.add_argument("--gene_table", help="TSV con nombre, biotipo, coordenadas y longitud de cada gen.")
+    parser.add_argument("--tx2gene", help="TSV transcript_id -> gene_id.")
+    args = parser.parse_args()
+
+    gtf_index = load_gtf_index(args.gtf_file)
+    if args.splice_sites:
+        print(f"Splice sites: {gtf_index.write_splice_sites(args.splice_sites)} -> {args.splice_sites}")
+    if args.exons:
+        print(f"Exones: {gtf_index.write_exons(args.exons)} -> {args.exons}")
+    if args.gene_table:
+        gtf_index.gene_table().to_csv(args.gene_table, sep='\t')
+        print(f"Tabla de genes -> {args.gene_table}")
+    if args.tx2gene:
+        pd.Series(gtf_index.transcript_gene_map(), name='gene_id').rename_axis('transcript_id').to_csv(args.tx2gene, sep='\t')
+        print(f"Mapa transcrito -> gen -> {args.tx2gene}")
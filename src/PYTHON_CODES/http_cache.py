@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# ==============================================================================
+# CACHÉ HTTP PERSISTENTE (SQLite) PARA METADATOS: NCBI, GEO, ENA Y ENSEMBL
+# ==============================================================================
+# experiment_profiler.py, data_conector.py y find_ensembl_urls() repiten las mismas
+# consultas en cada ejecución. Las respuestas se guardan en una base SQLite compartida
+# entre proyectos, indexada por método + URL + parámetros, con caducidad por endpoint.
+# Una entrada caducada se revalida con If-None-Match / If-Modified-Since (un 304 solo
+# renueva la fecha). En modo offline solo se usa la caché, sin tocar la red.
+# La configuración viaja por variables de entorno (como la telemetría) a los scripts hijos.
+
+CACHE_ENV_VAR = "OMNIRNA_HTTP_CACHE"
+OFFLINE_ENV_VAR = "OMNIRNA_OFFLINE"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "omnirna", "http_cache.sqlite")
+# Parámetros que no cambian la respuesta y no deben partir la caché (la API key de NCBI).
+IGNORED_PARAMS = {"api_key"}
+
+# Caducidad (segundos) por endpoint; la primera regla que coincide con la URL gana.
+ENDPOINT_TTLS = [
+    (r"eutils\.ncbi\.nlm\.nih\.gov/entrez/eutils/(esearch|esummary|elink|efetch)", 7 * 86400),
+    (r"ncbi\.nlm\.nih\.gov/geo/query/acc\.cgi", 7 * 86400),
+    (r"ebi\.ac\.uk/ena/portal/api/filereport", 86400),
+    (r"ensembl\.org/pub/release-\d+/", 30 * 86400),  # las releases publicadas no cambian
+]
+DEFAULT_TTL = 86400
+
+_thread_state = threading.local()
+
+
+class OfflineCacheMiss(requests.exceptions.ConnectionError):
+    """Modo offline sin respuesta en caché para la petición."""
+
+
+def configure_http_cache(cache_path=None, offline=None):
+    """Fija la ruta de la caché ('off' la desactiva) y el modo offline para este proceso y sus hijos."""
+    if cache_path is not None:
+        os.environ[CACHE_ENV_VAR] = os.path.abspath(cache_path) if cache_path != "off" else "off"
+    if offline is not None:
+        os.environ[OFFLINE_ENV_VAR] = "1" if offline else "0"
+
+
+def is_offline():
+    return os.environ.get(OFFLINE_ENV_VAR, "0") == "1"
+
+
+def cache_path():
+    """Ruta de la base SQLite, o None si la caché está desactivada."""
+    path = os.environ.get(CACHE_ENV_VAR, DEFAULT_CACHE_PATH)
+    return None if path.lower() in ("off", "0", "") else path
+
+
+def ttl_for(url):
+    for pattern, ttl in ENDPOINT_TTLS:
+        if re.search(pattern, url):
+            return ttl
+    return DEFAULT_TTL
+
+
+def request_key(method, url, params=None, data=None):
+    params = sorted((k, str(v)) for k, v in (params or {}).items() if k not in IGNORED_PARAMS)
+    data = sorted((k, str(v)) for k, v in (data or {}).items())
+    return hashlib.sha256(json.dumps([method.upper(), url, params, data]).encode()).hexdigest()
+
+
+def _connection():
+    """Una conexión por hilo y ruta; WAL permite lectores concurrentes de varios procesos."""
+    path = cache_path()
+    connections = getattr(_thread_state, 'connections', None)
+    if connections is None:
+        connections = _thread_state.connections = {}
+    if path not in connections:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY, method TEXT, url TEXT, status INTEGER,
+                            headers TEXT, body BLOB, fetched_at REAL, expires_at REAL)""")
+        conn.commit()
+        connections[path] = conn
+    return connections[path]
+
+
+def _build_response(row):
+    """Reconstruye un requests.Response a partir de una fila de la caché."""
+    url, status, headers, body = row
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(json.loads(headers))
+    response._content = body
+    response.url = url
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.from_cache = True
+    return response
+
+
+def cached_fetch(fetch, method, url, params=None, data=None, ttl=None):
+    """
+    Devuelve la respuesta de 'fetch(cabeceras_extra)' pasando por la caché. 'fetch' hace la petición real
+    (con sus reintentos y límites de tasa) y solo se llama si no hay copia vigente. Se guardan las
+    respuestas definitivas (no 5xx ni 429); los errores de red se propagan igual que sin caché.
+    """
+    if cache_path() is None:
+        return fetch({})
+    key = request_key(method, url, params, data)
+    conn = _connection()
+    row = conn.execute("SELECT url, status, headers, body, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+    now = time.time()
+
+    if row is not None and (row[4] > now or is_offline()):
+        return _build_response(row[:4])
+    if is_offline():
+        full_url = url + ("?" + urlencode(params) if params else "")
+        raise OfflineCacheMiss(f"Modo offline: sin respuesta en caché para {method} {full_url}")
+
+    conditional = {}
+    if row is not None:
+        cached_headers = CaseInsensitiveDict(json.loads(row[2]))
+        if cached_headers.get("ETag"):
+            conditional["If-None-Match"] = cached_headers["ETag"]
+        if cached_headers.get("Last-Modified"):
+            conditional["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+    response = fetch(conditional)
+    expires_at = now + (ttl if ttl is not None else ttl_for(url))
+    if response.status_code == 304 and row is not None:
+        conn.execute("UPDATE responses SET fetched_at = ?, expires_at = ? WHERE key = ?", (now, expires_at, key))
+        conn.commit()
+        return _build_response(row[:4])
+    if response.status_code < 500 and response.status_code != 429:
+        stored_headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-encoding", "transfer-encoding", "content-length")}
+        conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (key, method.upper(), response.url or url, response.status_code, json.dumps(stored_headers),
+                      response.content, now, expires_at))
+        conn.commit()
+    return response
+
+
+def cached_get(url, params=None, headers=None, timeout=30, ttl=None):
+    """requests.get con caché, para llamadas sencillas sin limitador propio."""
+    return cached_fetch(lambda extra: requests.get(url, params=params, headers={**(headers or {}), **extra}, timeout=timeout),
+                        "GET", url, params, ttl=ttl)
+
+
+def cached_head(url, timeout=10, ttl=None):
+    """requests.head con caché (sondeo de existencia de archivos en Ensembl)."""
+    return cached_fetch(lambda extra: requests.head(url, headers=extra, timeout=timeout), "HEAD", url, ttl=ttl)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspecciona o limpia la caché HTTP de metadatos.")
+    parser.add_argument("--path", help=f"Base SQLite (por defecto ${CACHE_ENV_VAR} o {DEFAULT_CACHE_PATH}).")
+    parser.add_argument("--purge-expired", action="store_true", help="Elimina las entradas caducadas.")
+    parser.add_argument("--clear", action="store_true", help="Vacía la caché.")
+    args = parser.parse_args()
+    if args.path:
+        configure_http_cache(args.path)
+    if cache_path() is None:
+        print("La caché HTTP está desactivada."); raise SystemExit(0)
+
+    conn = _connection()
+    if args.clear:
+        conn.execute("DELETE FROM responses")
+    elif args.purge_expired:
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+    conn.commit()
+    total, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()
+    expired = conn.execute("SELECT COUNT(*) FROM responses WHERE expires_at < ?", (time.time(),)).fetchone()[0]
+    print(f"Caché: {cache_path()} ({total} respuestas, {size / 1e6:.1f} MB, {expired} caducadas)")
+    for host, count in conn.execute("SELECT substr(url, 1, instr(substr(url, 9), '/') + 8) AS host, COUNT(*) FROM responses GROUP BY host ORDER BY 2 DESC"):
+        print(f"  {host}\t{count}")
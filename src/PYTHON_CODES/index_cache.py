@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import logging
+import subprocess
+from contextlib import contextmanager
+
+# ==============================================================================
+# CACHÉ GLOBAL DE ÍNDICES DIRECCIONADA POR CONTENIDO
+# ==============================================================================
+# Los índices de STAR/HISAT2 se guardan en un directorio compartido entre proyectos,
+# con nombre derivado del hash de (FASTA, GTF, versión del alineador, parámetros).
+# Cada proyecto enlaza el índice mediante un symlink en REFERENCE_GENOMES_FILES.
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".omnirna_index_cache")
+METADATA_FILE = ".omnirna_cache.json"
+LAST_USED_FILE = ".last_used"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+IN_USE_SUFFIX = ".inuse"
+
+# Cerrojos compartidos de uso que este proceso mantiene hasta terminar (ruta real de la entrada -> archivo).
+_held_entries = {}
+
+
+def resolve_cache_dir(cache_config):
+    """Devuelve el directorio de caché: JSON > variable OMNIRNA_INDEX_CACHE > ~/.omnirna_index_cache."""
+    return cache_config.get("cache_dir") or os.environ.get("OMNIRNA_INDEX_CACHE") or DEFAULT_CACHE_DIR
+
+
+def file_sha256(path):
+    """SHA-256 de un archivo, memorizado en '<archivo>.sha256' mientras no cambien tamaño ni mtime."""
+    stat = os.stat(path)
+    signature = f"{stat.st_size}:{int(stat.st_mtime)}"
+    memo_file = f"{path}.sha256"
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as f:
+            memo_signature, _, memo_hash = f.read().strip().partition(" ")
+        if memo_signature == signature and memo_hash:
+            return memo_hash
+
+    logging.info(f"🔑 Calculando huella SHA-256 de {os.path.basename(path)}...")
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    file_hash = digest.hexdigest()
+    try:
+        with open(memo_file, 'w') as f: f.write(f"{signature} {file_hash}\n")
+    except OSError:
+        pass
+    return file_hash
+
+
+def get_tool_version(container_img, version_cmd):
+    """Versión de la herramienta dentro del contenedor; si falla, huella de la propia imagen."""
+    container_cmd = os.environ.get("APPTAINER_CMD", "apptainer")
+    try:
+        result = subprocess.run([container_cmd, "exec", container_img] + version_cmd, check=True, capture_output=True, text=True)
+        output = (result.stdout or result.stderr).strip()
+        if output:
+            return output.splitlines()[0]
+    except (subprocess.CalledProcessError, OSError):
+        pass
+    if container_img and os.path.exists(container_img):
+        stat = os.stat(container_img)
+        return f"{os.path.basename(container_img)}:{stat.st_size}:{int(stat.st_mtime)}"
+    return str(container_img)
+
+
+def compute_cache_key(key_material):
+    """Hash estable del material de la clave (diccionario serializable a JSON)."""
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode()).hexdigest()
+
+
+@contextmanager
+def file_lock(lock_path, blocking=True):
+    """Cerrojo exclusivo entre procesos (y jobs de SLURM en el mismo FS) basado en flock."""
+    with open(lock_path, 'a') as lock_file:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            if not os.path.islink(fpath):
+                total += os.path.getsize(fpath)
+    return total
+
+
+def list_cache_entries(cache_dir):
+    """Entradas completas de la caché con su tamaño, último uso y metadatos."""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        metadata_path = os.path.join(entry_dir, METADATA_FILE)
+        if not os.path.isdir(entry_dir) or not os.path.exists(metadata_path):
+            continue
+        last_used_path = os.path.join(entry_dir, LAST_USED_FILE)
+        last_used = os.path.getmtime(last_used_path) if os.path.exists(last_used_path) else os.path.getmtime(metadata_path)
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+        entries.append({'path': entry_dir, 'size': directory_size(entry_dir), 'last_used': last_used, 'metadata': metadata})
+    return entries
+
+
+def evict_cache(cache_dir, max_size_gb, keep=()):
+    """Expulsa entradas por orden de último uso (LRU) hasta quedar por debajo de 'max_size_gb'."""
+    if max_size_gb is None:
+        return []
+    max_bytes = max_size_gb * 1024 ** 3
+    entries = sorted(list_cache_entries(cache_dir), key=lambda e: e['last_used'])
+    total = sum(e['size'] for e in entries)
+    evicted = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry['path'] in keep:
+            continue
+        # Una entrada en construcción (cerrojo '.lock') o en uso por otro job (cerrojo compartido '.inuse') no se toca.
+        with file_lock(f"{entry['path']}.lock", blocking=False) as acquired, \
+                file_lock(f"{entry['path']}{IN_USE_SUFFIX}", blocking=False) as unused:
+            if not (acquired and unused):
+                continue
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+        evicted.append(entry['path'])
+        logging.info(f"🗑️  Caché de índices: expulsado {os.path.basename(entry['path'])} ({entry['size'] / 1024 ** 3:.1f} GB).")
+    return evicted
+
+
+def hold_index_entry(path):
+    """
+    Marca como en uso la entrada de la caché a la que apunta 'path' (symlink del proyecto o la propia entrada)
+    con un cerrojo compartido que se mantiene hasta que termina el proceso: evict_cache() de otros proyectos
+    no puede borrar un índice mientras alguien alinea contra él. No hace nada si 'path' no está en la caché.
+    """
+    entry_dir = os.path.realpath(path)
+    if entry_dir in _held_entries or not os.path.exists(os.path.join(entry_dir, METADATA_FILE)):
+        return entry_dir in _held_entries
+    lock_file = open(f"{entry_dir}{IN_USE_SUFFIX}", 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_SH)
+    _held_entries[entry_dir] = lock_file
+    return True
+
+
+def link_into_project(entry_dir, link_path):
+    """Crea (o actualiza de forma atómica) el symlink del proyecto hacia la entrada de la caché."""
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        logging.warning(f"⚠️ {link_path} es un directorio real (índice local previo). Se usará tal cual, sin caché.")
+        return link_path
+    tmp_link = f"{link_path}.tmp-{os.getpid()}"
+    if os.path.lexists(tmp_link): os.remove(tmp_link)
+    os.symlink(entry_dir, tmp_link)
+    os.replace(tmp_link, link_path)
+    return link_path
+
+
+def obtain_cached_index(cache_config, kind, key_material, build_func, link_path):
+    """
+    Devuelve 'link_path' apuntando a un índice de la caché que coincide con 'key_material'.
+    Si no existe, lo construye UNA sola vez (cerrojo por clave) llamando a build_func(directorio_destino).
+    """
+    cache_dir = resolve_cache_dir(cache_config)
+    os.makedirs(cache_dir, exist_ok=True)
+    key = compute_cache_key(key_material)
+    entry_dir = os.path.join(cache_dir, f"{kind}_{key[:20]}")
+
+    with file_lock(f"{entry_dir}.lock"):
+        if os.path.exists(os.path.join(entry_dir, METADATA_FILE)):
+            logging.info(f"♻️  Índice {kind} reutilizado desde la caché global: {entry_dir}")
+        else:
+            logging.info(f"🛠️  Índice {kind} no está en la caché global. Construyendo en {entry_dir}...")
+            tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            build_func(tmp_dir)
+            with open(os.path.join(tmp_dir, METADATA_FILE), 'w') as f:
+                json.dump({'kind': kind, 'key': key, 'created': time.time(), 'material': key_material}, f, indent=2)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        with open(os.path.join(entry_dir, LAST_USED_FILE), 'w') as f:
+            f.write(f"{time.time()}\n")
+        # Se marca en uso antes de soltar el cerrojo de construcción: no hay hueco para una expulsión.
+        hold_index_entry(entry_dir)
+
+    evict_cache(cache_dir, cache_config.get("max_size_gb"), keep={entry_dir})
+    return link_into_project(entry_dir, link_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gestión de la caché global de índices de alineadores.")
+    parser.add_argument("--cache_dir", help="Directorio de la caché (por defecto OMNIRNA_INDEX_CACHE o ~/.omnirna_index_cache).")
+    parser.add_argument("--evict_to_gb", type=float, help="Expulsa entradas (LRU) hasta quedar por debajo de este tamaño.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] - %(message)s")
+
+    cache_dir = resolve_cache_dir({"cache_dir": args.cache_dir})
+    if args.evict_to_gb is not None:
+        evict_cache(cache_dir, args.evict_to_gb)
+    entries = sorted(list_cache_entries(cache_dir), key=lambda e: e['last_used'], reverse=True)
+    print(f"Caché: {cache_dir} ({len(entries)} entradas, {sum(e['size'] for e in entries) / 1024 ** 3:.1f} GB)")
+    for entry in entries:
+        material = entry['metadata'].get('material', {})
+        print(f"  {os.path.basename(entry['path'])}\t{entry['size'] / 1024 ** 3:.1f} GB\t"
+              f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used']))}\t{material.get('version', '')}")
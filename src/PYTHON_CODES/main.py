@@ -4,6 +4,8 @@ import sys
 import json
 import os
 
+from http_cache import configure_http_cache
+
 # ==============================================================================
 # SECCIÓN 1: FUNCIONES AUXILIARES
 # ==============================================================================
@@ -48,8 +50,11 @@ def main():
     )
     parser.add_argument("-c", "--config", required=True, help="Ruta al archivo JSON de configuración.")
     parser.add_argument("-p", "--project_id", help="ID del proyecto (Opcional en modo Manual).")
+    parser.add_argument("--dry-run", action="store_true", help="Muestra el plan de ejecución del pipeline core sin ejecutar nada.")
+    parser.add_argument("--offline", action="store_true", help="Consultas de metadatos (NCBI/GEO/ENA/Ensembl) solo desde la caché HTTP local.")
 
     args = parser.parse_args()
+    core_flags = ["--dry-run"] if args.dry_run else []
 
     # --- 1. Localizar scripts satélite ---
     script_info = get_script_path("experiment_profiler.py")
@@ -79,6 +84,13 @@ def main():
         # Asegurar que el directorio base existe
         os.makedirs(base_dir, exist_ok=True)
 
+        # Caché HTTP de metadatos compartida entre proyectos; los scripts satélite la heredan por entorno.
+        http_cache_config = config_data.get("tool_parameters", {}).get("http_cache", {})
+        cache_path = http_cache_config.get("path")
+        if not http_cache_config.get("enabled", True):
+            cache_path = "off"
+        configure_http_cache(cache_path, offline=args.offline or http_cache_config.get("offline", False))
+
     except Exception as e:
         print(f"❌ ERROR FATAL leyendo el archivo JSON: {e}", flush=True)
         sys.exit(1)
@@ -122,7 +134,7 @@ def main():
     if counting_method == "precomputed_csv":
         print("\n" + "=" * 20 + " MODO: Matriz Precalculada " + "=" * 20, flush=True)
         print("ℹ️  Saltando gestión de FASTQ.", flush=True)
-        run_command([script_core, "-c", config_path])
+        run_command([script_core, "-c", config_path] + core_flags)
         return 
 
     # ====================================================================
@@ -188,7 +200,7 @@ def main():
     # ====================================================================
     print("\n" + "-" * 10 + " FASE 2: INICIANDO PIPELINE CORE " + "-" * 10, flush=True)
     
-    run_command([script_core, "-c", config_path])
+    run_command([script_core, "-c", config_path] + core_flags)
 
     print("\n🎉 ¡ÉXITO TOTAL! El orquestador ha completado todas las tareas.", flush=True)
 
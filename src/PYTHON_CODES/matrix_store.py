@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Dependencia opcional: las copias Parquet/Feather solo se leen si pyarrow está instalado.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# ==============================================================================
+# ALMACÉN DE MATRICES EN DISCO CON ÍNDICES DE GENES Y MUESTRAS
+# ==============================================================================
+# Consultas habituales tras una ejecución: "estos 50 genes en todas las muestras" o
+# "estas muestras, todos los genes". En vez de cargar la TSV completa, la matriz se
+# guarda dos veces en teselas comprimidas (zlib) dentro de archivos que se abren por mmap:
+#   - por_genes:    bloques de 'tile_genes' filas x todas las muestras.
+#   - por_muestras: bloques de todas las filas x 'tile_samples' columnas.
+# Un índice ordenado de IDs (búsqueda binaria) localiza las filas/columnas pedidas y solo
+# se descomprimen las teselas que las contienen: el coste depende del tamaño del corte, no
+# del de la cohorte.
+#
+#   <matriz>.mstore/
+#     meta.json                         forma, dtype, tamaño de tesela, origen
+#     gene_ids.npy / samples.npy        IDs en el orden original
+#     gene_sorted.npy, gene_order.npy   índice de genes (IDs ordenados + posición original)
+#     by_gene.bin / by_gene_offsets.npy       teselas por filas y sus desplazamientos
+#     by_sample.bin / by_sample_offsets.npy   teselas por columnas y sus desplazamientos
+
+STORE_FORMAT_VERSION = 1
+ANNOTATION_COLUMNS = ['Chr', 'Start', 'End', 'Strand', 'Length']
+COLUMNAR_EXTENSIONS = {"parquet": ".parquet", "feather": ".feather"}
+
+
+def default_store_dir(matrix_file):
+    return f"{os.path.splitext(matrix_file)[0]}.mstore"
+
+
+def columnar_path(text_path, binary_format):
+    """Ruta de la copia columnar de una matriz de texto ('counts_STAR.txt' -> 'counts_STAR.parquet')."""
+    return f"{os.path.splitext(text_path)[0]}{COLUMNAR_EXTENSIONS[binary_format]}"
+
+
+def fresh_columnar_copy(text_file):
+    """Copia Parquet/Feather de 'text_file' si existe y es al menos tan reciente como el texto; si no, None."""
+    if pa is None or not os.path.exists(text_file):
+        return None
+    for binary_format in ("feather", "parquet"):
+        candidate = columnar_path(text_file, binary_format)
+        if os.path.exists(candidate) and os.path.getmtime(candidate) >= os.path.getmtime(text_file):
+            return candidate
+    return None
+
+
+def arrow_to_matrix(table):
+    """Tabla Arrow (gene_id + una columna por muestra) -> DataFrame indexado por gene_id."""
+    matrix = table.to_pandas().set_index('gene_id')
+    matrix.index = matrix.index.astype(str)
+    return matrix
+
+
+def iter_columnar_batches(columnar_file, rows_per_block):
+    """Bloques de filas de una copia columnar: Feather por memory-map (sin copia), Parquet descomprimiendo row groups."""
+    if columnar_file.endswith(".parquet"):
+        for batch in pq.ParquetFile(columnar_file).iter_batches(batch_size=rows_per_block):
+            yield arrow_to_matrix(pa.Table.from_batches([batch]))
+        return
+    with pa.memory_map(columnar_file, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for start in range(0, batch.num_rows, rows_per_block):
+                yield arrow_to_matrix(pa.Table.from_batches([batch.slice(start, rows_per_block)]))
+
+
+def read_matrix_blocks(matrix_file, rows_per_block, samples=None):
+    """
+    Itera la matriz por bloques de filas. Si hay una copia columnar al día con las mismas muestras,
+    se lee de ella; si no, del texto (TSV/CSV, formato featureCounts incluido).
+    """
+    columnar_file = fresh_columnar_copy(matrix_file)
+    if columnar_file:
+        schema = pq.read_schema(columnar_file) if columnar_file.endswith(".parquet") else pa.ipc.open_file(columnar_file).schema
+        if samples is None or schema.names[1:] == list(samples):
+            yield from iter_columnar_batches(columnar_file, rows_per_block)
+            return
+    sep = ',' if matrix_file.endswith(".csv") else '\t'
+    reader = pd.read_csv(matrix_file, sep=sep, comment='#', index_col=0, chunksize=rows_per_block)
+    for block in reader:
+        yield block.drop(columns=[c for c in ANNOTATION_COLUMNS if c in block.columns])
+
+
+def load_matrix_npz(npz_file):
+    """Carga una matriz guardada con save_matrix_npz() como DataFrame indexado por gene_id."""
+    with np.load(npz_file) as data:
+        matrix = pd.DataFrame(data['values'], index=data['gene_id'], columns=data['sample'])
+    matrix.index.name = 'gene_id'
+    return matrix
+
+
+def load_matrix(matrix_file):
+    """
+    Carga una matriz completa (genes x muestras). Desde .npz, Parquet o Feather directamente; desde una
+    matriz de texto, a través de su copia columnar si está al día (Feather por memory-map) o del propio texto.
+    """
+    extension = os.path.splitext(matrix_file)[1]
+    if extension == ".npz":
+        return load_matrix_npz(matrix_file)
+    columnar_file = matrix_file if extension in (".parquet", ".feather") else fresh_columnar_copy(matrix_file)
+    if columnar_file:
+        if columnar_file.endswith(".parquet"):
+            return arrow_to_matrix(pq.read_table(columnar_file))
+        with pa.memory_map(columnar_file, 'r') as source:
+            return arrow_to_matrix(pa.ipc.open_file(source).read_all())
+    matrix = pd.read_csv(matrix_file, sep=',' if extension == ".csv" else '\t', comment='#', index_col=0)
+    return matrix.drop(columns=[c for c in ANNOTATION_COLUMNS if c in matrix.columns])
+
+
+def write_tiles(tiles, bin_path, offsets_path, compression_level):
+    """Comprime y concatena las teselas; guarda los desplazamientos acumulados (n_teselas + 1)."""
+    offsets = [0]
+    with open(f"{bin_path}.tmp", 'wb') as f:
+        for tile in tiles:
+            f.write(zlib.compress(np.ascontiguousarray(tile).tobytes(), compression_level))
+            offsets.append(f.tell())
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+    os.replace(f"{bin_path}.tmp", bin_path)
+
+
+def build_matrix_store(matrix_file, store_dir=None, tile_genes=16, tile_samples=2, memory_mb=256, compression_level=3):
+    """
+    Construye (o reutiliza, si el origen no ha cambiado) el almacén de 'matrix_file'. La matriz se lee
+    por bloques (de su copia Parquet/Feather si está al día) y se vuelca sin comprimir a un temporal; las teselas se generan desde él por mmap,
+    así que la memoria queda acotada por 'memory_mb' sea cual sea el tamaño de la cohorte.
+    """
+    store_dir = store_dir or default_store_dir(matrix_file)
+    source_stat = os.stat(matrix_file)
+    meta_file = os.path.join(store_dir, "meta.json")
+    # Todo lo que determina el contenido del almacén: si algo cambia, se reconstruye.
+    build_key = {'format_version': STORE_FORMAT_VERSION, 'source_size': source_stat.st_size, 'source_mtime': source_stat.st_mtime,
+                 'tile_genes': tile_genes, 'tile_samples': tile_samples, 'compression_level': compression_level}
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if all(meta.get(k) == v for k, v in build_key.items()):
+            return store_dir
+    os.makedirs(store_dir, exist_ok=True)
+
+    # 1. Volcado por bloques a un temporal float64 fila a fila (se detecta si todo es entero).
+    raw_path = os.path.join(store_dir, "matrix.raw.tmp")
+    header = pd.read_csv(matrix_file, sep=',' if matrix_file.endswith(".csv") else '\t', comment='#', index_col=0, nrows=0)
+    samples = [c for c in header.columns if c not in ANNOTATION_COLUMNS]
+    rows_per_block = max(tile_genes, int(memory_mb * 1024 ** 2 / (32 * max(1, len(samples)))))
+    gene_ids, all_integral = [], True
+    with open(raw_path, 'wb') as f:
+        for block in read_matrix_blocks(matrix_file, rows_per_block, samples):
+            values = block.to_numpy(dtype=np.float64)
+            all_integral = all_integral and bool(np.all(np.mod(values, 1) == 0))
+            f.write(values.tobytes())
+            gene_ids.extend(block.index.astype(str))
+    n_genes, n_samples = len(gene_ids), len(samples)
+    dtype = np.dtype(np.int64 if all_integral else np.float64)
+    matrix = np.memmap(raw_path, dtype=np.float64, mode='r', shape=(n_genes, n_samples)) if n_genes and n_samples else np.zeros((n_genes, n_samples))
+
+    # 2. Teselas por filas (consultas de genes).
+    write_tiles((matrix[r:r + tile_genes].astype(dtype) for r in range(0, n_genes, tile_genes)),
+                os.path.join(store_dir, "by_gene.bin"), os.path.join(store_dir, "by_gene_offsets.npy"), compression_level)
+
+    # 3. Teselas por columnas (consultas de muestras): grupos de teselas que caben en 'memory_mb' por pasada.
+    tiles_per_pass = max(1, int(memory_mb * 1024 ** 2 / (8 * max(1, n_genes) * tile_samples)))
+
+    def column_tiles(matrix):
+        for group_start in range(0, n_samples, tile_samples * tiles_per_pass):
+            group = np.asarray(matrix[:, group_start:group_start + tile_samples * tiles_per_pass]).astype(dtype)
+            for c in range(0, group.shape[1], tile_samples):
+                yield group[:, c:c + tile_samples]
+
+    write_tiles(column_tiles(matrix), os.path.join(store_dir, "by_sample.bin"), os.path.join(store_dir, "by_sample_offsets.npy"), compression_level)
+    del matrix
+    os.remove(raw_path)
+
+    # 4. Índices de IDs.
+    gene_array = np.asarray(gene_ids, dtype=str)
+    gene_order = np.argsort(gene_array, kind='stable')
+    np.save(os.path.join(store_dir, "gene_ids.npy"), gene_array)
+    np.save(os.path.join(store_dir, "gene_sorted.npy"), gene_array[gene_order])
+    np.save(os.path.join(store_dir, "gene_order.npy"), gene_order.astype(np.int64))
+    np.save(os.path.join(store_dir, "samples.npy"), np.asarray(samples, dtype=str))
+
+    meta = {**build_key, 'source': os.path.abspath(matrix_file),
+            'shape': [n_genes, n_samples], 'dtype': dtype.str, 'index_name': header.index.name}
+    with open(f"{meta_file}.tmp", 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(f"{meta_file}.tmp", meta_file)
+    return store_dir
+
+
+class MatrixStore:
+    """Acceso de solo lectura a un almacén creado con build_matrix_store()."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.genes = np.load(os.path.join(store_dir, "gene_ids.npy"), mmap_mode='r')
+        self.samples = np.load(os.path.join(store_dir, "samples.npy"))
+        self._gene_sorted = np.load(os.path.join(store_dir, "gene_sorted.npy"), mmap_mode='r')
+        self._gene_order = np.load(os.path.join(store_dir, "gene_order.npy"), mmap_mode='r')
+        self._sample_positions = {s: i for i, s in enumerate(self.samples)}
+        self._tiles = {}
+        for layout in ("by_gene", "by_sample"):
+            offsets = np.load(os.path.join(store_dir, f"{layout}_offsets.npy"))
+            with open(os.path.join(store_dir, f"{layout}.bin"), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+            self._tiles[layout] = (data, offsets)
+
+    def _tile(self, layout, index, tile_shape):
+        data, offsets = self._tiles[layout]
+        return np.frombuffer(zlib.decompress(data[offsets[index]:offsets[index + 1]]), dtype=self.dtype).reshape(tile_shape)
+
+    def gene_positions(self, gene_ids):
+        """Posiciones (fila) de los genes pedidos; KeyError con los que no existen."""
+        gene_ids = np.asarray(gene_ids, dtype=str)
+        found = np.searchsorted(self._gene_sorted, gene_ids)
+        found = np.minimum(found, len(self._gene_sorted) - 1) if len(self._gene_sorted) else found
+        valid = (found < len(self._gene_sorted)) & (np.asarray(self._gene_sorted[found]) == gene_ids) if len(self._gene_sorted) else np.zeros(len(gene_ids), bool)
+        if not valid.all():
+            raise KeyError(f"Genes no encontrados: {', '.join(gene_ids[~valid][:10])}{' ...' if (~valid).sum() > 10 else ''}")
+        return np.asarray(self._gene_order[found])
+
+    def sample_positions(self, sample_ids):
+        """Posiciones (columna) de las muestras pedidas; KeyError con las que no existen."""
+        missing = [s for s in sample_ids if s not in self._sample_positions]
+        if missing:
+            raise KeyError(f"Muestras no encontradas: {', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}")
+        return np.asarray([self._sample_positions[s] for s in sample_ids], dtype=np.int64)
+
+    def rows(self, gene_ids, sample_ids=None):
+        """Genes pedidos x todas (o algunas) muestras, como DataFrame en el orden solicitado."""
+        positions = self.gene_positions(gene_ids)
+        columns = self.sample_positions(sample_ids) if sample_ids is not None else slice(None)
+        tile_genes, n_genes = self.meta['tile_genes'], self.shape[0]
+        result = np.empty((len(positions), self.shape[1]), dtype=self.dtype)
+        for tile_index in np.unique(positions // tile_genes):
+            start = tile_index * tile_genes
+            tile = self._tile("by_gene", tile_index, (min(tile_genes, n_genes - start), self.shape[1]))
+            hits = np.nonzero(positions // tile_genes == tile_index)[0]
+            result[hits] = tile[positions[hits] - start]
+        return self._frame(result[:, columns], positions, self.samples[columns])
+
+    def columns(self, sample_ids, gene_ids=None):
+        """Todas (o algunas) filas x muestras pedidas, como DataFrame en el orden solicitado."""
+        positions = self.sample_positions(sample_ids)
+        rows = self.gene_positions(gene_ids) if gene_ids is not None else slice(None)
+        tile_samples, n_samples = self.meta['tile_samples'], self.shape[1]
+        result = np.empty((self.shape[0], len(positions)), dtype=self.dtype)
+        for tile_index in np.unique(positions // tile_samples):
+            start = tile_index * tile_samples
+            tile = self._tile("by_sample", tile_index, (self.shape[0], min(tile_samples, n_samples - start)))
+            hits = np.nonzero(positions // tile_samples == tile_index)[0]
+            result[:, hits] = tile[:, positions[hits] - start]
+        gene_positions = np.arange(self.shape[0])[rows]
+        return self._frame(result[rows], gene_positions, self.samples[positions])
+
+    def _frame(self, values, gene_positions, sample_names):
+        frame = pd.DataFrame(values, index=pd.Index(np.asarray(self.genes[gene_positions]), name=self.meta.get('index_name')),
+                             columns=list(sample_names))
+        return frame
+
+
+def parse_id_list(value):
+    """'A,B,C' o '@archivo' (un ID por línea)."""
+    if value is None:
+        return None
+    if value.startswith('@'):
+        with open(value[1:], 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    return [v for v in value.split(',') if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Almacén en disco de matrices (genes x muestras) con consultas rápidas por gen o muestra.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Crea el almacén a partir de una matriz TSV/CSV.")
+    build_parser.add_argument("matrix_file")
+    build_parser.add_argument("-o", "--store_dir", help="Carpeta del almacén (por defecto <matriz>.mstore).")
+    build_parser.add_argument("--tile_genes", type=int, default=16)
+    build_parser.add_argument("--tile_samples", type=int, default=2)
+    build_parser.add_argument("--memory_mb", type=int, default=256)
+    query_parser = subparsers.add_parser("query", help="Extrae un corte de genes y/o muestras.")
+    query_parser.add_argument("store_dir")
+    query_parser.add_argument("--genes", help="IDs separados por comas o @archivo.")
+    query_parser.add_argument("--samples", help="IDs separados por comas o @archivo.")
+    query_parser.add_argument("-o", "--output", help="TSV de salida (por defecto, salida estándar).")
+    info_parser = subparsers.add_parser("info", help="Muestra la forma y el origen del almacén.")
+    info_parser.add_argument("store_dir")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store_dir = build_matrix_store(args.matrix_file, args.store_dir, args.tile_genes, args.tile_samples, args.memory_mb)
+        print(f"Almacén listo: {store_dir}")
+    elif args.command == "info":
+        store = MatrixStore(args.store_dir)
+        print(f"{store.shape[0]} genes x {store.shape[1]} muestras ({store.dtype}) desde {store.meta['source']}")
+    else:
+        store = MatrixStore(args.store_dir)
+        genes, samples = parse_id_list(args.genes), parse_id_list(args.samples)
+        if genes is None and samples is None:
+            print("ERROR: indica --genes y/o --samples."); sys.exit(1)
+        try:
+            result = store.rows(genes, samples) if genes is not None else store.columns(samples)
+        except KeyError as e:
+            print(f"ERROR: {e.args[0]}"); sys.exit(1)
+        result.to_csv(args.output or sys.stdout, sep='\t')
@@ -0,0 +1,299 @@
+import os
+import re
+import glob
+import json
+import argparse
+import logging
+
+# ==============================================================================
+# REPARTO ADAPTATIVO DE NÚCLEOS Y MEMORIA
+# ==============================================================================
+# 'threads', 'threads_per_sample' y 'max_parallel_samples' eran tres valores fijos e
+# independientes: los índices STAR y HISAT2 se construían a la vez con todos los hilos
+# cada uno, y N muestras x (genoma STAR + limitBAMsortRAM) podía superar la memoria del
+# job y acabar en un OOM kill. Aquí se lee la asignación real (SLURM, cgroups, afinidad
+# de CPU, /proc/meminfo) y se reparte entre los pasos concurrentes con un modelo de
+# memoria aproximado por herramienta.
+
+GiB = 1024 ** 3
+MiB = 1024 ** 2
+
+# Memoria de construcción de índices por base del FASTA de entrada (documentación de cada herramienta):
+# STAR ~32 GB para el genoma humano; hisat2-build con --ss/--exon ~160-200 GB; Salmon/kallisto sobre el transcriptoma.
+INDEX_BUILD_BYTES_PER_BASE = {"STAR": 11, "HISAT2": 60, "SALMON": 20, "KALLISTO": 20}
+INDEX_BUILD_MIN_BYTES = 2 * GiB
+# Memoria por hilo de alineamiento (búferes de lectura/escritura) y fija por proceso.
+ALIGNER_THREAD_BYTES = 256 * MiB
+ALIGNER_BASE_BYTES = 512 * MiB
+# Trimmomatic (JVM) y FastQC: techo práctico por muestra en la etapa de QC.
+QC_STAGE_BYTES = 2 * GiB
+DEFAULT_RESERVED_BYTES = 2 * GiB
+MEMORY_UNITS = {"B": 1, "K": 1024, "M": MiB, "G": GiB, "T": 1024 * GiB}
+PROC_CGROUP = "/proc/self/cgroup"
+PROC_MOUNTINFO = "/proc/self/mountinfo"
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def parse_memory(value, default_unit="M"):
+    """
+    '768M', '32G', '100B', bytes enteros o un texto numérico sin unidad -> bytes. Al texto sin unidad
+    se le aplica 'default_unit': "M" como en SLURM, "B" para parámetros en bytes como limitBAMsortRAM de STAR.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(B?)\s*", str(value).upper())
+    if not match:
+        return None
+    unit = match.group(2) or ("B" if match.group(3) else default_unit)
+    return int(float(match.group(1)) * MEMORY_UNITS[unit])
+
+
+def read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_mounts():
+    """{controlador: (punto de montaje, raíz del montaje)} según /proc/self/mountinfo; la clave '' es cgroup v2."""
+    mounts = {}
+    try:
+        with open(PROC_MOUNTINFO, 'r') as f:
+            for line in f:
+                mount_fields, _, fs_fields = line.partition(" - ")
+                mount_fields, fs_fields = mount_fields.split(), fs_fields.split()
+                if len(mount_fields) < 5 or len(fs_fields) < 3:
+                    continue
+                if fs_fields[0] == "cgroup2":
+                    mounts.setdefault("", (mount_fields[4], mount_fields[3]))
+                elif fs_fields[0] == "cgroup":
+                    for controller in set(fs_fields[2].split(",")) & {"cpu", "memory"}:
+                        mounts.setdefault(controller, (mount_fields[4], mount_fields[3]))
+    except OSError:
+        pass
+    return mounts
+
+
+def cgroup_directories(controller, mounts):
+    """
+    Directorios del cgroup del proceso para 'controller' ('' = v2), desde el propio cgroup
+    (p. ej. /sys/fs/cgroup/system.slice/slurmstepd.scope/job_123/step_0) hasta el punto de montaje.
+    En SLURM el límite suele estar en un ancestro (job_N), no en la raíz ni en el propio step.
+    """
+    default_mount = CGROUP_ROOT if controller == "" else os.path.join(CGROUP_ROOT, controller)
+    mount_point, mount_root = mounts.get(controller, (default_mount, "/"))
+    cgroup_path = "/"
+    try:
+        with open(PROC_CGROUP, 'r') as f:
+            for line in f:
+                parts = line.rstrip("\n").split(":", 2)
+                if len(parts) == 3 and (parts[1] == controller if controller == "" else controller in parts[1].split(",")):
+                    cgroup_path = parts[2]
+                    break
+    except OSError:
+        pass
+    # Con namespaces de cgroup la ruta ya es relativa al montaje; si no, se le quita la raíz montada.
+    relative = os.path.relpath(cgroup_path, mount_root) if os.path.commonpath([cgroup_path, mount_root]) == mount_root else cgroup_path
+    directory = os.path.normpath(os.path.join(mount_point, relative.lstrip("/")))
+    directories = [directory]
+    while directory != mount_point and directory.startswith(mount_point + os.sep):
+        directory = os.path.dirname(directory)
+        directories.append(directory)
+    return directories
+
+
+def detect_cgroup_limits():
+    """
+    Límites de CPU y memoria del cgroup del proceso (v2 o v1); None donde no hay límite.
+    Se recorre desde el cgroup propio hasta la raíz y se toma el límite más estricto, que es el efectivo.
+    """
+    mounts = cgroup_mounts()
+    cpu_limits, memory_limits = [], []
+    for directory in cgroup_directories("", mounts):
+        cpu_max = read_first_line(os.path.join(directory, "cpu.max"))
+        if cpu_max:
+            quota, _, period = cpu_max.partition(" ")
+            if quota != "max" and period:
+                cpu_limits.append(int(quota) / int(period))
+        memory_max = read_first_line(os.path.join(directory, "memory.max"))
+        if memory_max and memory_max.isdigit():
+            memory_limits.append(int(memory_max))
+    if not cpu_limits:
+        for directory in cgroup_directories("cpu", mounts):
+            quota, period = read_first_line(os.path.join(directory, "cpu.cfs_quota_us")), read_first_line(os.path.join(directory, "cpu.cfs_period_us"))
+            if quota and period and quota.lstrip("-").isdigit() and int(quota) > 0:
+                cpu_limits.append(int(quota) / int(period))
+    if not memory_limits:
+        for directory in cgroup_directories("memory", mounts):
+            limit = read_first_line(os.path.join(directory, "memory.limit_in_bytes"))
+            # v1 sin límite escribe un valor cercano a 2^63.
+            if limit and limit.isdigit() and int(limit) < 2 ** 60:
+                memory_limits.append(int(limit))
+    cpus = max(1, int(min(cpu_limits))) if cpu_limits else None
+    memory = min(memory_limits) if memory_limits else None
+    return cpus, memory
+
+
+def available_system_memory():
+    """MemAvailable de /proc/meminfo en bytes (None si no existe)."""
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def detect_resources(resources_config=None):
+    """
+    CPUs y memoria utilizables por el job: el mínimo entre la asignación de SLURM, el cgroup,
+    la afinidad de CPU y la memoria libre del nodo. 'cpus' / 'memory_gb' en el JSON fuerzan los valores.
+    """
+    resources_config = resources_config or {}
+    cpu_candidates, memory_candidates, sources = [], [], []
+
+    if hasattr(os, "sched_getaffinity"):
+        cpu_candidates.append(len(os.sched_getaffinity(0)))
+    else:
+        cpu_candidates.append(os.cpu_count() or 1)
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK") or os.environ.get("SLURM_CPUS_ON_NODE")
+    if slurm_cpus and slurm_cpus.isdigit():
+        cpu_candidates.append(int(slurm_cpus)); sources.append("SLURM")
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        memory_candidates.append(parse_memory(os.environ["SLURM_MEM_PER_NODE"]))
+    elif os.environ.get("SLURM_MEM_PER_CPU") and slurm_cpus and slurm_cpus.isdigit():
+        memory_candidates.append(parse_memory(os.environ["SLURM_MEM_PER_CPU"]) * int(slurm_cpus))
+
+    cgroup_cpus, cgroup_memory = detect_cgroup_limits()
+    if cgroup_cpus or cgroup_memory:
+        sources.append("cgroup")
+    if cgroup_cpus: cpu_candidates.append(cgroup_cpus)
+    if cgroup_memory: memory_candidates.append(cgroup_memory)
+    system_memory = available_system_memory()
+    if system_memory: memory_candidates.append(system_memory)
+
+    cpus = int(resources_config.get("cpus") or min(cpu_candidates))
+    memory = int(resources_config["memory_gb"] * GiB) if resources_config.get("memory_gb") else \
+        min([m for m in memory_candidates if m] or [16 * GiB])
+    reserved = int(resources_config.get("reserve_memory_gb", DEFAULT_RESERVED_BYTES / GiB) * GiB)
+    return {'cpus': max(1, cpus), 'memory_bytes': max(GiB, memory - reserved),
+            'source': "+".join(sources) or "nodo"}
+
+
+def path_size(paths):
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def index_build_memory(tool, input_fasta):
+    """Memoria estimada para construir el índice de 'tool' a partir de 'input_fasta'."""
+    if not input_fasta or not os.path.exists(input_fasta):
+        return INDEX_BUILD_MIN_BYTES
+    return max(INDEX_BUILD_MIN_BYTES, os.path.getsize(input_fasta) * INDEX_BUILD_BYTES_PER_BASE.get(tool.upper(), 11))
+
+
+def plan_index_builds(build_memory, resources):
+    """
+    Reparte los hilos entre las construcciones de índice simultáneas ({herramienta: memoria}).
+    Si juntas no caben en memoria se construyen de una en una, cada una con todos los hilos.
+    Devuelve ({herramienta: hilos}, nº de construcciones concurrentes).
+    """
+    if not build_memory:
+        return {}, 1
+    cpus, memory = resources['cpus'], resources['memory_bytes']
+    for tool, needed in build_memory.items():
+        if needed > memory:
+            logging.warning(f"⚠️ El índice {tool} necesita ~{needed / GiB:.0f} GB y el job dispone de ~{memory / GiB:.0f} GB: riesgo de OOM.")
+    if sum(build_memory.values()) > memory or len(build_memory) > cpus:
+        return {tool: cpus for tool in build_memory}, 1
+    share, extra = divmod(cpus, len(build_memory))
+    return {tool: share + (1 if i < extra else 0) for i, tool in enumerate(build_memory)}, len(build_memory)
+
+
+def aligner_index_bytes(aligner, paths):
+    """Tamaño en disco del índice ya construido (lo que el alineador carga en RAM)."""
+    if aligner == "STAR":
+        index_dir = paths.get('star_index_dir', paths.get('reference_dir', ""))
+        return path_size([os.path.join(index_dir, f) for f in ("Genome", "SA", "SAindex")])
+    if aligner == "HISAT2":
+        return path_size(glob.glob(f"{paths.get('hisat2_index_prefix', '')}*.ht2"))
+    index_dir = paths.get('pseudo_index_dir', "")
+    return path_size(glob.glob(os.path.join(index_dir, "**", "*"), recursive=True)) if index_dir else 0
+
+
+def sample_memory_model(tool_params, paths, aligners, shared_star_genome=False):
+    """
+    Función hilos -> bytes por muestra en la etapa de alineamiento (el máximo entre los alineadores,
+    que se ejecutan en serie dentro de cada muestra). Con genoma STAR compartido el genoma no se cuenta.
+    """
+    index_bytes = {aligner: aligner_index_bytes(aligner, paths) for aligner in aligners}
+    star_sort = parse_memory(tool_params.get("star", {}).get("limitBAMsortRAM", 10000000000), default_unit="B")
+    hisat2_params = tool_params.get("hisat2", {})
+    sort_per_thread = parse_memory(hisat2_params.get("sort_memory_per_thread", "768M"))
+
+    def model(threads):
+        per_aligner = [QC_STAGE_BYTES]
+        for aligner in aligners:
+            needed = ALIGNER_BASE_BYTES + ALIGNER_THREAD_BYTES * threads
+            if aligner == "STAR":
+                needed += star_sort + (0 if shared_star_genome else index_bytes[aligner])
+            elif aligner == "HISAT2":
+                # Con stream_to_sort HISAT2 y samtools sort conviven en memoria; en el flujo SAM -> BAM van uno tras otro.
+                sort_bytes = sort_per_thread * threads
+                needed += index_bytes[aligner] + sort_bytes if hisat2_params.get("stream_to_sort", False) else max(index_bytes[aligner], sort_bytes)
+            else:
+                needed += index_bytes[aligner]
+            per_aligner.append(needed)
+        return max(per_aligner)
+    return model, (index_bytes.get("STAR", 0) if shared_star_genome else 0)
+
+
+def plan_sample_slots(resources, memory_model, n_samples, shared_bytes=0, min_threads_per_sample=2, max_parallel_samples=None):
+    """
+    Elige (hilos por muestra, muestras en paralelo) que maximizan los núcleos ocupados sin exceder la
+    memoria: n * memoria(hilos) + memoria compartida <= memoria del job. A igual ocupación, más
+    muestras con menos hilos (los alineadores escalan peor que lineal).
+    """
+    cpus, memory = resources['cpus'], resources['memory_bytes'] - shared_bytes
+    min_threads = max(1, min(min_threads_per_sample, cpus))
+    best = None
+    for threads in range(min_threads, cpus + 1):
+        parallel = min(cpus // threads, memory // memory_model(threads), max(1, n_samples), max_parallel_samples or cpus)
+        if parallel >= 1 and (best is None or (parallel * threads, parallel) > best[:2]):
+            best = (parallel * threads, parallel, threads)
+    if best is None:
+        logging.warning(f"⚠️ Ni una muestra cabe en la memoria estimada (~{memory_model(min_threads) / GiB:.1f} GB por muestra, "
+                        f"{max(0, memory) / GiB:.1f} GB libres): se procesarán de una en una.")
+        return min_threads, 1
+    return best[2], best[1]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Muestra los recursos detectados y el reparto que haría el pipeline.")
+    parser.add_argument("--config", help="JSON del proyecto (usa tool_parameters.resources y los parámetros de STAR/HISAT2).")
+    parser.add_argument("--fasta", help="FASTA del genoma, para estimar la construcción de índices.")
+    parser.add_argument("--star_index_dir", help="Índice STAR ya construido, para el modelo de memoria por muestra.")
+    parser.add_argument("--hisat2_index_prefix", help="Prefijo del índice HISAT2 ya construido.")
+    parser.add_argument("--samples", type=int, default=8)
+    args = parser.parse_args()
+
+    tool_params = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            tool_params = json.load(f).get("tool_parameters", {})
+    resources = detect_resources(tool_params.get("resources", {}))
+    print(f"Recursos ({resources['source']}): {resources['cpus']} CPUs, {resources['memory_bytes'] / GiB:.1f} GB utilizables")
+    aligners = [a for a, p in (("STAR", args.star_index_dir), ("HISAT2", args.hisat2_index_prefix)) if p] or ["STAR"]
+    if args.fasta:
+        threads_by_tool, concurrent_builds = plan_index_builds({a: index_build_memory(a, args.fasta) for a in aligners}, resources)
+        print(f"Índices: {threads_by_tool} ({concurrent_builds} a la vez)")
+    model, shared_bytes = sample_memory_model(tool_params, {'star_index_dir': args.star_index_dir or "", 'hisat2_index_prefix': args.hisat2_index_prefix or ""},
+                                              aligners, tool_params.get("star", {}).get("shared_memory_genome", False))
+    threads, parallel = plan_sample_slots(resources, model, args.samples, shared_bytes, tool_params.get("threads_per_sample", 2))
+    print(f"Muestras: {parallel} en paralelo x {threads} hilos (~{model(threads) / GiB:.1f} GB por muestra)")
@@ -0,0 +1,217 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+
+from index_cache import file_sha256, compute_cache_key
+
+# ==============================================================================
+# PLANIFICADOR DE EJECUCIÓN (DAG) CON DETECCIÓN DE OBSOLESCENCIA POR HASH
+# ==============================================================================
+# Cada paso declara entradas, salidas y parámetros. Un manifiesto en base_dir guarda
+# la huella de los tres tras cada ejecución. Antes de ejecutar, el planificador marca
+# como obsoletos los pasos cuyos parámetros (propios o de sus ancestros) o entradas
+# han cambiado, o cuyas salidas faltan, y borra sus salidas. Así la lógica de
+# reanudación existente ("si la salida existe, saltar") re-ejecuta exactamente el
+# subgrafo obsoleto y nada más.
+
+MANIFEST_FILE = ".omnirna_manifest.json"
+SAMPLE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def make_step(name, inputs=(), outputs=(), params=None, temporary_outputs=()):
+    """
+    Declara un paso del DAG. 'temporary_outputs' son intermedios que el pipeline puede purgar
+    (FASTQ recortados...): su ausencia no vuelve obsoleto el paso.
+    """
+    return {'name': name, 'inputs': [p for p in inputs if p], 'outputs': [p for p in outputs if p],
+            'temporary': [p for p in temporary_outputs if p], 'params': params or {}}
+
+
+def path_signature(path, full_hash_max_mb=512):
+    """Huella de un archivo o carpeta; None si no existe."""
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        listing = []
+        for root, _, files in os.walk(path):
+            for fname in sorted(files):
+                fpath = os.path.join(root, fname)
+                stat = os.stat(fpath)
+                listing.append((os.path.relpath(fpath, path), stat.st_size, int(stat.st_mtime)))
+        return "dir:" + compute_cache_key(sorted(listing))
+    size = os.path.getsize(path)
+    if size <= full_hash_max_mb * 1024 * 1024:
+        return file_sha256(path)
+    # BAM/FASTQ/índices grandes: tamaño más hash de tres bloques (inicio, mitad y final).
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in (0, size // 2, max(0, size - SAMPLE_CHUNK_SIZE)):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_CHUNK_SIZE))
+    return "sampled:" + digest.hexdigest()
+
+
+def load_manifest(base_dir):
+    manifest_path = os.path.join(base_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(base_dir, manifest):
+    manifest_path = os.path.join(base_dir, MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def link_steps(steps):
+    """Dependencias implícitas: un paso depende de quien produce alguna de sus entradas."""
+    producers = {}
+    for step in steps:
+        for path in step['outputs'] + step['temporary']:
+            producers[path] = step['name']
+    for step in steps:
+        step['deps'] = sorted({producers[p] for p in step['inputs'] if p in producers and producers[p] != step['name']})
+    return steps
+
+
+def params_hashes(steps):
+    """Hash de parámetros encadenado: incluye el de los ancestros (un cambio en Trimmomatic alcanza al BAM)."""
+    by_name = {step['name']: step for step in steps}
+    hashes = {}
+
+    def resolve(name, visiting=()):
+        if name in hashes:
+            return hashes[name]
+        if name in visiting:
+            raise ValueError(f"Ciclo en el DAG del pipeline en el paso '{name}'.")
+        step = by_name[name]
+        upstream = [resolve(dep, visiting + (name,)) for dep in step['deps']]
+        hashes[name] = compute_cache_key({'params': step['params'], 'upstream': upstream})
+        return hashes[name]
+
+    for step in steps:
+        resolve(step['name'])
+    return hashes
+
+
+def plan_run(steps, manifest, full_hash_max_mb=512):
+    """
+    Devuelve [(paso, estado, motivo)] en orden de declaración; estado es 'ok', 'adoptado',
+    'pendiente' (nunca ejecutado) u 'obsoleto' (se invalidará y re-ejecutará).
+    """
+    link_steps(steps)
+    hashes = params_hashes(steps)
+    stale = set()
+    plan = []
+    for step in steps:
+        record = manifest.get(step['name'])
+        final_outputs = [p for p in step['outputs'] if p not in step['temporary']]
+        stale_deps = [dep for dep in step['deps'] if dep in stale]
+        status, reason = 'ok', ""
+
+        if stale_deps:
+            status, reason = 'obsoleto', f"depende de {stale_deps[0]}"
+        elif record is None:
+            # Resultados de ejecuciones previas al manifiesto: se adoptan si están completos.
+            if all(os.path.exists(p) for p in final_outputs):
+                status, reason = 'adoptado', "salidas existentes sin registro"
+            else:
+                status, reason = 'pendiente', "sin ejecutar"
+        elif record.get('params') != hashes[step['name']]:
+            status, reason = 'obsoleto', "parámetros cambiados"
+        else:
+            for path in step['inputs']:
+                current = path_signature(path, full_hash_max_mb)
+                recorded = record.get('inputs', {}).get(path)
+                # Entradas purgadas (None) no invalidan: solo cuenta un contenido distinto.
+                if current is not None and recorded is not None and current != recorded:
+                    status, reason = 'obsoleto', f"entrada modificada: {os.path.basename(path)}"
+                    break
+            if status == 'ok':
+                for path in final_outputs:
+                    current = path_signature(path, full_hash_max_mb)
+                    if current is None:
+                        status, reason = 'pendiente', f"salida ausente: {os.path.basename(path)}"
+                        break
+                    if current != record.get('outputs', {}).get(path):
+                        status, reason = 'obsoleto', f"salida modificada: {os.path.basename(path)}"
+                        break
+
+        if status in ('obsoleto', 'pendiente'):
+            stale.add(step['name'])
+        plan.append((step, status, reason))
+    return plan
+
+
+def invalidate_stale_outputs(plan):
+    """Borra las salidas de los pasos obsoletos para que el pipeline las regenere."""
+    removed = 0
+    for step, status, _ in plan:
+        if status != 'obsoleto':
+            continue
+        for path in step['outputs'] + step['temporary']:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True); removed += 1
+            elif os.path.lexists(path):
+                os.remove(path); removed += 1
+    return removed
+
+
+def record_manifest(base_dir, steps, full_hash_max_mb=512):
+    """Registra la huella de los pasos completos (todas sus salidas finales presentes) al terminar."""
+    manifest = load_manifest(base_dir)
+    link_steps(steps)
+    hashes = params_hashes(steps)
+    recorded = 0
+    for step in steps:
+        final_outputs = [p for p in step['outputs'] if p not in step['temporary']]
+        checked_outputs = final_outputs or step['temporary']
+        if not checked_outputs or not all(os.path.exists(p) for p in checked_outputs):
+            continue
+        previous = manifest.get(step['name'], {})
+        inputs = {}
+        for path in step['inputs']:
+            signature = path_signature(path, full_hash_max_mb)
+            inputs[path] = signature if signature is not None else previous.get('inputs', {}).get(path)
+        manifest[step['name']] = {
+            'params': hashes[step['name']],
+            'inputs': inputs,
+            'outputs': {p: path_signature(p, full_hash_max_mb) for p in final_outputs}
+        }
+        recorded += 1
+    save_manifest(base_dir, manifest)
+    logging.info(f"🗂️  Manifiesto de ejecución actualizado: {recorded} pasos registrados.")
+
+
+def format_plan(plan):
+    """Tabla legible del plan (para --dry-run)."""
+    icons = {'ok': "✅", 'adoptado': "📎", 'pendiente': "▶️ ", 'obsoleto': "♻️ "}
+    lines = [f"{'PASO':<40}{'ESTADO':<12}MOTIVO"]
+    for step, status, reason in plan:
+        lines.append(f"{icons[status]} {step['name']:<37}{status:<12}{reason}")
+    to_run = sum(1 for _, status, _ in plan if status in ('obsoleto', 'pendiente'))
+    lines.append(f"\n{to_run} de {len(plan)} pasos se ejecutarán "
+                 f"({sum(1 for _, s, _ in plan if s == 'obsoleto')} por obsolescencia).")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspecciona el manifiesto de ejecución de un proyecto.")
+    parser.add_argument("base_dir", help="Carpeta 'base_dir' del proyecto.")
+    parser.add_argument("--forget", nargs="+", metavar="PASO", help="Elimina pasos del manifiesto (se tratarán como no registrados).")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.base_dir)
+    if args.forget:
+        for name in args.forget:
+            manifest.pop(name, None)
+        save_manifest(args.base_dir, manifest)
+    print(f"Manifiesto: {os.path.join(args.base_dir, MANIFEST_FILE)} ({len(manifest)} pasos registrados)")
+    for name in sorted(manifest):
+        print(f"  {name}\t{len(manifest[name]['inputs'])} entradas\t{len(manifest[name]['outputs'])} salidas")
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import shlex
+import logging
+import argparse
+import threading
+import subprocess
+import importlib.util
+import concurrent.futures
+
+# ==============================================================================
+# BACKEND SLURM: REPARTO DE MUESTRAS COMO JOB ARRAY EN VARIOS NODOS
+# ==============================================================================
+# En lugar de procesar todas las muestras dentro del job maestro con un
+# ProcessPoolExecutor, cada muestra se convierte en una tarea de un job array de
+# SLURM que ejecuta pipeline_worker_for_sample() en su propio nodo. El maestro espera
+# a que termine el array (squeue), recoge el estado de cada tarea y continúa con la
+# agregación (conteo, DESeq2, MultiQC) como siempre.
+#
+# Para probar sin clúster: SBATCH_CMD y SQUEUE_CMD apuntan a los sustitutos locales
+# de este mismo script (--fake_sbatch / --fake_squeue), que ejecutan las tareas en local.
+
+FAKE_SLURM_DIR = os.environ.get("FAKE_SLURM_DIR", os.path.join(os.path.expanduser("~"), ".omnirna_fake_slurm"))
+
+
+def load_pipeline_core():
+    """Importa 01_pipeline_core.py (su nombre no es un identificador Python válido)."""
+    core_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "01_pipeline_core.py")
+    spec = importlib.util.spec_from_file_location("pipeline_core", core_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(core_path))
+    spec.loader.exec_module(module)
+    return module
+
+
+def slurm_command(env_var, default):
+    """Comando de SLURM configurable por variable de entorno (como APPTAINER_CMD); admite argumentos."""
+    return shlex.split(os.environ.get(env_var, default))
+
+
+def write_array_script(job_dir, n_tasks, executor_config, threads_per_sample):
+    """Genera el script sbatch del job array: cada tarea ejecuta una muestra del spec."""
+    max_concurrent = executor_config.get("max_concurrent")
+    array_range = f"0-{n_tasks - 1}" + (f"%{max_concurrent}" if max_concurrent else "")
+    directives = [
+        f"--job-name={executor_config.get('job_name', 'RNAseq_Sample')}",
+        f"--array={array_range}",
+        f"--output={os.path.join(job_dir, 'logs', '%x_%A_%a.out')}",
+        f"--error={os.path.join(job_dir, 'logs', '%x_%A_%a.err')}",
+        "--ntasks=1",
+        f"--cpus-per-task={executor_config.get('cpus_per_task', threads_per_sample)}",
+        f"--mem={executor_config.get('mem', '32G')}",
+        f"--time={executor_config.get('time', '12:00:00')}",
+    ]
+    if executor_config.get("partition"):
+        directives.append(f"--partition={executor_config['partition']}")
+    directives.extend(executor_config.get("extra_sbatch_args", []))
+
+    lines = ["#!/bin/bash"] + [f"#SBATCH {d}" for d in directives] + [""]
+    # Preparación del entorno del nodo (module load, exports...), igual que en RNA_SEQ_LETS_TRY.sh.
+    lines.extend(executor_config.get("setup_commands", []))
+    lines.append(f"{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} "
+                 f"--run_task {shlex.quote(os.path.join(job_dir, 'job_spec.json'))} --task_id \"$SLURM_ARRAY_TASK_ID\"")
+    script_path = os.path.join(job_dir, "array_job.sh")
+    with open(script_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return script_path
+
+
+# Estados de squeue en los que el job aún no ha terminado; el resto (COMPLETED, FAILED, CANCELLED,
+# TIMEOUT...) son finales aunque squeue los muestre durante unos minutos.
+ACTIVE_JOB_STATES = {"PENDING", "RUNNING", "CONFIGURING", "COMPLETING", "SUSPENDED"}
+MAX_SQUEUE_FAILURES = 5
+
+
+def sacct_active_states(job_id):
+    """Estados activos del job según sacct (contabilidad), o None si sacct tampoco responde."""
+    try:
+        result = subprocess.run(slurm_command("SACCT_CMD", "sacct") + ["-j", str(job_id), "-n", "-P", "-X", "-o", "State"],
+                                check=True, capture_output=True, text=True)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return [state for state in (line.split()[0] for line in result.stdout.splitlines() if line.strip()) if state in ACTIVE_JOB_STATES]
+
+
+def wait_for_job(job_id, poll_seconds):
+    """Espera hasta que ninguna tarea del job está en un estado activo."""
+    squeue_cmd = slurm_command("SQUEUE_CMD", "squeue")
+    last_report, failures = None, 0
+    while True:
+        try:
+            result = subprocess.run(squeue_cmd + ["-h", "-j", str(job_id), "-o", "%i %T"], check=True, capture_output=True, text=True)
+            failures = 0
+            states = [line.split()[-1] for line in result.stdout.splitlines() if line.strip()]
+        except subprocess.CalledProcessError as e:
+            # El job ya salió de la memoria de squeue: ha terminado.
+            if "invalid job id" in (e.stderr or "").lower():
+                return
+            failures += 1
+            if failures < MAX_SQUEUE_FAILURES:
+                # squeue falla de forma transitoria con el controlador saturado: se reintenta.
+                logging.warning(f"⚠️ squeue falló ({(e.stderr or str(e)).strip()}). Reintento {failures}/{MAX_SQUEUE_FAILURES} en {poll_seconds}s...")
+                time.sleep(poll_seconds); continue
+            states = sacct_active_states(job_id)
+            if states is None:
+                logging.error(f"❌ Ni squeue ni sacct responden para el job {job_id}. Se recogen los estados disponibles.")
+                return
+        except OSError as e:
+            logging.error(f"❌ No se pudo ejecutar squeue ({e}). Se recogen los estados disponibles."); return
+
+        active = [state for state in states if state in ACTIVE_JOB_STATES]
+        if not active:
+            return
+        report = f"{active.count('RUNNING')} en ejecución, {active.count('PENDING')} en cola"
+        if report != last_report:
+            logging.info(f"⏳ [SLURM] Job {job_id}: {report}.")
+            last_report = report
+        time.sleep(poll_seconds)
+
+
+def run_samples_on_slurm(samples, config, paths, executor_config, check_completed):
+    """
+    Envía las muestras pendientes como un job array, espera a que terminen y devuelve sus estados
+    ('OK: id', 'ERROR: id', 'SALTADO ...') en el mismo orden que 'samples', como el worker local.
+    'check_completed' es check_sample_completed() del núcleo: las muestras ya terminadas no se envían.
+    """
+    base_dir = config.get("project_setup", {}).get("base_dir", ".")
+    threads_per_sample = config.get("tool_parameters", {}).get("threads_per_sample", 2)
+
+    results, pending = {}, []
+    for sample in samples:
+        if not paths['aligners_to_run']:
+            results[sample['id']] = f"SALTADO (No Aligners): {sample['id']}"
+        elif check_completed(sample, config, paths):
+            results[sample['id']] = f"SALTADO (BAMs OK): {sample['id']}"
+        else:
+            pending.append(sample)
+    if not pending:
+        return [results[sample['id']] for sample in samples]
+
+    job_dir = os.path.join(os.path.abspath(base_dir), "SLURM_JOBS", time.strftime("array_%Y%m%d_%H%M%S"))
+    for subdir in ("logs", "status"):
+        os.makedirs(os.path.join(job_dir, subdir), exist_ok=True)
+    with open(os.path.join(job_dir, "job_spec.json"), 'w') as f:
+        json.dump({'config': config, 'paths': paths, 'samples': pending}, f, indent=2)
+    script_path = write_array_script(job_dir, len(pending), executor_config, threads_per_sample)
+
+    try:
+        submit = subprocess.run(slurm_command("SBATCH_CMD", "sbatch") + ["--parsable", script_path], check=True, capture_output=True, text=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.error(f"❌ [SLURM] No se pudo enviar el job array: {getattr(e, 'stderr', e)}")
+        return [results.get(sample['id'], f"ERROR: {sample['id']}") for sample in samples]
+    job_id = submit.stdout.strip().split(';')[0]
+    logging.info(f"🚀 [SLURM] Job array {job_id} enviado: {len(pending)} muestras ({job_dir}).")
+
+    try:
+        wait_for_job(job_id, executor_config.get("poll_seconds", 30))
+    except KeyboardInterrupt:
+        subprocess.run(slurm_command("SCANCEL_CMD", "scancel") + [job_id], capture_output=True)
+        raise
+
+    for task_id, sample in enumerate(pending):
+        status_file = os.path.join(job_dir, "status", f"{task_id}.txt")
+        if os.path.exists(status_file):
+            with open(status_file, 'r') as f:
+                results[sample['id']] = f.read().strip()
+        else:
+            # Sin estado: la tarea murió antes de terminar (OOM, límite de tiempo, nodo caído...).
+            logging.error(f"❌ [SLURM] La tarea {job_id}_{task_id} ({sample['id']}) terminó sin estado. Revisa {job_dir}/logs.")
+            results[sample['id']] = f"ERROR: {sample['id']}"
+    failed = [sample['id'] for sample in pending if results[sample['id']].startswith("ERROR")]
+    logging.info(f"🏁 [SLURM] Job array {job_id} finalizado: {len(pending) - len(failed)} OK, {len(failed)} con error.")
+    return [results[sample['id']] for sample in samples]
+
+
+def run_task(spec_file, task_id):
+    """Punto de entrada de cada tarea del array: procesa UNA muestra y deja su estado en disco."""
+    with open(spec_file, 'r') as f:
+        spec = json.load(f)
+    sample = spec['samples'][task_id]
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [%(levelname)s] [{sample['id']}] - %(message)s")
+    core = load_pipeline_core()
+    status = core.pipeline_worker_for_sample(sample, spec['config'], spec['paths'])
+    status_file = os.path.join(os.path.dirname(spec_file), "status", f"{task_id}.txt")
+    with open(f"{status_file}.tmp", 'w') as f:
+        f.write(f"{status}\n")
+    os.replace(f"{status_file}.tmp", status_file)
+    return 1 if status.startswith("ERROR") else 0
+
+
+# ==============================================================================
+# SUSTITUTOS LOCALES DE sbatch / squeue (pruebas sin clúster)
+# ==============================================================================
+
+def parse_array_directive(script_path, cli_args):
+    """Rango del array ('0-9%2') desde la línea de comandos o las directivas #SBATCH del script."""
+    directives = list(cli_args)
+    with open(script_path, 'r') as f:
+        directives += [line[len("#SBATCH "):].strip() for line in f if line.startswith("#SBATCH ")]
+    array_spec = next((d.split('=', 1)[1] for d in directives if d.startswith("--array=")), "0-0")
+    output_spec = next((d.split('=', 1)[1] for d in directives if d.startswith("--output=")), "slurm-%A_%a.out")
+    job_name = next((d.split('=', 1)[1] for d in directives if d.startswith("--job-name=")), "job")
+    task_range, _, limit = array_spec.partition('%')
+    first, _, last = task_range.partition('-')
+    return list(range(int(first), int(last or first) + 1)), int(limit) if limit else None, output_spec, job_name
+
+
+def fake_state_path(job_id):
+    return os.path.join(FAKE_SLURM_DIR, f"{job_id}.json")
+
+
+def fake_sbatch(argv):
+    """'sbatch' local: asigna un id, lanza las tareas en segundo plano y devuelve el id (--parsable)."""
+    script_path = argv[-1]
+    os.makedirs(FAKE_SLURM_DIR, exist_ok=True)
+    job_id = str(int(time.time() * 1000) % 10 ** 9)
+    tasks, _, _, _ = parse_array_directive(script_path, [a for a in argv[:-1] if a.startswith("--")])
+    with open(fake_state_path(job_id), 'w') as f:
+        json.dump({str(t): "PENDING" for t in tasks}, f)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "--fake_runner", job_id, script_path] + argv[:-1],
+                     start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(job_id)
+
+
+def fake_runner(job_id, script_path, cli_args):
+    """Ejecuta las tareas del array en local respetando el límite '%N' de concurrencia."""
+    os.makedirs(FAKE_SLURM_DIR, exist_ok=True)
+    tasks, limit, output_spec, job_name = parse_array_directive(script_path, cli_args)
+    states = {str(t): "PENDING" for t in tasks}
+    states_lock = threading.Lock()
+
+    def set_state(task_id, state):
+        # Los hilos terminan a la vez: actualización y escritura (tmp + rename) bajo el mismo candado.
+        with states_lock:
+            if task_id is not None:
+                states[str(task_id)] = state
+            with open(f"{fake_state_path(job_id)}.tmp", 'w') as f:
+                json.dump(states, f)
+            os.replace(f"{fake_state_path(job_id)}.tmp", fake_state_path(job_id))
+
+    def run_one(task_id):
+        set_state(task_id, "RUNNING")
+        code = None
+        try:
+            log_path = output_spec.replace("%x", job_name).replace("%A", job_id).replace("%a", str(task_id))
+            env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(task_id))
+            with open(log_path, 'w') as log:
+                code = subprocess.run(["bash", script_path], env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+        except Exception as e:
+            logging.error(f"❌ Tarea {job_id}_{task_id} no se pudo lanzar: {e}")
+        set_state(task_id, "COMPLETED" if code == 0 else "FAILED")
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=limit or len(tasks) or 1) as executor:
+            list(executor.map(run_one, tasks))
+    finally:
+        # Si el propio runner falla, ninguna tarea puede quedar PENDING/RUNNING para siempre en 'squeue'.
+        with states_lock:
+            for task_id, state in states.items():
+                if state in ("PENDING", "RUNNING"):
+                    states[task_id] = "FAILED"
+        set_state(None, None)
+
+
+def fake_squeue(argv):
+    """'squeue -h -j ID -o "%i %T"' local: lista las tareas aún en cola o en ejecución."""
+    job_id = argv[argv.index("-j") + 1]
+    if not os.path.exists(fake_state_path(job_id)):
+        print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr); sys.exit(1)
+    with open(fake_state_path(job_id), 'r') as f:
+        states = json.load(f)
+    for task_id, state in sorted(states.items(), key=lambda kv: int(kv[0])):
+        if state in ("PENDING", "RUNNING"):
+            print(f"{job_id}_{task_id} {state}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--fake_sbatch":
+        fake_sbatch([a for a in sys.argv[2:] if a != "--parsable"]); sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--fake_squeue":
+        fake_squeue(sys.argv[2:]); sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--fake_runner":
+        fake_runner(sys.argv[2], sys.argv[3], sys.argv[4:]); sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Backend SLURM (job array por muestra) del pipeline y sus sustitutos locales.")
+    parser.add_argument("--run_task", metavar="JOB_SPEC", help="Ejecuta una tarea del array (uso interno del script sbatch).")
+    parser.add_argument("--task_id", type=int, help="Índice de la tarea ($SLURM_ARRAY_TASK_ID).")
+    parser.add_argument("--fake_sbatch", action="store_true", help="Sustituto local de 'sbatch' (SBATCH_CMD).")
+    parser.add_argument("--fake_squeue", action="store_true", help="Sustituto local de 'squeue' (SQUEUE_CMD).")
+    args = parser.parse_args()
+    if args.run_task is None or args.task_id is None:
+        parser.print_help(); sys.exit(1)
+    sys.exit(run_task(args.run_task, args.task_id))
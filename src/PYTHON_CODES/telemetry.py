@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+
+# ==============================================================================
+# TELEMETRÍA DE RECURSOS POR HERRAMIENTA EXTERNA
+# ==============================================================================
+# Cada invocación de herramienta (STAR, HISAT2, samtools, Trimmomatic, FastQC,
+# featureCounts, StringTie, scripts de R...) se ejecuta mediante run_tool(), que
+# recoge el rusage del hijo con os.wait4 (tiempo de CPU, pico de RSS y bloques de
+# E/S a disco del árbol de procesos) y los bytes leídos/escritos de /proc/<pid>/io, y
+# añade un registro JSON-lines al perfil de la ejecución.
+
+PROFILE_ENV_VAR = "OMNIRNA_PROFILE_FILE"
+
+
+def configure_telemetry(profile_file):
+    """Activa la telemetría; se propaga por variable de entorno a procesos hijos y jobs."""
+    os.environ[PROFILE_ENV_VAR] = os.path.abspath(profile_file)
+
+
+def append_jsonl(path, record):
+    """Añade un registro a un JSON-lines de forma segura entre procesos concurrentes."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def infer_tool_name(cmd):
+    """Nombre de la herramienta: lo que sigue a '<apptainer> exec [--opciones] <imagen>'."""
+    args = [str(c) for c in cmd]
+    if len(args) > 2 and args[1] == "exec":
+        i = 2
+        while i < len(args) and args[i].startswith("--"):
+            i += 2  # --bind X, --pwd Y
+        if i + 1 < len(args):
+            tool = os.path.basename(args[i + 1])
+            return os.path.basename(args[i + 2]) if tool == "Rscript" and i + 2 < len(args) else tool
+    return os.path.basename(args[0]) if args else "desconocido"
+
+
+def read_proc_io(pid):
+    """(rchar, wchar) de /proc/<pid>/io, o (None, None) si no está disponible (otro SO, sin permisos)."""
+    try:
+        with open(f"/proc/{pid}/io", 'r') as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def run_tool(cmd, stage, sample=None, tool=None, check=True):
+    """
+    Equivalente a subprocess.run(cmd, check=check, capture_output=True, text=True) que además
+    mide tiempo de pared, CPU, pico de RSS, bytes leídos/escritos y E/S de bloques del proceso hijo.
+    """
+    cmd = [str(c) for c in cmd]
+    start_wall = time.time()
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    captured = {}
+    readers = [threading.Thread(target=lambda name=name, stream=stream: captured.__setitem__(name, stream.read()))
+               for name, stream in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+    for reader in readers: reader.start()
+    # Se espera al hijo SIN recogerlo (WNOWAIT): como zombi, su /proc/<pid>/io ya incluye la E/S de todos
+    # los descendientes que esperó (tuberías, STAR -> samtools...), también la servida desde la caché de
+    # páginas o un sistema de archivos de red, que ru_inblock/ru_oublock no ven.
+    read_bytes, write_bytes = None, None
+    if hasattr(os, "waitid"):
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        read_bytes, write_bytes = read_proc_io(proc.pid)
+    # wait4 devuelve el rusage de ESTE hijo (y sus descendientes esperados), no el del proceso entero.
+    _, wait_status, usage = os.wait4(proc.pid, 0)
+    for reader in readers: reader.join()
+    proc.stdout.close(); proc.stderr.close()
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    wall_seconds = time.monotonic() - start
+
+    profile_file = os.environ.get(PROFILE_ENV_VAR)
+    if profile_file:
+        append_jsonl(profile_file, {
+            'timestamp': start_wall,
+            'host': socket.gethostname(),
+            'sample': sample,
+            'stage': stage,
+            'tool': tool or infer_tool_name(cmd),
+            'exit_code': proc.returncode,
+            'wall_s': round(wall_seconds, 3),
+            'user_cpu_s': round(usage.ru_utime, 3),
+            'sys_cpu_s': round(usage.ru_stime, 3),
+            'cpu_efficiency': round((usage.ru_utime + usage.ru_stime) / wall_seconds, 3) if wall_seconds else None,
+            'max_rss_mb': round(usage.ru_maxrss / 1024, 1),  # Linux: ru_maxrss en KiB
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+            # Operaciones de bloque contra el dispositivo (ru_inblock/ru_oublock, unidades de 512 B): no incluyen
+            # lo servido desde la caché de páginas ni la E/S de red, así que no son bytes leídos/escritos por la herramienta.
+            'block_read_bytes': usage.ru_inblock * 512,
+            'block_write_bytes': usage.ru_oublock * 512,
+            'cmd': " ".join(cmd)
+        })
+
+    result = subprocess.CompletedProcess(cmd, proc.returncode, captured.get('stdout', ''), captured.get('stderr', ''))
+    if check:
+        result.check_returncode()
+    return result
+
+
+def summarize_run_profile(profile_file, output_file):
+    """Agrega el perfil por (muestra, etapa): un registro JSON-lines por muestra y etapa."""
+    if not os.path.exists(profile_file):
+        return []
+    stages = defaultdict(lambda: {'tools': [], 'wall_s': 0.0, 'cpu_s': 0.0, 'max_rss_mb': 0.0, 'read_bytes': 0, 'write_bytes': 0,
+                                  'block_read_bytes': 0, 'block_write_bytes': 0, 'failed': 0})
+    with open(profile_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            agg = stages[(record.get('sample'), record['stage'])]
+            agg['tools'].append(record['tool'])
+            agg['wall_s'] += record['wall_s']
+            agg['cpu_s'] += record['user_cpu_s'] + record['sys_cpu_s']
+            agg['max_rss_mb'] = max(agg['max_rss_mb'], record['max_rss_mb'])
+            if 'block_read_bytes' in record:
+                agg['read_bytes'] += record.get('read_bytes') or 0
+                agg['write_bytes'] += record.get('write_bytes') or 0
+                agg['block_read_bytes'] += record['block_read_bytes']
+                agg['block_write_bytes'] += record['block_write_bytes']
+            else:
+                # Perfiles antiguos: 'read_bytes'/'write_bytes' eran los contadores de bloques.
+                agg['block_read_bytes'] += record.get('read_bytes', 0)
+                agg['block_write_bytes'] += record.get('write_bytes', 0)
+            agg['failed'] += record['exit_code'] != 0
+
+    summary = []
+    for (sample, stage), agg in sorted(stages.items(), key=lambda kv: (str(kv[0][0]), kv[0][1])):
+        summary.append({'sample': sample, 'stage': stage, 'tools': sorted(set(agg['tools'])),
+                        'wall_s': round(agg['wall_s'], 3), 'cpu_s': round(agg['cpu_s'], 3),
+                        'cpu_efficiency': round(agg['cpu_s'] / agg['wall_s'], 3) if agg['wall_s'] else None,
+                        'max_rss_mb': agg['max_rss_mb'], 'read_bytes': agg['read_bytes'], 'write_bytes': agg['write_bytes'],
+                        'block_read_bytes': agg['block_read_bytes'],
+                        'block_write_bytes': agg['block_write_bytes'], 'failed_calls': agg['failed']})
+    with open(output_file, 'w') as f:
+        for record in summary:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resume el perfil de recursos (run_profile.jsonl) por muestra y etapa.")
+    parser.add_argument("profile_file", help="Ruta a run_profile.jsonl.")
+    parser.add_argument("-o", "--output", help="Salida JSON-lines (por defecto run_profile_stages.jsonl junto al perfil).")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.profile_file)), "run_profile_stages.jsonl")
+    summary = summarize_run_profile(args.profile_file, output)
+    print(f"{'MUESTRA':<20}{'ETAPA':<24}{'PARED(s)':>10}{'CPU(s)':>10}{'EFIC.':>7}{'RSS(MB)':>10}{'LEÍDO(MB)':>11}{'ESCRITO(MB)':>12}")
+    for r in summary:
+        print(f"{str(r['sample'] or '-'):<20}{r['stage']:<24}{r['wall_s']:>10.1f}{r['cpu_s']:>10.1f}{(r['cpu_efficiency'] or 0):>7.2f}{r['max_rss_mb']:>10.1f}"
+              f"{r['read_bytes'] / 1024 ** 2:>11.1f}{r['write_bytes'] / 1024 ** 2:>12.1f}")
+    print(f"\nResumen guardado en: {output}")